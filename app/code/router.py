@@ -1,9 +1,11 @@
 import logging
+from functools import partial
 from fastapi import APIRouter, HTTPException, Request, UploadFile
 import prisma
 from app.code.service import CodeService
 from app.foundation.adapter_prisma import PrismaAdapter
 from app.foundation.field_type_match import cast_dict_to_types, model_fields_into_type_map
+from app.foundation.paging import fetch_page_and_count, page_count_mode
 
 adapter = PrismaAdapter()
 service = CodeService()
@@ -21,16 +23,28 @@ async def count():
 async def get_paged(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    page_size = int(query_params["_pageSize"])
-    page_num = int(query_params["_pageNum"])
-    content = await service.fetch_paged(
-        where=query_args,
-        take=page_size,
-        skip=page_size * page_num,
-    )  ##TODO: Group these to a single query
-    count = len(content)
+    try:
+        page_args = adapter.to_page_args(query_params, prisma.models.Code.model_fields)
+        page_count_mode(query_params)
+        fields = adapter.to_fields_args(query_params, prisma.models.Code.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    content, count, approximate = await fetch_page_and_count(
+        query_params,
+        page_args,
+        query_args,
+        fetch_content=partial(service.fetch_paged, **page_args),
+        fetch_count=partial(service.fetch_count, where=query_args),
+        client=service.prisma,
+        table="Code",
+    )
     response = adapter.to_pageable_response(
-        query=query_params, response=content, count=count
+        query=query_params,
+        response=content,
+        count=count,
+        order=page_args["order"],
+        approximate=approximate,
+        fields=fields,
     )
     return response
 
@@ -38,13 +52,36 @@ async def get_paged(request: Request):
 async def get(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    include = query_params.get("_include", None)
-    return await service.fetch_many(
+    try:
+        fields = adapter.to_fields_args(query_params, prisma.models.Code.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    include = (
+        adapter.to_include_exclude_args(query_params["_include"])
+        if "_include" in query_params
+        else None
+    )
+    include = adapter.include_projected(include, fields)
+    results = await service.fetch_many(
         where=query_args, include=include
     )
+    return adapter.project(results, fields)
 
 
-@router.get("/code-group/")
+@router.get("/code-aggregate/")
+async def aggregate(request: Request):
+    """
+    Aggregates the codes in one query, with a columnar response. Query: _dimensions, _measures, _sort, _limit and
+    the filters of /code/, see /iemissiondata-aggregate/. E.g. the codes per type and depth:
+    _dimensions=type,treeDepth&_measures=count&_sort=count:desc.
+    """
+    query_params = request.query_params._dict
+    try:
+        return await service.aggregate(**adapter.to_aggregation_args(query_params))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/code-group/", deprecated=True)
 async def group(count=None, by = None, sum = None, order = None, having = None):
     return await service.group_by(count = count, by = by, sum = sum, order = order, having = having)
 
@@ -9,6 +9,11 @@ from app.foundation.field_type_match import cast_dict_to_types, model_fields_int
 from app.emission_data.service import IEmissionDataService
 from app.config.column_mapping import ipcc_to_gir_code
 import logging
+from app.foundation.aggregation import AggregationQuery
+
+# Typed aggregations of the codes, see aggregate
+CODE_AGGREGATION = AggregationQuery("Code", model_fields_into_type_map(prisma.models.Code.model_fields))
+
 
 class CodeService:
     """
@@ -168,26 +173,38 @@ class CodeService:
             count=count, by=by, sum=sum, order=order, having=having, where=where
         )
 
+    async def aggregate(self, dimensions=(), measures=(), filters=None, order=(), limit=None) -> dict:
+        """
+        Aggregates the codes in one query (see AggregationQuery.compile),
+        e.g. dimensions=["type", "treeDepth"], measures=["count"].
+
+        Returns:
+            dict: One list per dimension and measure.
+        """
+        return await CODE_AGGREGATION.fetch(
+            self.prisma, dimensions=dimensions, measures=measures, filters=filters, order=order, limit=limit
+        )
+
     async def _fetch_page(
-        self, cursor: str, page_size=10
-    ) -> tuple[list[prisma.models.Code], str]:
+        self, cursor: int | None, page_size=10
+    ) -> tuple[list[prisma.models.Code], int]:
         """
         Fetches a page of organizations from the database.
 
         Args:
-            cursor (str): The cursor used for pagination.
+            cursor (int): The sid of the last row of the previous page, None for the first page.
             page_size (int, optional): The number of results per page. Defaults to 10.
 
         Returns:
-            Tuple[List[prisma.models.Code], str]: A tuple containing a list of organizations
+            Tuple[List[prisma.models.Code], int]: A tuple containing a list of organizations
                 and the next cursor for pagination.
         """
         results = await self.prisma.code.find_many(
             take=page_size,
-            cursor={"id": cursor} if cursor else None,
-            order={"id": "asc"},
+            where={"sid": {"gt": cursor}} if cursor is not None else None,
+            order={"sid": "asc"},
         )
-        next_cursor = results[-1].id if results else None
+        next_cursor = results[-1].sid if results else None
         return results, next_cursor
 
     async def fetch_paged(
@@ -212,14 +229,14 @@ class CodeService:
     async def fetch_all_paginated(self):
         pass
 
-    async def fetch_count(self) -> int:
+    async def fetch_count(self, where: prisma.types.CodeWhereInput = None) -> int:
         """
         Fetches the count of the Code table.
 
         Returns:
             int: The count of the Code table.
         """
-        return await self.prisma.code.count()
+        return await self.prisma.code.count(where=where)
 
     # Business logic
 
@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.code.tree import CodeTree, category_code, rollup_category_totals
+
+
+def make_tree():
+    # 2 -> 2.A -> 2.A.1, 2.A.2 ; 2 -> 2.B
+    return CodeTree(
+        uids=["u2", "u2A", "u2A1", "u2A2", "u2B"],
+        codes=["2", "2.A", "2.A.1", "2.A.2", "2.B"],
+        parent_uids=[None, "u2", "u2A", "u2A", "u2"],
+    )
+
+
+def test_category_code():
+    assert category_code("2.A.1.") == "2.A.1"
+    assert category_code("A.  광물산업") == "2.A"
+    assert category_code(None) is None
+
+
+def test_tree_arrays():
+    tree = make_tree()
+    assert list(tree.depth) == [0, 1, 2, 2, 1]
+    assert list(tree.ancestors(tree.find("2.A.1"))) == [tree.find("2.A"), tree.find("2")]
+    assert sorted(tree.codes[i] for i in tree.descendants(tree.find("2"))) == ["2.A", "2.A.1", "2.A.2", "2.B"]
+    assert list(tree.descendants(tree.find("2.B"))) == []
+    assert tree.find("9.Z") == -1
+
+
+def test_tree_cycle():
+    with pytest.raises(ValueError):
+        CodeTree(uids=["a", "b"], codes=["a", "b"], parent_uids=["b", "a"])
+
+
+def test_rollup_sums_children_without_double_counting():
+    tree = make_tree()
+    nodes = np.array([tree.find("2.A.1"), tree.find("2.A.1"), tree.find("2.A.2"), tree.find("2.B"), tree.find("2.A.1")])
+    groups = np.array([0, 0, 0, 0, 1])
+    values = np.array([10.0, 5.0, 20.0, 7.0, 3.0])
+    totals, reported = tree.rollup(nodes, groups, values, group_count=2)
+    assert totals[tree.find("2.A.1"), 0] == 15.0
+    assert totals[tree.find("2.A"), 0] == 35.0
+    assert totals[tree.find("2"), 0] == 42.0
+    assert totals[tree.find("2"), 1] == 3.0
+    assert np.isnan(totals[tree.find("2.B"), 1])
+    assert not reported[tree.find("2.A"), 0]
+
+
+def test_rollup_keeps_reported_totals():
+    tree = make_tree()
+    # The inventory reports 2.A (including sub-categories that are not listed) and 2.A.1
+    nodes = np.array([tree.find("2.A"), tree.find("2.A.1"), tree.find("2.B")])
+    totals, reported = tree.rollup(nodes, np.zeros(3, dtype=int), np.array([50.0, 10.0, 5.0]), group_count=1)
+    assert totals[tree.find("2.A"), 0] == 50.0
+    assert totals[tree.find("2"), 0] == 55.0
+    assert reported[tree.find("2.A"), 0]
+
+
+def test_rollup_category_totals():
+    tree = make_tree()
+    totals = pd.DataFrame([
+        {"source": "calc:gir-db4", "pollutantId": "CO2", "year": 2020, "categoryUid": None, "categoryName": "2.A.1", "emissionTotal": 10.0},
+        {"source": "calc:gir-db4", "pollutantId": "CO2", "year": 2020, "categoryUid": "u2A2", "categoryName": "2.A.2", "emissionTotal": 5.0},
+        {"source": "calc:gir-db4", "pollutantId": "CO2", "year": 2021, "categoryUid": None, "categoryName": "2.B.", "emissionTotal": 1.0},
+        {"source": "calc:gir-db4", "pollutantId": "CO2", "year": 2021, "categoryUid": None, "categoryName": "9.Z", "emissionTotal": 99.0},
+    ])
+    result = rollup_category_totals(tree, totals)
+    lookup = {(row.year, row.categoryCode): row for row in result.itertuples()}
+    assert lookup[(2020, "2")].emissionTotal == 15.0
+    assert lookup[(2020, "2.A")].emissionTotal == 15.0
+    assert lookup[(2020, "2.A")].treeDepth == 1
+    assert lookup[(2020, "2.A.1")].isReported
+    assert lookup[(2021, "2")].emissionTotal == 1.0
+    assert (2021, "2.A") not in lookup
+    assert len(result) == 6
@@ -0,0 +1,177 @@
+from typing import Iterable, Optional
+import numpy as np
+import pandas as pd
+from app.config.column_mapping import ipcc_to_gir_code
+
+# GIR regional (db1) rows name their category in Korean, e.g. "A.  광물산업" for 2.A.
+_GIR_NAME_TO_CODE = {value: key for key, value in ipcc_to_gir_code.items()}
+
+
+def category_code(category_name: Optional[str]) -> Optional[str]:
+    """
+    Returns the IPCC code of an IEmissionData categoryName, e.g. "2.A.1." -> "2.A.1", "A.  광물산업" -> "2.A".
+    """
+    if category_name is None:
+        return None
+    if category_name in _GIR_NAME_TO_CODE:
+        return _GIR_NAME_TO_CODE[category_name]
+    return category_name.strip().rstrip(".")
+
+
+class CodeTree:
+    """
+    The Code hierarchy (parentUid) in array form.
+
+    Nodes are numbered 0..n-1. parent[i] is the index of the parent of i (-1 for roots) and depth[i] its depth.
+    The nodes are also numbered in depth-first order (order, enter, exit), so the descendants of a node are the
+    contiguous slice order[enter[i]:exit[i]].
+    """
+
+    def __init__(self, uids: list[str], codes: list[str], parent_uids: list[Optional[str]]) -> None:
+        self.uids = list(uids)
+        self.codes = list(codes)
+        self.index = {uid: i for i, uid in enumerate(self.uids)}
+        self.code_index = {}
+        for i, code in enumerate(self.codes):
+            self.code_index.setdefault(code, i)
+        self.parent = np.array([self.index.get(uid, -1) if uid else -1 for uid in parent_uids], dtype=int)
+        self._build()
+
+    @classmethod
+    def from_codes(cls, codes: Iterable) -> "CodeTree":
+        """
+        Builds the tree from prisma Code models (or any object with uid, code and parentUid).
+        """
+        codes = list(codes)
+        return cls(
+            uids=[code.uid for code in codes],
+            codes=[code.code for code in codes],
+            parent_uids=[code.parentUid for code in codes],
+        )
+
+    def _build(self) -> None:
+        size = len(self.uids)
+        children = [[] for _ in range(size)]
+        for child, parent in enumerate(self.parent):
+            if parent >= 0:
+                children[parent].append(child)
+        self.children = children
+        self.depth = np.zeros(size, dtype=int)
+        self.enter = np.zeros(size, dtype=int)
+        self.exit = np.zeros(size, dtype=int)
+        order = []
+        visited = np.zeros(size, dtype=bool)
+        for root in [i for i in range(size) if self.parent[i] < 0]:
+            stack = [(root, False)]
+            while stack:
+                node, done = stack.pop()
+                if done:
+                    self.exit[node] = len(order)
+                    continue
+                visited[node] = True
+                self.enter[node] = len(order)
+                order.append(node)
+                stack.append((node, True))
+                for child in reversed(children[node]):
+                    self.depth[child] = self.depth[node] + 1
+                    stack.append((child, False))
+        if not visited.all():
+            raise ValueError(f"The code hierarchy has a cycle: {[self.codes[i] for i in np.flatnonzero(~visited)][:10]}")
+        self.order = np.array(order, dtype=int)
+        self.max_depth = int(self.depth.max()) if size else 0
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def find(self, code: Optional[str]) -> int:
+        """Returns the index of the node with this code (see category_code), -1 if there is none."""
+        return self.code_index.get(code, -1) if code is not None else -1
+
+    def ancestors(self, node: int) -> np.ndarray:
+        """The indices from the parent of node up to its root."""
+        path = []
+        node = self.parent[node]
+        while node >= 0:
+            path.append(node)
+            node = self.parent[node]
+        return np.array(path, dtype=int)
+
+    def descendants(self, node: int) -> np.ndarray:
+        """The indices of the nodes below node, in depth-first order."""
+        return self.order[self.enter[node] + 1:self.exit[node]]
+
+    def rollup(self, nodes: np.ndarray, groups: np.ndarray, values: np.ndarray, group_count: int) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Computes the total of every node for every group (e.g. source, pollutant and year) in one bottom-up pass.
+
+        A node keeps its own reported value when it has one, otherwise its total is the sum of the totals of its
+        children. Inventories such as GIR4 report the totals of every level, so summing every level would count
+        the emissions several times.
+
+        Args:
+            nodes (np.ndarray): The node index of every value.
+            groups (np.ndarray): The group index (0..group_count-1) of every value.
+            values (np.ndarray): The values. Several values of the same node and group are summed.
+            group_count (int): The number of groups.
+
+        Returns:
+            tuple[np.ndarray, np.ndarray]: The (nodes x groups) totals, NaN where a node has no data, and the mask
+            of the totals that were reported rather than rolled up.
+        """
+        size = len(self.uids)
+        reported = np.zeros((size, group_count))
+        has_reported = np.zeros((size, group_count), dtype=bool)
+        np.add.at(reported, (nodes, groups), values)
+        has_reported[nodes, groups] = True
+
+        child_sums = np.zeros((size, group_count))
+        has_children = np.zeros((size, group_count), dtype=bool)
+        totals = np.full((size, group_count), np.nan)
+        for depth in range(self.max_depth, -1, -1):
+            level = np.flatnonzero(self.depth == depth)
+            level_totals = np.where(has_reported[level], reported[level], np.where(has_children[level], child_sums[level], np.nan))
+            totals[level] = level_totals
+            with_parent = self.parent[level] >= 0
+            parents = self.parent[level][with_parent]
+            known = ~np.isnan(level_totals[with_parent])
+            np.add.at(child_sums, parents, np.nan_to_num(level_totals[with_parent]))
+            np.logical_or.at(has_children, parents, known)
+        return totals, has_reported
+
+
+ROLLUP_GROUP_COLUMNS = ["source", "pollutantId", "year"]
+
+
+def rollup_category_totals(tree: CodeTree, totals: pd.DataFrame) -> pd.DataFrame:
+    """
+    Rolls the category totals up the code tree for every (source, pollutantId, year).
+
+    Args:
+        tree (CodeTree): The code hierarchy.
+        totals (pd.DataFrame): source, pollutantId, year, categoryUid, categoryName and emissionTotal,
+            e.g. CATEGORY_TOTALS_BY_YEAR. Rows are matched to the tree by categoryUid, then by categoryName.
+
+    Returns:
+        pd.DataFrame: One row per (source, pollutantId, year, node with data) with categoryUid, categoryCode,
+        treeDepth, emissionTotal and isReported.
+    """
+    columns = [*ROLLUP_GROUP_COLUMNS, "categoryUid", "categoryCode", "treeDepth", "emissionTotal", "isReported"]
+    if totals.empty or len(tree) == 0:
+        return pd.DataFrame(columns=columns)
+    by_uid = totals["categoryUid"].map(tree.index)
+    by_name = totals["categoryName"].map(lambda name: tree.find(category_code(name)))
+    nodes = by_uid.fillna(by_name).astype(int).to_numpy()
+    values = pd.to_numeric(totals["emissionTotal"], errors="coerce").to_numpy(dtype=float)
+    matched = (nodes >= 0) & ~np.isnan(values)
+    group_keys = totals.loc[matched, ROLLUP_GROUP_COLUMNS]
+    group_codes, group_index = pd.MultiIndex.from_frame(group_keys).factorize()
+    rolled, reported = tree.rollup(nodes[matched], group_codes, values[matched], len(group_index))
+
+    node_idx, group_idx = np.nonzero(~np.isnan(rolled))
+    result = pd.DataFrame(list(group_index[group_idx]), columns=ROLLUP_GROUP_COLUMNS)
+    result["categoryUid"] = np.asarray(tree.uids, dtype=object)[node_idx]
+    result["categoryCode"] = np.asarray(tree.codes, dtype=object)[node_idx]
+    result["treeDepth"] = tree.depth[node_idx]
+    result["emissionTotal"] = rolled[node_idx, group_idx]
+    result["isReported"] = reported[node_idx, group_idx]
+    return result[columns]
@@ -367,6 +367,28 @@ address_dict = {
 }
 
 
+# 100-year global warming potentials of the pollutantIds per IPCC assessment report (SAR is the basis of the older GIR inventories).
+# pollutantIds that are already CO2 equivalents have a GWP of 1. Keys are upper case, lookups are case-insensitive.
+gwp_values = {
+    "SAR": {"CO2": 1, "CH4": 21, "N2O": 310, "SF6": 23900, "CO2EQ": 1, "TCO2EQ": 1},
+    "AR5": {"CO2": 1, "CH4": 28, "N2O": 265, "SF6": 23500, "NF3": 16100, "CO2EQ": 1, "TCO2EQ": 1},
+}
+default_gwp_set = "AR5"
+
+# Tonnes per unit
+unit_factors = {"t": 1, "kt": 1000, "Mt": 1000000}
+
+# Unit of emissionTotal per source. GIR regional (db1) and ETS data are in tonnes, the national inventory (db4) in kilotonnes.
+source_units = {
+    "orig:gir-db4": "kt",
+    "orig:gir-db1": "t",
+    "orig:gir-ets": "t",
+    "calc:gir-db4": "kt",
+    "calc:gir-db1": "kt",
+    "est:intensity": "t",
+}
+
+# tCO2eq per employee (per_capita) and per m2 of manufacturing facility (per_sqrmt), see app.emission_data.intensity
 emission_intensity = {
     "2.A":{
         "per_capita": 1.576155271,
@@ -10,3 +10,12 @@ KAKAO_API_KEY = os.getenv("KAKAO_API_KEY")
 ROOT_DIR = dotenv_path = os.path.join(os.path.dirname(__file__), '../../', '/app')
 KAKAO_API_BURL = os.getenv("KAKAO_API_BURL")
 ENV_IS_GITHUB = bool(os.getenv("GITHUB_ACTIONS"))
+RESPONSE_CACHE_SIZE = int(os.getenv("RESPONSE_CACHE_SIZE", 256))
+RESPONSE_CACHE_TTL = float(os.getenv("RESPONSE_CACHE_TTL", 600))
+TILE_CACHE_SIZE = int(os.getenv("TILE_CACHE_SIZE", 4096))
+EMISSION_STORE_ENABLED = os.getenv("EMISSION_STORE_ENABLED", "false").lower() == "true"
+EMISSION_STORE_MAX_ROWS = int(os.getenv("EMISSION_STORE_MAX_ROWS", 2_000_000))
+PAGE_COUNT_CACHE_TTL = float(os.getenv("PAGE_COUNT_CACHE_TTL", 60))
+CALC_RUN_RETENTION = int(os.getenv("CALC_RUN_RETENTION", 3))
+LONG_TX_TIMEOUT_SECONDS = float(os.getenv("LONG_TX_TIMEOUT_SECONDS", 600))
+JOB_LOCK_TIMEOUT_SECONDS = float(os.getenv("JOB_LOCK_TIMEOUT_SECONDS", 6 * 3600))
@@ -0,0 +1,186 @@
+from datetime import datetime
+from typing import Dict, Iterable, Optional
+import numpy as np
+import pandas as pd
+from app.emission_data.queries import GIR_TOTALS_BY_YEAR, RELATIONS_WITH_SITES
+
+# Site fields that can be overridden in a what-if scenario. They are the proxies used by
+# IOrgSiteService.update_relation_single to derive contributionMagnitudeSector.
+PROXY_FIELDS = ["manufacturingFacilityArea"]
+
+# Which GIR source is allocated to a relation depends on its category level (see calculate_emissions).
+GIR4_SOURCE = "orig:gir-db4"
+GIR1_SOURCE = "orig:gir-db1"
+
+RESULT_COLUMNS = [
+    "categoryName", "categoryUid", "periodStartDt", "periodEndDt", "periodLength", "emissionTotal",
+    "source", "regionUid", "regionName", "siteUid", "pollutantId", "longitude", "latitude", "categoryRelUid",
+]
+
+
+class AllocationEngine:
+    """
+    In-memory version of IEmissionDataService.calculate_emissions.
+
+    The relations and the GIR totals are loaded once. The relations are the non-zero entries of the
+    sites x categories contribution matrix and are kept in COO form (one array per attribute), so allocating
+    every year and every pollutant sheet is a handful of numpy operations instead of a DB round trip per relation.
+    """
+
+    def __init__(self, relations: pd.DataFrame, totals: pd.DataFrame) -> None:
+        """
+        Args:
+            relations (pd.DataFrame): One row per ISiteCategoryRel with the site fields of RELATIONS_WITH_SITES.
+            totals (pd.DataFrame): One row per (source, categoryName, pollutantId, year) as returned by GIR_TOTALS_BY_YEAR.
+        """
+        relations = relations[relations["categoryName"].notna()].reset_index(drop=True)
+        self.relations = relations
+        self.totals = totals.reset_index(drop=True)
+        self.total_values = pd.to_numeric(self.totals["emissionTotal"], errors="coerce").to_numpy(dtype=float)
+        self.calc_sources = ("calc:" + self.totals["source"].str.split(":").str[1]).to_numpy()
+
+        self.category_index = pd.Index(pd.unique(pd.concat([relations["categoryName"], self.totals["categoryName"]])))
+        self.category_codes = self.category_index.get_indexer(relations["categoryName"])
+        self.site_uids = relations["siteUid"].to_numpy()
+        self.contribution = pd.to_numeric(relations["contributionMagnitudeSector"], errors="coerce").to_numpy(dtype=float)
+        self.operation_start = pd.to_datetime(relations["operationStartDt"], utc=True).dt.tz_localize(None).to_numpy(dtype="datetime64[ns]")
+        self.is_gir4 = pd.to_numeric(relations["categoryLevel"], errors="coerce").to_numpy(dtype=float) > 2
+        sector_ids = relations["sectorIds"] if "sectorIds" in relations else pd.Series(None, index=relations.index)
+        self.sector_count = sector_ids.fillna("").astype(str).str.split(",").str.len().to_numpy(dtype=float)
+
+    @classmethod
+    async def load(cls, client, year_from: int, year_to: int) -> "AllocationEngine":
+        """
+        Loads the relations and the GIR totals of [year_from, year_to] from the database.
+
+        Args:
+            client: The prisma client (see app.database.get_connection).
+            year_from (int): The first year to load totals for.
+            year_to (int): The last year (inclusive) to load totals for.
+
+        Returns:
+            AllocationEngine: The engine, ready to allocate without further DB access.
+        """
+        relations = await client.query_raw(RELATIONS_WITH_SITES)
+        totals = await client.query_raw(GIR_TOTALS_BY_YEAR, year_from, year_to)
+        relations_df = pd.DataFrame(relations, columns=[
+            "uid", "siteUid", "categoryName", "categoryLevel", "contributionMagnitudeSector", "operationStartDt",
+            "manufacturingFacilityArea", "sectorIds", "addressRegionUid", "addressSubRegion", "longitude", "latitude",
+        ])
+        totals_df = pd.DataFrame(totals, columns=[
+            "source", "categoryName", "categoryUid", "pollutantId", "year", "periodStartDt", "periodEndDt",
+            "periodLength", "emissionTotal",
+        ])
+        # query_raw returns DateTime columns as ISO strings
+        for column in ["periodStartDt", "periodEndDt"]:
+            totals_df[column] = pd.to_datetime(totals_df[column]).dt.tz_localize(None)
+        return cls(relations_df, totals_df)
+
+    def contributions(self, overrides: Optional[Dict[str, Dict[str, float]]] = None) -> np.ndarray:
+        """
+        Returns the contribution of every relation, with the proxy overrides applied.
+
+        Args:
+            overrides (dict): {siteUid: {proxyField: value}}, e.g. {"site-1": {"manufacturingFacilityArea": 120.0}}.
+                A value <= 0 removes the site from the allocation, as update_relation_single does.
+
+        Returns:
+            np.ndarray: The contributionMagnitudeSector of every relation.
+
+        Raises:
+            ValueError: When a field is not a proxy field, or a site has no relation (unknown or not allocated).
+        """
+        contribution = self.contribution.copy()
+        if not overrides:
+            return contribution
+        unknown_sites = set(overrides) - set(self.site_uids)
+        if unknown_sites:
+            raise ValueError(f"No relations for the sites {sorted(unknown_sites)}")
+        for site_uid, fields in overrides.items():
+            unknown = set(fields) - set(PROXY_FIELDS)
+            if unknown:
+                raise ValueError(f"Cannot override {unknown}, proxy fields are {PROXY_FIELDS}")
+            mask = self.site_uids == site_uid
+            proxy = fields.get("manufacturingFacilityArea")
+            if proxy is None:
+                continue
+            contribution[mask] = proxy / self.sector_count[mask] if proxy > 0 else np.nan
+        return contribution
+
+    def allocate(
+        self,
+        years: Iterable[int],
+        overrides: Optional[Dict[str, Dict[str, float]]] = None,
+        pollutants: Optional[Iterable[str]] = None,
+    ) -> pd.DataFrame:
+        """
+        Allocates the GIR totals of the given years to the sites.
+
+        Args:
+            years (Iterable[int]): The years to allocate.
+            overrides (dict, optional): Proxy overrides, see contributions().
+            pollutants (Iterable[str], optional): Restrict the result to these pollutantIds (e.g. ["CO2"]).
+
+        Returns:
+            pd.DataFrame: The calc rows (RESULT_COLUMNS), in the shape calculate_emissions writes them.
+        """
+        years = np.asarray(sorted(set(years)), dtype=int)
+        if len(years) == 0 or len(self.relations) == 0:
+            return pd.DataFrame(columns=RESULT_COLUMNS)
+
+        contribution = np.nan_to_num(self.contributions(overrides), nan=0.0)
+        year_start = np.array([np.datetime64(datetime(year, 1, 1), "ns") for year in years])
+        # (relations x years): a relation takes part in a year once its site is operating on Jan 1st
+        weights = (self.operation_start[:, None] <= year_start[None, :]) * contribution[:, None]
+        category_sums = np.zeros((len(self.category_index), len(years)))
+        np.add.at(category_sums, self.category_codes, weights)
+        relation_sums = category_sums[self.category_codes]
+        shares = np.divide(weights, relation_sums, out=np.zeros_like(weights), where=relation_sums != 0)
+
+        totals = self.totals[self.totals["year"].isin(years)]
+        if pollutants is not None:
+            totals = totals[totals["pollutantId"].isin(list(pollutants))]
+        relation_rows, total_rows, emission_values = [], [], []
+        for source, group in totals.groupby(["source", "pollutantId"], sort=False):
+            relation_mask = self.is_gir4 if source[0] == GIR4_SOURCE else ~self.is_gir4
+            # (categories x years) -> row of the GIR total in self.totals, -1 if there is none
+            total_index = np.full((len(self.category_index), len(years)), -1)
+            total_index[
+                self.category_index.get_indexer(group["categoryName"]), np.searchsorted(years, group["year"])
+            ] = group.index.to_numpy()
+            relation_total_index = total_index[self.category_codes]
+            eligible = relation_mask[:, None] & (shares > 0) & (relation_total_index >= 0)
+            relation_idx, year_idx = np.nonzero(eligible)
+            total_idx = relation_total_index[relation_idx, year_idx]
+            relation_rows.append(relation_idx)
+            total_rows.append(total_idx)
+            emission_values.append(shares[relation_idx, year_idx] * self.total_values[total_idx])
+        if not relation_rows:
+            return pd.DataFrame(columns=RESULT_COLUMNS)
+        return self._to_frame(np.concatenate(relation_rows), np.concatenate(total_rows), np.concatenate(emission_values))
+
+    def _to_frame(self, relation_idx: np.ndarray, total_idx: np.ndarray, emissions: np.ndarray) -> pd.DataFrame:
+        relations = {column: self.relations[column].to_numpy()[relation_idx] for column in [
+            "categoryName", "addressRegionUid", "addressSubRegion", "siteUid", "longitude", "latitude", "uid",
+        ]}
+        totals = {column: self.totals[column].to_numpy()[total_idx] for column in [
+            "categoryUid", "periodStartDt", "periodEndDt", "periodLength", "pollutantId",
+        ]}
+        valid = ~np.isnan(emissions)
+        frame = pd.DataFrame({
+            "categoryName": relations["categoryName"],
+            "categoryUid": totals["categoryUid"],
+            "periodStartDt": totals["periodStartDt"],
+            "periodEndDt": totals["periodEndDt"],
+            "periodLength": totals["periodLength"],
+            "emissionTotal": emissions,
+            "source": self.calc_sources[total_idx],
+            "regionUid": relations["addressRegionUid"],
+            "regionName": relations["addressSubRegion"],
+            "siteUid": relations["siteUid"],
+            "pollutantId": totals["pollutantId"],
+            "longitude": relations["longitude"],
+            "latitude": relations["latitude"],
+            "categoryRelUid": relations["uid"],
+        })
+        return frame[valid].reset_index(drop=True)
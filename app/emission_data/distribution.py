@@ -0,0 +1,76 @@
+import numpy as np
+import pandas as pd
+
+# Organization emission fields distributed to the sites proportionally to their manufacturing facility area.
+# create_org_emission receives the scopes as emissionScope1/emissionScope2 (see Emission).
+DISTRIBUTED_FIELDS = [
+    "emissionTotal", "emissionDirect", "emissionIndirect", "energyHeat", "energyElectricity", "energyFuel", "energyTotal",
+]
+SCOPE_FIELDS = {"emissionScope1": "emissionDirect", "emissionScope2": "emissionIndirect"}
+PERIOD_FIELDS = ["periodStartDt", "periodEndDt", "periodLength", "source"]
+ORG_EMISSION_POLLUTANT = "tCO2eq"
+
+
+def normalize_org_totals(
+    org_totals: pd.DataFrame, pollutant_id: str | None = ORG_EMISSION_POLLUTANT, fill_value: float | None = 0.0
+) -> pd.DataFrame:
+    """
+    Returns the organization totals with the scopes renamed to the IEmissionData fields, every distributed field
+    present (fill_value when missing) and a one year period when only periodStartDt is known.
+
+    Args:
+        org_totals (pd.DataFrame): One row per organization total with organizationUid, source, periodStartDt and
+            any of DISTRIBUTED_FIELDS (or emissionScope1/emissionScope2).
+        pollutant_id (str, optional): The pollutantId of the rows. Defaults to tCO2eq, like create_org_emission.
+        fill_value (float, optional): The value of the missing fields, None keeps them NULL. Defaults to 0.
+
+    Returns:
+        pd.DataFrame: The normalized totals.
+    """
+    totals = org_totals.rename(columns={key: value for key, value in SCOPE_FIELDS.items() if value not in org_totals})
+    fill_value = np.nan if fill_value is None else fill_value
+    for field in DISTRIBUTED_FIELDS:
+        totals[field] = pd.to_numeric(totals[field], errors="coerce").fillna(fill_value) if field in totals else fill_value
+    totals["periodStartDt"] = pd.to_datetime(totals["periodStartDt"])
+    if "periodEndDt" not in totals:
+        totals["periodEndDt"] = totals["periodStartDt"] + pd.DateOffset(years=1)
+    totals["periodEndDt"] = pd.to_datetime(totals["periodEndDt"])
+    if "periodLength" not in totals:
+        totals["periodLength"] = "1Y"
+    totals["pollutantId"] = pollutant_id
+    return totals.reset_index(drop=True)
+
+
+def distribute_org_emissions(org_totals: pd.DataFrame, sites: pd.DataFrame) -> pd.DataFrame:
+    """
+    Distributes organization totals to their sites, weighted by manufacturingFacilityArea, for every
+    distributed field at once. Same ratios as IEmissionDataService.create_org_emission: a site without area
+    gets 0, and every site gets 0 when the organization has no area at all. Missing totals stay missing.
+
+    Args:
+        org_totals (pd.DataFrame): The normalized organization totals (see normalize_org_totals).
+        sites (pd.DataFrame): The sites with uid, organizationUid, manufacturingFacilityArea, longitude, latitude,
+            addressRegionUid and addressRegionName.
+
+    Returns:
+        pd.DataFrame: One IEmissionData row per (organization total, site).
+    """
+    if org_totals.empty or sites.empty:
+        return pd.DataFrame(columns=["organizationUid", "siteUid", *PERIOD_FIELDS, "pollutantId", *DISTRIBUTED_FIELDS])
+    sites = sites.copy()
+    area = pd.to_numeric(sites["manufacturingFacilityArea"], errors="coerce").fillna(0.0)
+    sites["area"] = area.where(area > 0, 0.0)
+    org_area = sites.groupby("organizationUid")["area"].transform("sum")
+    sites["ratio"] = np.divide(sites["area"], org_area, out=np.zeros(len(sites)), where=org_area.to_numpy() > 0)
+
+    rows = org_totals.merge(
+        sites[["uid", "organizationUid", "ratio", "longitude", "latitude", "addressRegionUid", "addressRegionName"]],
+        on="organizationUid",
+        how="inner",
+    )
+    rows[DISTRIBUTED_FIELDS] = rows[DISTRIBUTED_FIELDS].to_numpy(dtype=float) * rows["ratio"].to_numpy()[:, None]
+    rows = rows.rename(columns={"uid": "siteUid", "addressRegionUid": "regionUid", "addressRegionName": "regionName"})
+    return rows[[
+        "organizationUid", "siteUid", *PERIOD_FIELDS, "pollutantId", *DISTRIBUTED_FIELDS,
+        "longitude", "latitude", "regionUid", "regionName",
+    ]]
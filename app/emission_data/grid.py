@@ -0,0 +1,71 @@
+import math
+import numpy as np
+import pandas as pd
+
+# Cell sizes (degrees) of the heatmap grid are powers of two between these, so that a grid is coarsened by merging
+# 2x2 cells and requests of similar resolutions share their cached grid.
+FINEST_GRID_EXPONENT = -7  # about 0.0078 degrees, under 1 km
+COARSEST_GRID_EXPONENT = 0  # 1 degree
+DEFAULT_GRID_RESOLUTION = 2.0**-3
+# Cells per side of a 256px map tile at a zoom level, i.e. a cell of about 8px
+CELLS_PER_TILE = 32
+# Grids with more cells are coarsened until they fit
+MAX_GRID_CELLS = 4000
+
+
+def grid_resolution(resolution: float | None = None, zoom: int | None = None) -> float:
+    """
+    Returns the grid cell size for a requested cell size or map zoom level, the power of two at least as large
+    (bounded by FINEST_GRID_EXPONENT and COARSEST_GRID_EXPONENT).
+
+    Args:
+        resolution (float, optional): The requested cell size in degrees.
+        zoom (int, optional): The web map zoom level, used when resolution is None.
+
+    Returns:
+        float: The cell size in degrees, DEFAULT_GRID_RESOLUTION without resolution and zoom.
+    """
+    if resolution is None and zoom is None:
+        return DEFAULT_GRID_RESOLUTION
+    if resolution is None:
+        resolution = 360 / 2 ** int(zoom) / CELLS_PER_TILE
+    if not resolution > 0:
+        raise ValueError(f"The resolution must be positive, got {resolution}")
+    exponent = min(max(math.ceil(math.log2(resolution)), FINEST_GRID_EXPONENT), COARSEST_GRID_EXPONENT)
+    return 2.0**exponent
+
+
+def bin_grid(cells: pd.DataFrame, resolution: float, max_cells: int = MAX_GRID_CELLS) -> dict:
+    """
+    Turns the cells binned in SQL (row and column indexes of the grid of resolution, see EMISSION_GRID) into the
+    heatmap response, merging 2x2 cells until there are at most max_cells.
+
+    Args:
+        cells (pd.DataFrame): row, column, emissionTotal and rowCount per cell.
+        resolution (float): The cell size (degrees) of the indexes.
+        max_cells (int, optional): The maximum number of cells. Defaults to MAX_GRID_CELLS.
+
+    Returns:
+        dict: The resolution and columnar arrays of the cell centers (latitude, longitude), emissionTotal and rowCount.
+    """
+    if cells.empty:
+        cells = pd.DataFrame(columns=["row", "column", "emissionTotal", "rowCount"])
+    keys = cells[["row", "column"]].to_numpy(dtype=np.int64)
+    totals = cells["emissionTotal"].to_numpy(dtype=float)
+    counts = cells["rowCount"].to_numpy(dtype=np.int64)
+    while True:
+        keys, inverse = np.unique(keys, axis=0, return_inverse=True)
+        inverse = inverse.reshape(-1)
+        totals = np.bincount(inverse, weights=totals, minlength=len(keys))
+        counts = np.bincount(inverse, weights=counts, minlength=len(keys)).astype(np.int64)
+        if len(keys) <= max_cells or resolution >= 2.0**COARSEST_GRID_EXPONENT:
+            break
+        keys = np.floor_divide(keys, 2)
+        resolution *= 2
+    return {
+        "resolution": resolution,
+        "latitude": ((keys[:, 0] + 0.5) * resolution).tolist(),
+        "longitude": ((keys[:, 1] + 0.5) * resolution).tolist(),
+        "emissionTotal": totals.tolist(),
+        "rowCount": counts.tolist(),
+    }
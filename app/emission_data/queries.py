@@ -0,0 +1,791 @@
+"""
+Raw SQL used by the emission data service for set-based operations that cannot be
+expressed efficiently through the Prisma query builder.
+
+Queries are parameterized ($1, $2, ...) and are executed with ``execute_raw`` / ``query_raw``.
+"""
+import json
+from app.config.column_mapping import source_units
+from app.utils.units import co2eq_sql, source_unit_sql, unit_factor
+
+# GIR1 regional rows are in tonnes, the allocation works in kilotonnes like GIR4.
+_GIR1_TO_KT = unit_factor(source_units["orig:gir-db1"], "kt")
+
+# Relations active for the year (site started operating before Jan 1st), with the
+# per-category contribution total computed once through a window function.
+_ACTIVE_RELATIONS = """
+    SELECT
+        r."uid",
+        r."siteUid",
+        r."categoryName",
+        r."categoryLevel",
+        r."contributionMagnitudeSector",
+        s."addressRegionUid",
+        s."addressSubRegion",
+        s."longitude",
+        s."latitude",
+        SUM(r."contributionMagnitudeSector") OVER (PARTITION BY r."categoryName") AS "categoryContribution"
+    FROM "ISiteCategoryRel" r
+    JOIN "IOrgSite" s ON s."uid" = r."siteUid"
+    WHERE s."operationStartDt" <= make_timestamp($1, 1, 1, 0, 0, 0)
+        {category_condition}
+"""
+
+# GIR4 (3rd level and deeper): the CO2 row of the category for the year.
+_GIR4_TOTALS = """
+    SELECT DISTINCT ON (e."categoryName")
+        e."categoryName",
+        e."categoryUid",
+        e."pollutantId",
+        e."periodStartDt",
+        e."periodEndDt",
+        e."periodLength",
+        e."emissionTotal"
+    FROM "IEmissionData" e
+    WHERE e."source" = 'orig:gir-db4'
+        AND e."pollutantId" = 'CO2'
+        AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+        AND e."periodEndDt" <= make_timestamp($1, 12, 31, 0, 0, 0)
+    ORDER BY e."categoryName", e."sid"
+"""
+
+# GIR1 (2nd level): regional rows summed per category and converted to kt (see create_partial_gir1).
+_GIR1_TOTALS = f"""
+    SELECT DISTINCT ON (g."categoryName")
+        g."categoryName",
+        g."categoryUid",
+        'CO2eq' AS "pollutantId",
+        make_timestamp($1, 1, 1, 0, 0, 0) AS "periodStartDt",
+        make_timestamp($1, 12, 31, 0, 0, 0) AS "periodEndDt",
+        '1Y' AS "periodLength",
+        g."emissionTotal"
+    FROM (
+        SELECT e."categoryName", e."categoryUid", SUM(e."emissionTotal") * {_GIR1_TO_KT} AS "emissionTotal"
+        FROM "IEmissionData" e
+        WHERE e."source" = 'orig:gir-db1'
+            AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+            AND e."periodEndDt" <= make_timestamp($1, 12, 31, 0, 0, 0)
+        GROUP BY e."categoryName", e."pollutantId", e."categoryUid"
+    ) g
+    ORDER BY g."categoryName", g."categoryUid"
+"""
+
+# Rows are written into the calculation run $2 (see IEmissionDataService.start_calc_run).
+_ALLOCATE_EMISSIONS = """
+    WITH rels AS ({relations}),
+    totals AS ({totals})
+    INSERT INTO "IEmissionData" (
+        "uid", "categoryName", "categoryUid", "periodStartDt", "periodEndDt", "periodLength",
+        "emissionTotal", "source", "regionUid", "regionName", "siteUid", "pollutantId",
+        "longitude", "latitude", "categoryRelUid", "calcRunUid"
+    )
+    SELECT
+        gen_random_uuid()::text,
+        rels."categoryName",
+        totals."categoryUid",
+        totals."periodStartDt",
+        totals."periodEndDt",
+        totals."periodLength",
+        rels."contributionMagnitudeSector" / NULLIF(rels."categoryContribution", 0) * totals."emissionTotal",
+        '{calc_source}',
+        rels."addressRegionUid",
+        rels."addressSubRegion",
+        rels."siteUid",
+        totals."pollutantId",
+        rels."longitude",
+        rels."latitude",
+        rels."uid",
+        $2::text
+    FROM rels
+    JOIN totals ON totals."categoryName" = rels."categoryName"
+    WHERE {level_condition}
+        AND rels."contributionMagnitudeSector" IS NOT NULL
+        AND totals."emissionTotal" IS NOT NULL
+        AND COALESCE(rels."categoryContribution", 0) <> 0
+    ON CONFLICT ("categoryRelUid", "periodStartDt", "periodEndDt", "pollutantId", "source", "calcRunUid")
+    DO UPDATE SET
+        "categoryName" = EXCLUDED."categoryName",
+        "categoryUid" = EXCLUDED."categoryUid",
+        "periodLength" = EXCLUDED."periodLength",
+        "emissionTotal" = EXCLUDED."emissionTotal",
+        "regionUid" = EXCLUDED."regionUid",
+        "regionName" = EXCLUDED."regionName",
+        "siteUid" = EXCLUDED."siteUid",
+        "longitude" = EXCLUDED."longitude",
+        "latitude" = EXCLUDED."latitude",
+        "dateModified" = now()
+"""
+
+# Categories are passed as a JSON array ($3) by the incremental calculation.
+_CATEGORY_FILTER = """AND {column} IN (SELECT jsonb_array_elements_text($3::jsonb))"""
+
+
+def _allocate_emissions(totals: str, calc_source: str, level_condition: str, category_condition: str = "") -> str:
+    return _ALLOCATE_EMISSIONS.format(
+        relations=_ACTIVE_RELATIONS.format(category_condition=category_condition),
+        totals=totals,
+        calc_source=calc_source,
+        level_condition=level_condition,
+    )
+
+
+ALLOCATE_GIR4_EMISSIONS = _allocate_emissions(_GIR4_TOTALS, "calc:gir-db4", 'rels."categoryLevel" > 2')
+ALLOCATE_GIR1_EMISSIONS = _allocate_emissions(_GIR1_TOTALS, "calc:gir-db1", 'rels."categoryLevel" <= 2')
+ALLOCATE_GIR4_EMISSIONS_FOR_CATEGORIES = _allocate_emissions(
+    _GIR4_TOTALS, "calc:gir-db4", 'rels."categoryLevel" > 2', _CATEGORY_FILTER.format(column='r."categoryName"')
+)
+ALLOCATE_GIR1_EMISSIONS_FOR_CATEGORIES = _allocate_emissions(
+    _GIR1_TOTALS, "calc:gir-db1", 'rels."categoryLevel" <= 2', _CATEGORY_FILTER.format(column='r."categoryName"')
+)
+
+# Copies the calc rows of run $1 outside the categories of the JSON array $3 into the staging run $2, so that an
+# incremental calculation only reallocates the dirty categories of the new run.
+COPY_CALC_RUN_EXCEPT_CATEGORIES = """
+    INSERT INTO "IEmissionData" (
+        "uid", "categoryName", "categoryUid", "periodStartDt", "periodEndDt", "periodLength",
+        "emissionTotal", "source", "regionUid", "regionName", "siteUid", "pollutantId",
+        "longitude", "latitude", "categoryRelUid", "calcRunUid"
+    )
+    SELECT
+        gen_random_uuid()::text, e."categoryName", e."categoryUid", e."periodStartDt", e."periodEndDt", e."periodLength",
+        e."emissionTotal", e."source", e."regionUid", e."regionName", e."siteUid", e."pollutantId",
+        e."longitude", e."latitude", e."categoryRelUid", $2::text
+    FROM "IEmissionData" e
+    WHERE e."calcRunUid" = $1
+        AND (e."categoryName" IS NULL OR e."categoryName" NOT IN (SELECT jsonb_array_elements_text($3::jsonb)))
+"""
+
+# Makes $1 the only active run of its year. Readers only see the rows of active runs, so this single
+# statement is the publication: it touches the runs of one year, never the emission rows.
+PUBLISH_CALC_RUN = """
+    UPDATE "IEmissionCalcRun"
+    SET "isActive" = ("uid" = $1),
+        "status" = CASE
+            WHEN "uid" = $1 THEN 'published'
+            WHEN "status" = 'published' THEN 'archived'
+            ELSE "status"
+        END,
+        "datePublished" = CASE WHEN "uid" = $1 THEN now() ELSE "datePublished" END,
+        "dateModified" = now()
+    WHERE "year" = (SELECT "year" FROM "IEmissionCalcRun" WHERE "uid" = $1)
+        AND ("uid" = $1 OR "isActive" OR "status" = 'published')
+"""
+
+# Calc rows written before runs existed are attached to run $2 so that they can be superseded.
+ADOPT_UNVERSIONED_EMISSIONS = """
+    UPDATE "IEmissionData"
+    SET "calcRunUid" = $2
+    WHERE "calcRunUid" IS NULL
+        AND "source" IN ('calc:gir-db4', 'calc:gir-db1')
+        AND "periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+        AND "periodEndDt" <= make_timestamp($1, 12, 31, 0, 0, 0)
+"""
+
+# Per (categoryName, source, pollutantId) totals of two runs, $1 (base) and $2 (compared).
+DIFF_CALC_RUNS = """
+    SELECT
+        e."categoryName",
+        e."source",
+        e."pollutantId",
+        SUM(CASE WHEN e."calcRunUid" = $1 THEN e."emissionTotal" END) AS "baseTotal",
+        SUM(CASE WHEN e."calcRunUid" = $2 THEN e."emissionTotal" END) AS "comparedTotal",
+        COALESCE(SUM(CASE WHEN e."calcRunUid" = $2 THEN e."emissionTotal" END), 0)
+            - COALESCE(SUM(CASE WHEN e."calcRunUid" = $1 THEN e."emissionTotal" END), 0) AS "delta",
+        COUNT(*) FILTER (WHERE e."calcRunUid" = $1) AS "baseRows",
+        COUNT(*) FILTER (WHERE e."calcRunUid" = $2) AS "comparedRows"
+    FROM "IEmissionData" e
+    WHERE e."calcRunUid" IN ($1, $2)
+    GROUP BY e."categoryName", e."source", e."pollutantId"
+    ORDER BY ABS(
+        COALESCE(SUM(CASE WHEN e."calcRunUid" = $2 THEN e."emissionTotal" END), 0)
+            - COALESCE(SUM(CASE WHEN e."calcRunUid" = $1 THEN e."emissionTotal" END), 0)
+    ) DESC
+"""
+
+# Marking an already dirty group increments its version, so that a calculation running meanwhile keeps the mark.
+MARK_CALCULATION_DIRTY_CONFLICT = """
+    ON CONFLICT ("categoryName", "year") DO UPDATE
+    SET "version" = "IEmissionCalcDirty"."version" + 1, "reason" = EXCLUDED."reason"
+"""
+
+# Dirty (categoryName, year) allocation groups, see IEmissionDataService.mark_dirty.
+# $1: JSON array of categories, $2: JSON array of years, $3: reason
+MARK_CALCULATION_DIRTY = f"""
+    INSERT INTO "IEmissionCalcDirty" ("uid", "categoryName", "year", "reason")
+    SELECT gen_random_uuid()::text, c.value, y.value::int, $3
+    FROM jsonb_array_elements_text($1::jsonb) c
+    CROSS JOIN jsonb_array_elements_text($2::jsonb) y
+    {MARK_CALCULATION_DIRTY_CONFLICT}
+"""
+
+# Same as MARK_CALCULATION_DIRTY for distinct groups, each with its own reason.
+# $1: JSON array of {"categoryName", "year", "reason"} objects
+MARK_CALCULATION_DIRTY_GROUPS = f"""
+    INSERT INTO "IEmissionCalcDirty" ("uid", "categoryName", "year", "reason")
+    SELECT gen_random_uuid()::text, g->>'categoryName', (g->>'year')::int, g->>'reason'
+    FROM jsonb_array_elements($1::jsonb) g
+    {MARK_CALCULATION_DIRTY_CONFLICT}
+"""
+
+# Same as MARK_CALCULATION_DIRTY for every year that has calculated emissions.
+# $1: JSON array of categories, $2: reason
+MARK_CALCULATION_DIRTY_ALL_YEARS = f"""
+    INSERT INTO "IEmissionCalcDirty" ("uid", "categoryName", "year", "reason")
+    SELECT gen_random_uuid()::text, c.value, y."year", $2
+    FROM jsonb_array_elements_text($1::jsonb) c
+    CROSS JOIN (
+        SELECT DISTINCT EXTRACT(YEAR FROM "periodStartDt")::int AS "year"
+        FROM "IEmissionData"
+        WHERE "source" IN ('calc:gir-db4', 'calc:gir-db1')
+    ) y
+    {MARK_CALCULATION_DIRTY_CONFLICT}
+"""
+
+# Relations with the site fields needed to allocate emissions in memory (see AllocationEngine).
+RELATIONS_WITH_SITES = """
+    SELECT
+        r."uid",
+        r."siteUid",
+        r."categoryName",
+        r."categoryLevel",
+        r."contributionMagnitudeSector",
+        s."operationStartDt",
+        s."manufacturingFacilityArea",
+        s."sectorIds",
+        s."addressRegionUid",
+        s."addressSubRegion",
+        s."longitude",
+        s."latitude"
+    FROM "ISiteCategoryRel" r
+    JOIN "IOrgSite" s ON s."uid" = r."siteUid"
+    WHERE r."categoryName" IS NOT NULL
+"""
+
+# GIR totals for every year in [$1, $2] and every pollutant sheet, same selection rules as the calculation.
+GIR_TOTALS_BY_YEAR = f"""
+    SELECT * FROM (
+        SELECT DISTINCT ON (e."categoryName", e."pollutantId", EXTRACT(YEAR FROM e."periodStartDt"))
+            'orig:gir-db4' AS "source",
+            e."categoryName",
+            e."categoryUid",
+            e."pollutantId",
+            EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+            e."periodStartDt",
+            e."periodEndDt",
+            e."periodLength",
+            e."emissionTotal"
+        FROM "IEmissionData" e
+        WHERE e."source" = 'orig:gir-db4'
+            AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+            AND e."periodEndDt" <= make_timestamp($2, 12, 31, 0, 0, 0)
+        ORDER BY e."categoryName", e."pollutantId", EXTRACT(YEAR FROM e."periodStartDt"), e."sid"
+    ) gir4
+    UNION ALL
+    SELECT * FROM (
+        SELECT DISTINCT ON (g."categoryName", g."year")
+            'orig:gir-db1' AS "source",
+            g."categoryName",
+            g."categoryUid",
+            'CO2eq' AS "pollutantId",
+            g."year",
+            make_timestamp(g."year", 1, 1, 0, 0, 0) AS "periodStartDt",
+            make_timestamp(g."year", 12, 31, 0, 0, 0) AS "periodEndDt",
+            '1Y' AS "periodLength",
+            g."emissionTotal"
+        FROM (
+            SELECT e."categoryName", e."categoryUid", EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+                SUM(e."emissionTotal") * {_GIR1_TO_KT} AS "emissionTotal"
+            FROM "IEmissionData" e
+            WHERE e."source" = 'orig:gir-db1'
+                AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+                AND e."periodEndDt" <= make_timestamp($2, 12, 31, 0, 0, 0)
+            GROUP BY e."categoryName", e."pollutantId", e."categoryUid", EXTRACT(YEAR FROM e."periodStartDt")
+        ) g
+        ORDER BY g."categoryName", g."year", g."categoryUid"
+    ) gir1
+"""
+
+# One bounded batch of the purge of derived emissions, see IEmissionDataService.purge_emissions.
+# $1: JSON array of sources, $2/$3: period bounds (ISO timestamps or NULL), $4: categoryName or NULL, $5: batch size.
+# The sources are resolved from the prefix beforehand so that the "source" index is used.
+PURGE_EMISSIONS_BATCH = """
+    DELETE FROM "IEmissionData"
+    WHERE "uid" IN (
+        SELECT "uid"
+        FROM "IEmissionData"
+        WHERE "source" IN (SELECT jsonb_array_elements_text($1::jsonb))
+            AND ($2::timestamp IS NULL OR "periodStartDt" >= $2::timestamp)
+            AND ($3::timestamp IS NULL OR "periodEndDt" <= $3::timestamp)
+            AND ($4::text IS NULL OR "categoryName" = $4::text)
+        LIMIT $5
+    )
+"""
+
+# The distinct sources starting with $1. A prefix match cannot use the index on "source" (LIKE needs a
+# text_pattern_ops index), so the few distinct sources are read first by walking the index one value at a time.
+SOURCES_WITH_PREFIX = """
+    WITH RECURSIVE sources AS (
+        (SELECT "source" FROM "IEmissionData" WHERE "source" IS NOT NULL ORDER BY "source" LIMIT 1)
+        UNION ALL
+        SELECT (SELECT e."source" FROM "IEmissionData" e WHERE e."source" > s."source" ORDER BY e."source" LIMIT 1)
+        FROM sources s
+        WHERE s."source" IS NOT NULL
+    )
+    SELECT "source"
+    FROM sources
+    WHERE starts_with("source", $1)
+"""
+
+# Removes the organization and site rows of the given organization totals before they are rewritten.
+# $1: JSON array of {organizationUid, source, periodStartDt, periodEndDt}.
+DELETE_ORG_EMISSIONS = """
+    DELETE FROM "IEmissionData" e
+    USING jsonb_to_recordset($1::jsonb) AS k(
+        "organizationUid" text, "source" text, "periodStartDt" timestamp, "periodEndDt" timestamp
+    )
+    WHERE e."organizationUid" = k."organizationUid"
+        AND e."source" = k."source"
+        AND e."periodStartDt" = k."periodStartDt"
+        AND e."periodEndDt" = k."periodEndDt"
+"""
+
+# Map rollups of year $1: the calc rows of the active runs per district (their regionUid) and per province (the
+# parent of the district), and the orig:gir-db1 rows per province name, of the categories of the JSON array $2
+# (every category when NULL). Every total is in kt.
+REFRESH_REGION_ROLLUPS = f"""
+    WITH calc AS (
+        SELECT e."source", e."categoryName", e."regionUid", SUM(e."emissionTotal") AS "emissionTotal"
+        FROM "IEmissionData" e
+        WHERE e."source" IN ('calc:gir-db4', 'calc:gir-db1')
+            AND e."regionUid" IS NOT NULL
+            AND e."categoryName" IS NOT NULL
+            AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+            AND e."periodEndDt" <= make_timestamp($1, 12, 31, 0, 0, 0)
+            AND ($2::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($2::jsonb)))
+            AND e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive")
+        GROUP BY e."source", e."categoryName", e."regionUid"
+    )
+    INSERT INTO "IEmissionRegionRollup" (
+        "uid", "year", "source", "categoryName", "regionLevel", "regionUid", "regionName", "latitude", "longitude", "emissionTotal"
+    )
+    SELECT gen_random_uuid()::text, $1, c."source", c."categoryName", 'district', r."uid", r."name", r."latitude", r."longitude", c."emissionTotal"
+    FROM calc c
+    JOIN "Region" r ON r."uid" = c."regionUid"
+    UNION ALL
+    SELECT gen_random_uuid()::text, $1, c."source", c."categoryName", 'province', p."uid", p."name", p."latitude", p."longitude", SUM(c."emissionTotal")
+    FROM calc c
+    JOIN "Region" r ON r."uid" = c."regionUid"
+    JOIN "Region" p ON p."uid" = r."parentUid"
+    GROUP BY c."source", c."categoryName", p."uid", p."name", p."latitude", p."longitude"
+    UNION ALL
+    SELECT
+        gen_random_uuid()::text, $1, 'orig:gir-db1', e."categoryName", 'province', COALESCE(e."regionUid", ''), e."regionName",
+        AVG(e."latitude"), AVG(e."longitude"), SUM(e."emissionTotal") * {_GIR1_TO_KT}
+    FROM "IEmissionData" e
+    WHERE e."source" = 'orig:gir-db1'
+        AND e."regionName" IS NOT NULL
+        AND e."categoryName" IS NOT NULL
+        AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+        AND e."periodEndDt" <= make_timestamp($1, 12, 31, 0, 0, 0)
+        AND ($2::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($2::jsonb)))
+    GROUP BY e."categoryName", COALESCE(e."regionUid", ''), e."regionName"
+"""
+
+def region_totals(region_level: str) -> str:
+    """
+    Emission totals of a calc source ($1) in the years [$2, $3] per region of region_level (district: the regionUid
+    of the rows, province: its parent), for the categories of the JSON array $4 (every category when NULL).
+    Only the rows of active calculation runs are counted.
+    """
+    region_join = 'JOIN "Region" g ON g."uid" = e."regionUid"'
+    if region_level == "province":
+        region_join = 'JOIN "Region" d ON d."uid" = e."regionUid" JOIN "Region" g ON g."uid" = d."parentUid"'
+    return f"""
+        SELECT g."uid" AS "regionUid", g."name" AS "regionName", g."latitude", g."longitude", SUM(e."emissionTotal") AS "emissionTotal"
+        FROM "IEmissionData" e
+        {region_join}
+        WHERE e."source" = $1
+            AND e."periodStartDt" >= make_timestamp($2, 1, 1, 0, 0, 0)
+            AND e."periodEndDt" <= make_timestamp($3, 12, 31, 0, 0, 0)
+            AND ($4::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($4::jsonb)))
+            AND e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive")
+        GROUP BY g."uid", g."name", g."latitude", g."longitude"
+    """
+
+
+# orig:gir-db1 totals (kt) per region name in the years [$1, $2], for the categories of the JSON array $3.
+GIR1_REGION_TOTALS = f"""
+    SELECT
+        MIN(e."regionUid") AS "regionUid",
+        e."regionName",
+        AVG(e."latitude") AS "latitude",
+        AVG(e."longitude") AS "longitude",
+        SUM(e."emissionTotal") * {_GIR1_TO_KT} AS "emissionTotal"
+    FROM "IEmissionData" e
+    WHERE e."source" = 'orig:gir-db1'
+        AND e."regionName" IS NOT NULL
+        AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+        AND e."periodEndDt" <= make_timestamp($2, 12, 31, 0, 0, 0)
+        AND ($3::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($3::jsonb)))
+    GROUP BY e."regionName"
+"""
+
+def emission_time_series(by_region: bool = True, deltas: bool = False) -> str:
+    """
+    Yearly emission totals (kt) of the sources of the JSON array $3 in the years [$1, $2], per source and category
+    (and region), for the categories of the JSON array $4 (every category when NULL), in one aggregation.
+    With deltas, the year-over-year change is computed in the same pass (NULL when the previous year is missing).
+    Only the rows of active calculation runs are counted.
+    """
+    columns = ["source", "categoryName", *(["regionUid", "regionName"] if by_region else [])]
+    row_keys = ", ".join(f'e."{column}"' for column in columns)
+    series_keys = ", ".join(f't."{column}"' for column in columns)
+    delta, window = "", ""
+    if deltas:
+        delta = ', CASE WHEN LAG(t."year") OVER w = t."year" - 1 THEN t."emissionTotal" - LAG(t."emissionTotal") OVER w END AS "delta"'
+        window = f'WINDOW w AS (PARTITION BY {series_keys} ORDER BY t."year")'
+    return f"""
+        SELECT t.*{delta}
+        FROM (
+            SELECT
+                EXTRACT(YEAR FROM date_trunc('year', e."periodStartDt"))::int AS "year",
+                {row_keys},
+                SUM(e."emissionTotal" * ({source_unit_sql('e."source"', "kt")})) AS "emissionTotal"
+            FROM "IEmissionData" e
+            WHERE e."source" IN (SELECT jsonb_array_elements_text($3::jsonb))
+                AND e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+                AND e."periodEndDt" <= make_timestamp($2, 12, 31, 0, 0, 0)
+                AND ($4::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($4::jsonb)))
+                AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+            GROUP BY date_trunc('year', e."periodStartDt"), {row_keys}
+        ) t
+        {window}
+        ORDER BY {series_keys}, t."year"
+    """
+
+
+# Emission totals (kt) of the year $1 per cell of the grid of $2 degrees (row and column indexes of the cell), from
+# the rows with coordinates of the sources of the JSON array $3 and of the categories of the JSON array $4 (every
+# category when NULL), within the bounding box $5 south, $6 west, $7 north, $8 east when given.
+EMISSION_GRID = f"""
+    SELECT
+        floor(e."latitude" / $2::float8)::int AS "row",
+        floor(e."longitude" / $2::float8)::int AS "column",
+        SUM(e."emissionTotal" * ({source_unit_sql('e."source"', "kt")})) AS "emissionTotal",
+        COUNT(*)::int AS "rowCount"
+    FROM "IEmissionData" e
+    WHERE e."source" IN (SELECT jsonb_array_elements_text($3::jsonb))
+        AND e."periodStartDt" >= make_timestamp($1::int, 1, 1, 0, 0, 0)
+        AND e."periodStartDt" < make_timestamp($1::int + 1, 1, 1, 0, 0, 0)
+        AND ($4::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($4::jsonb)))
+        AND e."latitude" IS NOT NULL
+        AND e."longitude" IS NOT NULL
+        AND ($5::float8 IS NULL OR e."latitude" BETWEEN $5::float8 AND $7::float8)
+        AND ($6::float8 IS NULL OR e."longitude" BETWEEN $6::float8 AND $8::float8)
+        AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+    GROUP BY 1, 2
+"""
+
+
+# Served rows of the sources of the JSON array $1 in the years of the JSON array $2 (every source or year when NULL),
+# loaded by the in-process columnar store (see EmissionStore).
+_STORE_SLICE = """
+    FROM "IEmissionData" e
+    WHERE ($1::jsonb IS NULL OR e."source" IN (SELECT jsonb_array_elements_text($1::jsonb)))
+        AND ($2::jsonb IS NULL OR EXTRACT(YEAR FROM e."periodStartDt")::int IN (SELECT jsonb_array_elements_text($2::jsonb)::int))
+        AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+"""
+STORE_ROWS = f"""
+    SELECT
+        e."periodStartDt", e."source", e."categoryName", e."regionUid", e."regionName", e."pollutantId",
+        e."emissionTotal", e."latitude", e."longitude"
+    {_STORE_SLICE}
+"""
+# Number of rows of the same slice, checked against the size of the store before loading it
+STORE_ROW_COUNT = f"""
+    SELECT COUNT(*)::int AS "count"
+    {_STORE_SLICE}
+"""
+STORE_COLUMNS = [
+    "periodStartDt", "source", "categoryName", "regionUid", "regionName", "pollutantId", "emissionTotal", "latitude", "longitude"
+]
+# Version of every served (source, year) slice (pass NULL, NULL): it changes whenever rows of the slice are written
+# (the update paths of IEmissionDataService set dateModified) or deleted, or another calculation run of the year is
+# published, also by other processes. See EmissionStore.expire_versions.
+STORE_VERSIONS = f"""
+    SELECT
+        e."source",
+        EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+        COUNT(*)::int AS "count",
+        MAX(COALESCE(e."dateModified", e."dateCreated"))::text AS "modified",
+        MAX(e."calcRunUid") AS "run"
+    {_STORE_SLICE}
+        AND e."source" IS NOT NULL
+        AND e."periodStartDt" IS NOT NULL
+    GROUP BY 1, 2
+"""
+
+
+# Cube rows of the years [$1, $2] (every year when NULL), of the sources of the JSON array $3 (every source
+# when NULL) and of the categories of the JSON array $4 (every category when NULL), from the rows of the active
+# calculation runs.
+REFRESH_CUBE = """
+    INSERT INTO "IEmissionCube" (
+        "uid", "year", "source", "categoryName", "regionUid", "regionName", "pollutantId", "organizationUid",
+        "emissionTotal", "energyTotal", "rowCount"
+    )
+    SELECT
+        gen_random_uuid()::text,
+        EXTRACT(YEAR FROM e."periodStartDt")::int,
+        e."source",
+        COALESCE(e."categoryName", ''),
+        COALESCE(e."regionUid", ''),
+        COALESCE(e."regionName", ''),
+        COALESCE(e."pollutantId", ''),
+        COALESCE(e."organizationUid", ''),
+        SUM(e."emissionTotal"),
+        SUM(e."energyTotal"),
+        COUNT(*)
+    FROM "IEmissionData" e
+    WHERE e."source" IS NOT NULL
+        AND e."periodStartDt" IS NOT NULL
+        AND ($1::int IS NULL OR e."periodStartDt" >= make_timestamp($1::int, 1, 1, 0, 0, 0))
+        AND ($2::int IS NULL OR e."periodStartDt" < make_timestamp($2::int + 1, 1, 1, 0, 0, 0))
+        AND ($3::jsonb IS NULL OR e."source" IN (SELECT jsonb_array_elements_text($3::jsonb)))
+        AND ($4::jsonb IS NULL OR e."categoryName" IN (SELECT jsonb_array_elements_text($4::jsonb)))
+        AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+    GROUP BY 2, 3, 4, 5, 6, 7, 8
+"""
+
+CUBE_DIMENSIONS = ["year", "source", "categoryName", "regionUid", "regionName", "pollutantId", "organizationUid"]
+CUBE_MEASURES = ["emissionTotal", "energyTotal", "rowCount"]
+
+
+def cube_query(dimensions: list[str], filters: dict | None = None) -> tuple[str, list]:
+    """
+    Compiles a slice of the IEmissionCube: the measures summed per dimensions, for the rows matching the filters.
+    No dimension rolls everything up to a single total.
+
+    Args:
+        dimensions (list[str]): The dimensions to group by, from CUBE_DIMENSIONS.
+        filters (dict, optional): Dimension -> value or list of values.
+
+    Returns:
+        tuple[str, list]: The query and its parameters.
+    """
+    filters = filters or {}
+    unknown = [dimension for dimension in [*dimensions, *filters] if dimension not in CUBE_DIMENSIONS]
+    if unknown:
+        raise ValueError(f"Unknown dimensions {unknown}, expected some of {CUBE_DIMENSIONS}")
+    conditions, args = [], []
+    for dimension, values in filters.items():
+        values = values if isinstance(values, (list, tuple, set)) else [values]
+        args.append(json.dumps([str(value) if value is not None else "" for value in values]))
+        element = f"jsonb_array_elements_text(${len(args)}::jsonb)" + ("::int" if dimension == "year" else "")
+        conditions.append(f'c."{dimension}" IN (SELECT {element})')
+    columns = [
+        f'c."{dimension}"' if dimension == "year" else f'NULLIF(c."{dimension}", \'\') AS "{dimension}"'
+        for dimension in dimensions
+    ]
+    keys = ", ".join(f'c."{dimension}"' for dimension in dimensions)
+    query = f"""
+        SELECT
+            {"".join(column + ", " for column in columns)}
+            SUM(c."emissionTotal") AS "emissionTotal",
+            SUM(c."energyTotal") AS "energyTotal",
+            SUM(c."rowCount")::int AS "rowCount"
+        FROM "IEmissionCube" c
+        {"WHERE " + " AND ".join(conditions) if conditions else ""}
+        {f"GROUP BY {keys} ORDER BY {keys}" if dimensions else ""}
+    """
+    return query, args
+
+
+# Rows of the years [$1, $2] (every year when NULL) and of the sources of the JSON array $3 (every source when
+# NULL) served to the readers, the slice refreshed by REFRESH_SITE_TOTALS and REFRESH_ORG_TOTALS.
+_EMITTER_SLICE = """
+    e."source" IS NOT NULL
+    AND ($1::int IS NULL OR e."periodStartDt" >= make_timestamp($1::int, 1, 1, 0, 0, 0))
+    AND ($2::int IS NULL OR e."periodStartDt" < make_timestamp($2::int + 1, 1, 1, 0, 0, 0))
+    AND ($3::jsonb IS NULL OR e."source" IN (SELECT jsonb_array_elements_text($3::jsonb)))
+    AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+"""
+_EMISSION_KT = f"""e."emissionTotal" * ({source_unit_sql('e."source"', "kt")})"""
+# categoryName of the totals of every category
+ALL_CATEGORIES = "*"
+
+# The region of the totals is the province: addressRegionName, and the parent of the addressRegion (the district)
+REFRESH_SITE_TOTALS = f"""
+    WITH totals AS (
+        SELECT
+            EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+            e."source",
+            COALESCE(e."categoryName", '') AS "categoryName",
+            e."siteUid",
+            SUM({_EMISSION_KT}) AS "emissionTotal"
+        FROM "IEmissionData" e
+        WHERE e."siteUid" IS NOT NULL AND {_EMITTER_SLICE}
+        GROUP BY 1, 2, 3, 4
+    ),
+    all_totals AS (
+        SELECT * FROM totals
+        UNION ALL
+        SELECT "year", "source", '{ALL_CATEGORIES}', "siteUid", SUM("emissionTotal") FROM totals GROUP BY 1, 2, 4
+    )
+    INSERT INTO "IEmissionSiteTotal" (
+        "uid", "year", "source", "categoryName", "siteUid", "organizationUid", "regionUid", "regionName", "emissionTotal"
+    )
+    SELECT
+        gen_random_uuid()::text, t."year", t."source", t."categoryName", t."siteUid",
+        s."organizationUid", d."parentUid", s."addressRegionName", t."emissionTotal"
+    FROM all_totals t
+    JOIN "IOrgSite" s ON s."uid" = t."siteUid"
+    LEFT JOIN "Region" d ON d."uid" = s."addressRegionUid"
+"""
+
+# Organization totals are the totals of their sites' rows, or of their organization rows when they have no sites
+# (organization rows are otherwise distributed to the sites, see create_org_emission).
+REFRESH_ORG_TOTALS = f"""
+    WITH totals AS (
+        SELECT
+            EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+            e."source",
+            COALESCE(e."categoryName", '') AS "categoryName",
+            COALESCE(s."organizationUid", e."organizationUid") AS "organizationUid",
+            SUM({_EMISSION_KT}) AS "emissionTotal"
+        FROM "IEmissionData" e
+        LEFT JOIN "IOrgSite" s ON s."uid" = e."siteUid"
+        WHERE COALESCE(s."organizationUid", e."organizationUid") IS NOT NULL
+            AND (
+                e."siteUid" IS NOT NULL
+                OR NOT EXISTS (SELECT 1 FROM "IOrgSite" os WHERE os."organizationUid" = e."organizationUid")
+            )
+            AND {_EMITTER_SLICE}
+        GROUP BY 1, 2, 3, 4
+    ),
+    all_totals AS (
+        SELECT * FROM totals
+        UNION ALL
+        SELECT "year", "source", '{ALL_CATEGORIES}', "organizationUid", SUM("emissionTotal") FROM totals GROUP BY 1, 2, 4
+    )
+    INSERT INTO "IEmissionOrgTotal" (
+        "uid", "year", "source", "categoryName", "organizationUid", "regionUid", "regionName", "emissionTotal"
+    )
+    SELECT
+        gen_random_uuid()::text, t."year", t."source", t."categoryName", t."organizationUid",
+        d."parentUid", o."addressRegionName", t."emissionTotal"
+    FROM all_totals t
+    JOIN "IOrganization" o ON o."uid" = t."organizationUid"
+    LEFT JOIN "Region" d ON d."uid" = o."addressRegionUid"
+"""
+
+EMITTER_ENTITIES = ["sites", "organizations"]
+
+
+def top_emitters_query(entity: str, by_region: bool = False) -> str:
+    """
+    The largest emitters (sites or organizations) of the year $1, source $2 and categoryName $3 (ALL_CATEGORIES
+    for every category), within the region named $4 when by_region, read from the ranked index of their totals.
+    The number of emitters is the last parameter ($4, or $5 when by_region).
+    """
+    if entity not in EMITTER_ENTITIES:
+        raise ValueError(f"Unknown entity {entity}, expected one of {EMITTER_ENTITIES}")
+    region_condition = 'AND t."regionName" = $4' if by_region else ""
+    limit = "$5" if by_region else "$4"
+    if entity == "sites":
+        columns, join = 't."siteUid" AS "uid", s."companyName" AS "name", t."organizationUid"', 'JOIN "IOrgSite" s ON s."uid" = t."siteUid"'
+        table = "IEmissionSiteTotal"
+    else:
+        columns, join = 't."organizationUid" AS "uid", COALESCE(o."name", o."legalName") AS "name"', 'JOIN "IOrganization" o ON o."uid" = t."organizationUid"'
+        table = "IEmissionOrgTotal"
+    return f"""
+        SELECT
+            (ROW_NUMBER() OVER (ORDER BY t."emissionTotal" DESC))::int AS "rank",
+            {columns},
+            t."regionUid",
+            t."regionName",
+            t."emissionTotal"
+        FROM (
+            SELECT * FROM "{table}" t
+            WHERE t."year" = $1::int AND t."source" = $2 AND t."categoryName" = $3 {region_condition}
+            ORDER BY t."emissionTotal" DESC
+            LIMIT {limit}::int
+        ) t
+        {join}
+        ORDER BY t."emissionTotal" DESC
+    """
+
+
+# Operating sites of year $1 with a sector but no allocation relation (no mapped category or no area),
+# the sites the intensity estimation covers.
+SITES_WITHOUT_ALLOCATIONS = """
+    SELECT
+        s."uid",
+        s."organizationUid",
+        s."sectorIds",
+        s."sectorIdMain",
+        s."numEmployeesTotal",
+        s."manufacturingFacilityArea",
+        s."longitude",
+        s."latitude",
+        s."addressRegionUid",
+        s."addressRegionName"
+    FROM "IOrgSite" s
+    WHERE NOT s."deleteFlag"
+        AND (s."sectorIds" IS NOT NULL OR s."sectorIdMain" IS NOT NULL)
+        AND (s."operationStartDt" IS NULL OR s."operationStartDt" <= make_timestamp($1, 12, 31, 0, 0, 0))
+        AND (s."operationEndDt" IS NULL OR s."operationEndDt" >= make_timestamp($1, 1, 1, 0, 0, 0))
+        AND NOT EXISTS (
+            SELECT 1 FROM "ISiteCategoryRel" r
+            WHERE r."siteUid" = s."uid" AND r."contributionMagnitudeSector" > 0
+        )
+"""
+
+# Rows of source $1 in year $2, e.g. the previous estimates of a year.
+DELETE_SOURCE_EMISSIONS_FOR_YEAR = """
+    DELETE FROM "IEmissionData"
+    WHERE "source" = $1
+        AND "periodStartDt" >= make_timestamp($2, 1, 1, 0, 0, 0)
+        AND "periodStartDt" <= make_timestamp($2, 12, 31, 0, 0, 0)
+"""
+
+
+def co2eq_totals(gwp_set: str | None = None) -> str:
+    """
+    Per (categoryName, year) CO2 equivalents in kt of every pollutant sheet of a source, summed in one pass.
+    Only the rows of active calculation runs are counted. $1: source, $2/$3: first and last year.
+    """
+    return f"""
+        SELECT
+            e."categoryName",
+            EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+            SUM({co2eq_sql("e", "kt", gwp_set)}) AS "emissionTotal",
+            COUNT(DISTINCT e."pollutantId") AS "pollutantCount"
+        FROM "IEmissionData" e
+        WHERE e."source" = $1
+            AND e."periodStartDt" >= make_timestamp($2, 1, 1, 0, 0, 0)
+            AND e."periodEndDt" <= make_timestamp($3, 12, 31, 0, 0, 0)
+            AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+        GROUP BY e."categoryName", EXTRACT(YEAR FROM e."periodStartDt")
+        ORDER BY e."categoryName", "year"
+    """
+
+# Yearly totals per category, the leaves of the category rollup. Only the rows of active calculation runs are counted.
+# $1/$2: first and last year.
+CATEGORY_TOTALS_BY_YEAR = """
+    SELECT
+        e."source",
+        COALESCE(e."pollutantId", '') AS "pollutantId",
+        EXTRACT(YEAR FROM e."periodStartDt")::int AS "year",
+        e."categoryUid",
+        e."categoryName",
+        SUM(e."emissionTotal") AS "emissionTotal"
+    FROM "IEmissionData" e
+    WHERE e."periodStartDt" >= make_timestamp($1, 1, 1, 0, 0, 0)
+        AND e."periodEndDt" <= make_timestamp($2, 12, 31, 0, 0, 0)
+        AND e."periodLength" = '1Y'
+        AND e."categoryName" IS NOT NULL
+        AND e."source" IS NOT NULL
+        AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+    GROUP BY e."source", e."pollutantId", EXTRACT(YEAR FROM e."periodStartDt"), e."categoryUid", e."categoryName"
+"""
@@ -4,13 +4,26 @@ from fastapi import APIRouter, HTTPException, Request, Response, UploadFile
 from fastapi.responses import StreamingResponse
 from pandas import ExcelWriter
 import prisma
-from app.emission_data.service import IEmissionDataService
+from functools import partial
+from app.emission_data.service import (
+    CALCULATION_MODES,
+    DERIVED_SOURCE_PREFIXES,
+    IEmissionDataService,
+    REGION_EXPORT_COLUMNS,
+    calculation_lock_keys,
+    emission_cache,
+    emission_store,
+)
+from app.foundation.jobs import job_runner
+from app.foundation.paging import fetch_page_and_count, page_count_mode
+from app.foundation.single_flight import request_key, single_flight
 from app.foundation.adapter_prisma import PrismaAdapter
 from app.foundation.field_type_match import (
     cast_dict_to_types,
     model_fields_into_type_map,
 )
 from app.utils.data_types import parse_to_date
+from app.utils.export import EXPORT_FORMATS, check_export_format, stream_export
 import pandas as pd
 
 service = IEmissionDataService()
@@ -23,12 +36,43 @@ adapter = PrismaAdapter()
 logger = logging.getLogger(__name__)
 
 
+def year_range(query_params: dict) -> tuple[int, int]:
+    """
+    Returns the first and the last (inclusive) year of the from and to query params. As in the other endpoints
+    "to" is exclusive, e.g. from=2020-01-01&to=2022-01-01 is 2020 and 2021.
+
+    Raises:
+        HTTPException: 400 when from or to is missing or is not a date.
+    """
+    if "from" not in query_params or "to" not in query_params:
+        raise HTTPException(status_code=400, detail="from and to are required")
+    date_from = parse_to_date(query_params["from"])
+    date_to = parse_to_date(query_params["to"])
+    if date_from is None or date_to is None:
+        raise HTTPException(status_code=400, detail="from and to must be dates")
+    return date_from.year, date_to.year - 1
+
+
 @router.get("/iemissiondata-count/")
 async def count():
     return await service.fetch_count()
 
 
-@router.get("/iemissiondata-group/")
+@router.get("/iemissiondata-aggregate/")
+async def aggregate(request: Request):
+    """
+    Aggregates in one query, with a columnar response. Query: _dimensions (fields, or datetime fields bucketed by
+    year, quarter, month, week or day, e.g. periodStartDt:year), _measures (count, or sum, avg, min, max or count
+    of a field, e.g. sum:emissionTotal), _sort (e.g. sum:emissionTotal:desc), _limit and the filters of the list
+    endpoints (e.g. source:in=a,b).
+    """
+    query_params = request.query_params._dict
+    try:
+        return await single_flight.do(request_key(request), partial(service.aggregate, **adapter.to_aggregation_args(query_params)))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/iemissiondata-group/", deprecated=True)
 async def group(count=None, by=None, sum=None, order=None, having=None):
     return await service.group_by(
         count=count, by=by, sum=sum, order=order, having=having
@@ -39,13 +83,18 @@ async def group(count=None, by=None, sum=None, order=None, having=None):
 async def search(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
+    try:
+        fields = adapter.to_fields_args(query_params, prisma.models.IEmissionData.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     include = (
         adapter.to_include_exclude_args(query_params["_include"])
         if "_include" in query_params
         else None
     )
+    include = adapter.include_projected(include, fields)
     response = await service.fetch_many(where=query_args, include=include) ##TODO: Put default take num so that results are limited
-    return response
+    return adapter.project(response, fields)
 
 
 @router.get("/iemissiondata/{uid}/")
@@ -60,34 +109,182 @@ async def fetch_grouped_by_region(request: Request):
     year_end = query_params["_year_to"] if "_year_to" in query_params else None
     if year_start is None or year_end is None:
         raise HTTPException(status_code=400, detail="year_start and year_end are required")
-    response = await service.fetch_grouped_by_region( year_start=year_start, year_end=year_end, category=query_args)
-    return response
+    try:
+        return await single_flight.do(
+            request_key(request),
+            partial(
+                service.fetch_grouped_by_region,
+                year_start=year_start,
+                year_end=year_end,
+                category=query_args,
+                region_level=query_params.get("_regionLevel", "district"),
+                live=query_params.get("_live", "false").lower() == "true",
+            ),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/iemissiondata-timeseries/")
+async def fetch_time_series(request: Request):
+    """
+    Yearly emissions (kt) per source, category and region of the years [from, to) as columnar arrays.
+    Query: from, to, source and categoryName (comma separated), _byRegion (default true), _deltas (default false).
+    """
+    query_params = request.query_params._dict
+    year_from, year_to = year_range(query_params)
+    sources = query_params.get("source")
+    categories = query_params.get("categoryName")
+    return await single_flight.do(
+        request_key(request),
+        partial(
+            service.fetch_time_series,
+            year_from=year_from,
+            year_to=year_to,
+            sources=sources.split(",") if sources else None,
+            categories=categories.split(",") if categories else None,
+            by_region=query_params.get("_byRegion", "true").lower() == "true",
+            deltas=query_params.get("_deltas", "false").lower() == "true",
+        ),
+    )
+
+@router.get("/iemissiondata-grid/")
+async def fetch_emission_grid(request: Request):
+    """
+    Emissions (kt) of a year per grid cell, for heatmaps. Query: year, source and categoryName (comma separated),
+    _resolution (cell size in degrees) or _zoom (map zoom level), _bbox (south,west,north,east).
+    """
+    query_params = request.query_params._dict
+    if "year" not in query_params:
+        raise HTTPException(status_code=400, detail="year is required")
+    sources = query_params.get("source")
+    categories = query_params.get("categoryName")
+    try:
+        return await single_flight.do(
+            request_key(request),
+            partial(
+                service.fetch_emission_grid,
+                year=int(query_params["year"]),
+                sources=sources.split(",") if sources else None,
+                categories=categories.split(",") if categories else None,
+                resolution=float(query_params["_resolution"]) if "_resolution" in query_params else None,
+                zoom=int(query_params["_zoom"]) if "_zoom" in query_params else None,
+                bbox=tuple(float(value) for value in query_params["_bbox"].split(",")) if "_bbox" in query_params else None,
+            ),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/iemissiondata-cube/")
+async def fetch_cube(request: Request):
+    """
+    Slices the emissions cube. Query: _dimensions (comma separated, e.g. year,categoryName), and a comma separated
+    filter per dimension, e.g. source=calc:gir-db4&year=2020,2021.
+    """
+    query_params = request.query_params._dict
+    dimensions = [dimension for dimension in query_params.get("_dimensions", "").split(",") if dimension]
+    filters = {key: value.split(",") for key, value in query_params.items() if not key.startswith("_")}
+    try:
+        return await single_flight.do(request_key(request), partial(service.fetch_cube, dimensions, filters))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.put("/iemissiondata-cube/")
+async def refresh_cube(request: Request):
+    """
+    Rebuilds the emissions cube and the emitter totals of the years [from, to), of every year without them, as a
+    background job.
+    """
+    query_params = request.query_params._dict
+    year_from, year_to = year_range(query_params) if "from" in query_params or "to" in query_params else (None, None)
+    job = job_runner.submit(
+        f"refresh_cube {year_from}-{year_to}",
+        # refresh_summaries holds SUMMARY_LOCK_KEY
+        lambda job: service.refresh_summaries(year_from, year_to),
+    )
+    return job.to_dict()
+
+@router.get("/iemissiondata-top/{entity}/")
+async def fetch_top_emitters(entity: str, request: Request):
+    """
+    Fetches the largest emitting sites or organizations of a year, ranked.
+    Query: year, source, categoryName and regionName (province) filters, _limit (default 50).
+    """
+    query_params = request.query_params._dict
+    try:
+        return await single_flight.do(
+            request_key(request),
+            partial(
+                service.fetch_top_emitters,
+                entity,
+                int(query_params["year"]),
+                source=query_params.get("source", "calc:gir-db4"),
+                category_name=query_params.get("categoryName"),
+                region_name=query_params.get("regionName"),
+                limit=int(query_params.get("_limit", 50)),
+            ),
+        )
+    except KeyError:
+        raise HTTPException(status_code=400, detail="year is required")
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.put("/iemissiondata-mapdata/")
+async def refresh_region_rollups(request: Request):
+    """
+    Rebuilds the map rollups of the years [from, to) as a background job. They are otherwise refreshed
+    when a calculation run is published.
+    """
+    year_from, year_to = year_range(request.query_params._dict)
+    years = list(range(year_from, year_to + 1))
+    if not years:
+        raise HTTPException(status_code=400, detail="to must be after from")
+
+    async def refresh(job):
+        job.set_total(len(years))
+        for year in years:
+            await service.refresh_region_rollups(year)
+            job.advance()
+
+    job = job_runner.submit(
+        f"refresh_region_rollups {years[0]}-{years[-1]}",
+        refresh,
+        lock_keys=calculation_lock_keys(years[0], years[-1] + 1),
+        unit="years",
+    )
+    return job.to_dict()
 
 @router.get("/iemissiondata.paged/")
 async def get_paged(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    page_size = int(query_params["_pageSize"])
-    page_num = int(query_params["_pageNum"])
-    _sort = query_params.get("_sort", None)
-    sort = adapter.to_sort_object(_sort)
+    try:
+        page_args = adapter.to_page_args(query_params, prisma.models.IEmissionData.model_fields)
+        page_count_mode(query_params)
+        fields = adapter.to_fields_args(query_params, prisma.models.IEmissionData.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     include = (
         adapter.to_include_exclude_args(query_params["_include"])
         if "_include" in query_params
         else None
     )
-    content = await service.fetch_paged(
-        where=query_args,
-        take=page_size,
-        skip=page_size * page_num,
-        order=sort,
-        include=include,
-    )  ##TODO: Group these to a single query
-    if content is None:
-        content = []
-    count = await service.fetch_count(where=query_args)
+    include = adapter.include_projected(include, fields)
+    content, count, approximate = await fetch_page_and_count(
+        query_params,
+        page_args,
+        query_args,
+        fetch_content=partial(service.fetch_paged, **page_args, include=include),
+        fetch_count=partial(service.fetch_count, where=query_args),
+        client=service.prisma,
+        table="IEmissionData",
+    )
     response = adapter.to_pageable_response(
-        query=query_params, response=content, count=count
+        query=query_params,
+        response=content,
+        count=count,
+        order=page_args["order"],
+        approximate=approximate,
+        fields=fields,
     )
     return response
 
@@ -134,52 +331,248 @@ async def date_boundaries(request: Request):
     return await service.get_date_boundaries(source=source)
 
 
+@router.get("/iemissiondata-co2eq/")
+async def co2eq_totals(request: Request):
+    """
+    CO2 equivalents (kt) per category and year of the years [from, to). Query: from, to, source (default
+    orig:gir-db4), _gwp.
+    """
+    query_params = request.query_params._dict
+    source = query_params.get("source", "orig:gir-db4")
+    year_from, year_to = year_range(query_params)
+    try:
+        return await service.fetch_co2eq_totals(
+            source=source,
+            year_from=year_from,
+            year_to=year_to,
+            gwp_set=query_params.get("_gwp"),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/iemissiondata-category-rollups/")
+async def category_rollups(
+    year: int | None = None, code: str | None = None, source: str | None = None, pollutantId: str | None = None, depth: int | None = None
+):
+    return await service.fetch_category_rollups(year=year, code=code, source=source, pollutant_id=pollutantId, depth=depth)
+
+@router.put("/iemissiondata-category-rollups/")
+async def refresh_category_rollups(request: Request):
+    year_from, year_to = year_range(request.query_params._dict)
+    job = job_runner.submit(
+        f"refresh_category_rollups {year_from}-{year_to}",
+        # refresh_category_rollups holds CATEGORY_ROLLUP_LOCK_KEY
+        lambda job: service.refresh_category_rollups(year_from=year_from, year_to=year_to),
+    )
+    return job.to_dict()
+
+
 @router.get("/iemissiondata-calculate/")
 async def calculate(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
     from_date = parse_to_date(query_args["from"]).year
     to_date = parse_to_date(query_args["to"]).year
-    for year in range(from_date, to_date):
-        await service.calculate_emissions(year=year)
+    mode = query_params.get("_mode", "set")
+    if mode not in CALCULATION_MODES:
+        raise HTTPException(status_code=400, detail=f"_mode must be one of {CALCULATION_MODES}")
+    job = job_runner.submit(
+        f"calculate_emissions {from_date}-{to_date} ({mode})",
+        partial(service.calculate_emissions_range, from_date, to_date, mode),
+        lock_keys=calculation_lock_keys(from_date, to_date),
+        unit="relations",
+    )
+    return job.to_dict()
+
+@router.delete("/iemissiondata-purge/")
+async def purge(request: Request):
+    """
+    Deletes derived emissions in batches as a background job, after the calculations and estimations of its years.
+    Query: source (prefix, e.g. calc:gir-db4), from and to (required), categoryName, _batchSize.
+    """
+    query_params = request.query_params._dict
+    source = query_params.get("source")
+    if not source:
+        raise HTTPException(status_code=400, detail="source is required")
+    date_from = parse_to_date(query_params.get("from"))
+    date_to = parse_to_date(query_params.get("to"))
+    # The purge locks the calculations and estimations of its years, an open-ended one could not lock them
+    if date_from is None or date_to is None:
+        raise HTTPException(status_code=400, detail="from and to are required dates")
+    if date_to < date_from:
+        raise HTTPException(status_code=400, detail="to must be after from")
+    try:
+        batch_size = int(query_params.get("_batchSize", 5000))
+    except ValueError:
+        raise HTTPException(status_code=400, detail="_batchSize must be an integer")
+    if batch_size <= 0:
+        raise HTTPException(status_code=400, detail="_batchSize must be positive")
+    if not any(source.startswith(prefix) for prefix in DERIVED_SOURCE_PREFIXES):
+        raise HTTPException(status_code=400, detail=f"source must start with one of {DERIVED_SOURCE_PREFIXES}")
+    years = range(date_from.year, date_to.year + 1)
+    lock_keys = ["purge", *calculation_lock_keys(years[0], years[-1] + 1), *[f"estimate:{year}" for year in years]]
+    job = job_runner.submit(
+        f"purge_emissions {source}",
+        partial(
+            service.purge_emissions,
+            source,
+            date_from,
+            date_to,
+            query_params.get("categoryName"),
+            batch_size,
+        ),
+        lock_keys=lock_keys,
+        unit="rows",
+    )
+    return job.to_dict()
+
+@router.put("/iemissiondata-estimate/")
+async def estimate_by_intensity(request: Request):
+    """
+    Estimates the emissions of the sites without allocation from the intensity table (source est:intensity),
+    as a background job. Query: from, to.
+    """
+    year_from, year_last = year_range(request.query_params._dict)
+    year_to = year_last + 1
+    job = job_runner.submit(
+        f"estimate_emissions_by_intensity {year_from}-{year_to}",
+        lambda job: service.estimate_emissions_by_intensity(year_from=year_from, year_to=year_to, job=job),
+        lock_keys=[f"estimate:{year}" for year in range(year_from, year_to)],
+        unit="years",
+    )
+    return job.to_dict()
+
+@router.post("/iemissiondata-whatif/")
+async def allocate_what_if(request: Request):
+    """
+    Re-allocates the GIR totals in memory with changed site proxies, without writing to the database.
+    Body: {"from": "2019-01-01", "to": "2021-01-01", "overrides": {siteUid: {"manufacturingFacilityArea": 100}},
+    "pollutants": ["CO2"], "reload": false}. As in /iemissiondata-calculate/, "to" is exclusive.
+    Overriding a site without relations is a 400.
+    """
+    body = await request.json()
+    if "from" not in body or "to" not in body:
+        raise HTTPException(status_code=400, detail="from and to are required")
+    from_date = parse_to_date(body["from"])
+    to_date = parse_to_date(body["to"])
+    if from_date is None or to_date is None:
+        raise HTTPException(status_code=400, detail="from and to must be dates")
+    try:
+        result = await service.allocate_what_if(
+            year_from=from_date.year,
+            year_to=to_date.year - 1,
+            overrides=body.get("overrides"),
+            pollutants=body.get("pollutants"),
+            reload=bool(body.get("reload", False)),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    # Sites without coordinates or region have NaN, which JSON cannot encode
+    return result.astype(object).where(result.notna(), None).to_dict("records")
+
+@router.get("/iemissiondata-cache/")
+async def cache_stats():
+    return {**emission_cache.stats(), "store": emission_store.stats()}
+
+@router.delete("/iemissiondata-cache/")
+async def clear_cache():
+    return {"cleared": service.invalidate_cached()}
+
+@router.get("/iemissiondata-calcruns/")
+async def get_calc_runs(year: int | None = None):
+    return await service.fetch_calc_runs(year=year)
+
+@router.put("/iemissiondata-calcruns/{uid}/publish/")
+async def publish_calc_run(uid: str):
+    """Publishes the run as a background job, under the calculation lock keys of its year."""
+    run = await service.fetch_calc_run(uid)
+    if run is None:
+        raise HTTPException(status_code=404, detail=f"Run {uid} not found")
+    if run.status == "failed":
+        raise HTTPException(status_code=400, detail=f"Run {uid} failed and cannot be published")
+    job = job_runner.submit(
+        f"publish_calc_run {uid}",
+        lambda job: service.publish_calc_run(uid),
+        lock_keys=calculation_lock_keys(run.year, run.year + 1),
+    )
+    return job.to_dict()
+
+@router.put("/iemissiondata-calcruns-rollback/{year}/")
+async def rollback_calc_run(year: int):
+    """Re-publishes the previous run of the year as a background job, under the calculation lock keys of the year."""
+
+    async def rollback(job):
+        run = await service.rollback_calc_run(year)
+        if run is None:
+            raise ValueError(f"No previous run for {year}")
+        return run
+
+    job = job_runner.submit(f"rollback_calc_run {year}", rollback, lock_keys=calculation_lock_keys(year, year + 1))
+    return job.to_dict()
+
+@router.get("/iemissiondata-calcruns-diff/")
+async def diff_calc_runs(base: str, compared: str):
+    return await service.diff_calc_runs(base_uid=base, compared_uid=compared)
 
 @router.get("/iemissiondata-sources/")
 async def get_sources():
-    sources = await service.fetch_many(distinct=["source"])
-    _sources = []
-    for source in sources:
-        _sources.append(source.source)
-    return _sources
+    return await service.fetch_distinct("source")
 
 @router.post("/iemissiondata-org/")
 async def create_org_emission(request: Request):
+    """
+    Writes an organization total and distributes it to the sites. The cube and the emitter totals of its source
+    and year are refreshed by a background job shortly after.
+    """
     body = await request.json()
     return await service.create_org_emission(data=body)
 
+@router.post("/iemissiondata-org-bulk/")
+async def create_org_emissions_bulk(request: Request):
+    """Body: a list of /iemissiondata-org/ bodies, distributed to the sites in one pass."""
+    body = await request.json()
+    if not isinstance(body, list):
+        raise HTTPException(status_code=400, detail="A list of organization emissions is expected")
+    for item in body:
+        if "uid" not in item or "periodStartDt" not in item or "source" not in item:
+            raise HTTPException(status_code=400, detail="uid, periodStartDt and source are required")
+        if isinstance(item["periodStartDt"], int) or str(item["periodStartDt"]).isdigit():
+            item["periodStartDt"] = f"{item['periodStartDt']}-01-01"
+    return await service.create_org_emissions_bulk(body)
+
 @router.get("/iemissiondata-categories/")
-async def get_categories():
-    categories = await service.fetch_many(distinct=["categoryName"])
-    _categories = []
-    for category in categories:
-        _categories.append(category.categoryName)
-    return _categories
+async def get_categories(request: Request):
+    return await single_flight.do(request_key(request), partial(service.fetch_distinct, "categoryName"))
 
 @router.get("/iemissiondata-regions/")
-async def get_regions():
-    regions = await service.fetch_many(distinct=["regionName"])
-    _regions = []
-    for region in regions:
-        if region.regionName is not None and region.regionName != "":
-            _regions.append(region.regionName)
-    return _regions
-
-@router.get("/iemissiondata-asgroup-export/", response_class=Response)
+async def get_regions(request: Request):
+    regions = await single_flight.do(request_key(request), partial(service.fetch_distinct, "regionName"))
+    return [region for region in regions if region is not None and region != ""]
+
+@router.get("/iemissiondata-asgroup-export/")
 async def export_as_group(request: Request):
+    """
+    Streams the map data per region as csv (default), xlsx or parquet, chosen by _format.
+    """
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
     year_start = query_params["_year_from"] if "_year_from" in query_params else None
     year_end = query_params["_year_to"] if "_year_to" in query_params else None
     if year_start is None or year_end is None:
         raise HTTPException(status_code=400, detail="year_start and year_end are required")
-    _response = await service.export_region_groupped( year_start=year_start, year_end=year_end, category=query_args)
-    return Response(content=_response, media_type="application/vnd.ms-excel", headers={"Content-Disposition": "attachment; filename=asgroup.csv"})
+    export_format = query_params.get("_format", "csv")
+    try:
+        check_export_format(export_format)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    rows = await single_flight.do(
+        request_key(request),
+        partial(service.export_region_groupped, year_start=year_start, year_end=year_end, category=query_args),
+    )
+    media_type, extension = EXPORT_FORMATS[export_format]
+    return StreamingResponse(
+        stream_export(rows, REGION_EXPORT_COLUMNS, export_format),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=asgroup.{extension}"},
+    )
@@ -1,4 +1,5 @@
-from io import BytesIO
+import asyncio
+import json
 from typing import Dict
 from typing import Optional
 import logging
@@ -7,17 +8,155 @@ import pandas as pd
 import prisma
 from sklearn.preprocessing import MinMaxScaler
 from tqdm import tqdm
-from app.config.column_mapping import ipcc_to_gir, ipcc_to_gir_code
+from app.config.column_mapping import ipcc_to_gir, ipcc_to_gir_code, source_units
 from app.database import get_connection
 from app.emission_data.adapters.gir4_import_adapter import GirCategoryAdapter
 from app.utils.file import FileUtils
-from app.utils.object import list_of_objects_to_dict
-from app.utils.data_types import to_dict
+from app.utils.object import list_of_objects_to_dict, records_to_columns
+from app.utils.data_types import parse_to_date, to_dict
+from app.utils.units import convert_units, unit_factor
 from app.isitecategoryrels.service import ISiteCategoryRelService
-from app.utils.string import get_second_level_category
+from app.code.tree import CodeTree, rollup_category_totals
 from app.emission_data.models.partial_emission_data import create_partial_gir1
+from app.emission_data.queries import (
+    ADOPT_UNVERSIONED_EMISSIONS,
+    ALLOCATE_GIR1_EMISSIONS,
+    ALLOCATE_GIR1_EMISSIONS_FOR_CATEGORIES,
+    ALLOCATE_GIR4_EMISSIONS,
+    ALLOCATE_GIR4_EMISSIONS_FOR_CATEGORIES,
+    ALL_CATEGORIES,
+    CATEGORY_TOTALS_BY_YEAR,
+    COPY_CALC_RUN_EXCEPT_CATEGORIES,
+    CUBE_MEASURES,
+    DELETE_ORG_EMISSIONS,
+    DELETE_SOURCE_EMISSIONS_FOR_YEAR,
+    DIFF_CALC_RUNS,
+    EMISSION_GRID,
+    GIR1_REGION_TOTALS,
+    MARK_CALCULATION_DIRTY,
+    MARK_CALCULATION_DIRTY_ALL_YEARS,
+    MARK_CALCULATION_DIRTY_GROUPS,
+    PUBLISH_CALC_RUN,
+    PURGE_EMISSIONS_BATCH,
+    REFRESH_CUBE,
+    REFRESH_ORG_TOTALS,
+    REFRESH_REGION_ROLLUPS,
+    REFRESH_SITE_TOTALS,
+    SITES_WITHOUT_ALLOCATIONS,
+    SOURCES_WITH_PREFIX,
+    STORE_COLUMNS,
+    STORE_ROW_COUNT,
+    STORE_ROWS,
+    STORE_VERSIONS,
+    co2eq_totals,
+    cube_query,
+    emission_time_series,
+    region_totals,
+    top_emitters_query,
+)
+from app.emission_data.allocation import GIR1_SOURCE, GIR4_SOURCE, AllocationEngine
+from app.emission_data.distribution import (
+    DISTRIBUTED_FIELDS,
+    ORG_EMISSION_POLLUTANT,
+    distribute_org_emissions,
+    normalize_org_totals,
+)
+from app.emission_data.grid import bin_grid, grid_resolution
+from app.emission_data.store import EmissionStore
+from app.emission_data.intensity import INTENSITY_SOURCE, estimate_site_emissions
+from app.foundation.cache import ResponseCache
+from app.foundation.jobs import Job, job_runner
+from app.config.env_config import (
+    CALC_RUN_RETENTION,
+    EMISSION_STORE_ENABLED,
+    EMISSION_STORE_MAX_ROWS,
+    LONG_TX_TIMEOUT_SECONDS,
+    RESPONSE_CACHE_SIZE,
+    RESPONSE_CACHE_TTL,
+)
 from dateutil.relativedelta import relativedelta
-from datetime import datetime
+from datetime import datetime, timedelta
+import time
+from app.foundation.aggregation import AggregationQuery
+from app.foundation.field_type_match import model_fields_into_type_map
+
+# Levels of the map rollups (IEmissionRegionRollup): the site district and its parent province.
+REGION_LEVELS = ["district", "province"]
+
+
+def years_within(date_from: datetime, date_to: datetime) -> list[int]:
+    """
+    Returns the years whose whole period lies in [date_from, date_to], e.g. 2019-01-01..2020-01-01 -> [2019],
+    the periods matched by periodStartDt >= date_from and periodEndDt <= date_to.
+    """
+    date_from, date_to = date_from.replace(tzinfo=None), date_to.replace(tzinfo=None)
+    return [
+        year for year in range(date_from.year, date_to.year + 1)
+        if datetime(year, 1, 1) >= date_from and datetime(year, 12, 31) <= date_to
+    ]
+
+
+def category_names(category: dict) -> list[str] | None:
+    """
+    Returns the categoryName values of a prisma where clause, e.g. {"categoryName": {"in": ["2.A"]}} -> ["2.A"],
+    None when it has no categoryName filter.
+    """
+    value = category.get("categoryName")
+    if value is None:
+        return None
+    if isinstance(value, str):
+        return [value]
+    if isinstance(value, dict) and "in" in value:
+        return list(value["in"])
+    if isinstance(value, dict) and "equals" in value:
+        return [value["equals"]]
+    raise ValueError(f"Unsupported categoryName filter {value}, expected a name, equals or in")
+
+
+def region_map_response(gir_4_calc: pd.DataFrame, gir_1_calc: pd.DataFrame, gir_1: pd.DataFrame) -> dict:
+    """
+    Builds the /iemissiondata-mapdata/ response from the per region totals of calc:gir-db4, calc:gir-db1 and
+    orig:gir-db1 (regionUid, regionName, latitude, longitude, emissionTotal). The totals are normalized with the
+    scale of orig:gir-db1.
+    """
+    if gir_4_calc.empty or gir_1_calc.empty or gir_1.empty:
+        return {}
+    aggregations = {"emissionTotal": "sum", "latitude": "mean", "longitude": "mean", "regionName": "first"}
+    gir_4_calc_groupped = gir_4_calc.groupby("regionUid", as_index=False).agg(aggregations)
+    gir_1_calc_groupped = gir_1_calc.groupby("regionUid", as_index=False).agg(aggregations)
+    gir_1_groupped = gir_1.groupby("regionName", as_index=False).agg(
+        {"emissionTotal": "sum", "latitude": "mean", "longitude": "mean"}
+    )
+    scaler = MinMaxScaler(feature_range=(0, 1))
+
+    gir_1_groupped["norm"] = scaler.fit_transform(gir_1_groupped[["emissionTotal"]])
+    gir_4_calc_groupped["norm"] = scaler.transform(gir_4_calc_groupped[["emissionTotal"]])
+    gir_1_calc_groupped["norm"] = scaler.transform(gir_1_calc_groupped[["emissionTotal"]])
+    return {
+        "gir4Calc": gir_4_calc_groupped.to_dict("records"),
+        "gir1Calc": gir_1_calc_groupped.to_dict("records"),
+        "gir1": gir_1_groupped.to_dict("records"),
+    }
+
+
+def published_only(where: dict | None) -> dict:
+    """
+    Restricts an IEmissionData where clause to the rows served to readers: rows without a calculation run
+    (imported data) and rows of the active run of their year.
+    """
+    where = dict(where or {})
+    unpublished = {"calcRun": {"is": {"isActive": False}}}
+    if "NOT" not in where:
+        where["NOT"] = unpublished
+    else:
+        where["NOT"] = (where["NOT"] if isinstance(where["NOT"], list) else [where["NOT"]]) + [unpublished]
+    return where
+
+
+def calculation_lock_keys(year_from: int, year_to: int) -> list[str]:
+    """The JobRunner lock keys of a calculation of [year_from, year_to), one per (year, source)."""
+    return [f"calculate:{year}:{source}" for year in range(year_from, year_to) for source in CALCULATION_SOURCES]
+
 
 class Emission:
     emissionYear: int
@@ -32,12 +171,73 @@ class Emission:
     uid: str
 
 
+CALCULATION_MODES = ["set", "reference", "incremental"]
+
+# Rows written by calculate_emissions, one lock per (year, source) is taken by calculation jobs.
+CALCULATION_SOURCES = ["calc:gir-db4", "calc:gir-db1"]
+
+# Source prefixes of the rows derived from other data, the only ones purge_emissions deletes.
+DERIVED_SOURCE_PREFIXES = ["calc:", "est:"]
+
+# Imported emissions that are allocated by calculate_emissions. Writing them makes the calculation dirty.
+GIR_SOURCE_PREFIX = "orig:gir-"
+
+# Tag of the cached AllocationEngine of allocate_what_if, dropped with the relations by mark_dirty.
+ALLOCATION_ENGINE_TAG = "allocation:relations"
+
+# Sources read by the map data (fetch_grouped_by_region), the tags of its cache entries.
+MAP_SOURCES = ["calc:gir-db4", "calc:gir-db1", "orig:gir-db1"]
+
+# Columns of export_region_groupped, the emissions are in kt.
+REGION_EXPORT_COLUMNS = ["region name", "gir1Calc", "gir4Calc", "gir1"]
+
+# Transactions of the whole-slice rebuilds, see IEmissionDataService.long_tx.
+LONG_TX_MAX_WAIT = timedelta(seconds=10)
+LONG_TX_TIMEOUT = timedelta(seconds=LONG_TX_TIMEOUT_SECONDS)
+
+# JobRunner key held by every rebuild of the summaries (cube and emitter totals), see refresh_summaries.
+SUMMARY_LOCK_KEY = "summaries"
+
+# JobRunner key held by every rebuild of the category rollups, see refresh_category_rollups.
+CATEGORY_ROLLUP_LOCK_KEY = "category-rollups"
+
+# Largest number of emitters returned by fetch_top_emitters.
+MAX_TOP_EMITTERS = 1000
+
+# Shared by every service instance, so writes made through any of them invalidate the cached responses.
+emission_cache = ResponseCache(max_size=RESPONSE_CACHE_SIZE, ttl=RESPONSE_CACHE_TTL)
+# {source: years} whose summaries are refreshed by the next summary job, see schedule_summary_refresh
+pending_summaries: Dict[str, set[int]] = {}
+# The last submitted summary job, which takes pending_summaries when it starts
+summary_refresh_job: Job | None = None
+# Optional (EMISSION_STORE_ENABLED) in-process copy of the served rows for the map, sources, categories and regions
+emission_store = EmissionStore(enabled=EMISSION_STORE_ENABLED, max_rows=EMISSION_STORE_MAX_ROWS)
+
+
+def cache_tags(sources: list[str], years: list[int]) -> list[str]:
+    """The tags of a cached response read from the sources in the years, e.g. calc:gir-db4 and calc:gir-db4:2020."""
+    return [*sources, *[f"{source}:{year}" for source in sources for year in years]]
+
+
+# Typed aggregations of the emission data of the active calculation runs, see aggregate
+EMISSION_AGGREGATION = AggregationQuery(
+    "IEmissionData", model_fields_into_type_map(prisma.models.IEmissionData.model_fields),
+    condition='(t."calcRunUid" IS NULL OR t."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))',
+)
+
+
 class IEmissionDataService:
     def __init__(self) -> None:
         self.prisma = get_connection()
         self.rel_service = ISiteCategoryRelService()
         self.logger = logging.getLogger(__name__)
 
+    def long_tx(self):
+        """
+        A transaction for the whole-slice rebuilds (cube, emitter totals, rollups, bulk writes), which outlast the
+        5 s default timeout of prisma on real table sizes. See LONG_TX_TIMEOUT.
+        """
+        return self.prisma.tx(max_wait=LONG_TX_MAX_WAIT, timeout=LONG_TX_TIMEOUT)
 
     async def update_or_create(
         self,
@@ -58,10 +258,14 @@ class IEmissionDataService:
 
         if existing_record:
             await self.prisma.iemissiondata.update(
-                where={"uid": existing_record.uid}, data=data
+                where={"uid": existing_record.uid}, data={**data, "dateModified": datetime.now()}
             )
         else:
             await self.prisma.iemissiondata.create(data=data)
+        # The previous row tells the group the update moved the emissions out of, and its source when data omits it
+        rows = [data, {**to_dict(existing_record), **data}] if existing_record else [data]
+        await self.mark_gir_rows_dirty(rows)
+        self.invalidate_cached_rows(rows)
 
     async def upsert(
         self,
@@ -81,8 +285,10 @@ class IEmissionDataService:
             None
         """
         await self.prisma.iemissiondata.upsert(
-            data={"create": data, "update": data}, where=where
+            data={"create": data, "update": {**data, "dateModified": datetime.now()}}, where=where
         )
+        await self.mark_gir_rows_dirty([data])
+        self.invalidate_cached_rows([data])
 
     async def create(
         self, data: prisma.types.IEmissionDataCreateInput
@@ -96,7 +302,10 @@ class IEmissionDataService:
         Returns:
             None
         """
-        return await self.prisma.iemissiondata.create(data=data)
+        created = await self.prisma.iemissiondata.create(data=data)
+        await self.mark_gir_rows_dirty([data])
+        self.invalidate_cached_rows([data])
+        return created
 
     async def update(
         self,
@@ -113,7 +322,12 @@ class IEmissionDataService:
         Returns:
             None
         """
-        return await self.prisma.iemissiondata.update(where=where, data=data)
+        previous = await self.prisma.iemissiondata.find_unique(where=where)
+        updated = await self.prisma.iemissiondata.update(where=where, data={**data, "dateModified": datetime.now()})
+        rows = [to_dict(row) for row in (previous, updated) if row is not None] or [data]
+        await self.mark_gir_rows_dirty(rows)
+        self.invalidate_cached_rows(rows)
+        return updated
 
     async def delete(self, where: prisma.types.IEmissionDataWhereInput) -> None:
         """
@@ -125,7 +339,11 @@ class IEmissionDataService:
         Returns:
             None
         """
-        await self.prisma.iemissiondata.delete(where=where)
+        deleted = await self.prisma.iemissiondata.delete(where=where)
+        if deleted is None:
+            return
+        await self.mark_gir_rows_dirty([to_dict(deleted)])
+        self.invalidate_cached_rows([to_dict(deleted)])
 
     async def fetch_many(
         self,
@@ -143,7 +361,7 @@ class IEmissionDataService:
             A list of IEmissionData objects that match the given conditions.
         """
         return await self.prisma.iemissiondata.find_many(
-            where=where, include=include, distinct=distinct
+            where=published_only(where), include=include, distinct=distinct
         )
 
     async def fetch_one(
@@ -160,17 +378,23 @@ class IEmissionDataService:
         """
         return await self.prisma.iemissiondata.find_first(where=where)
 
-    async def create_many(self, data: prisma.types.IEmissionDataCreateInput) -> None:
+    async def create_many(self, data: prisma.types.IEmissionDataCreateInput, batch_size: int = 1000) -> None:
         """
-        Create multiple organizations.
+        Create multiple organizations, batch_size rows per create_many call in one transaction. Their allocation
+        groups are marked dirty and their cached responses dropped once for all the rows.
 
         Args:
             data (prisma.types.IEmissionDataCreateInput): The data to create multiple organizations.
+            batch_size (int, optional): The number of rows per create_many call. Defaults to 1000.
 
         Returns:
             None: This function does not return anything.
         """
-        await self.prisma.iemissiondata.create_many(data=data)
+        async with self.long_tx() as transaction:
+            for start in range(0, len(data), batch_size):
+                await transaction.iemissiondata.create_many(data=data[start:start + batch_size])
+        await self.mark_gir_rows_dirty(data)
+        self.invalidate_cached_rows(data)
 
     async def group_by(
         self,
@@ -195,29 +419,41 @@ class IEmissionDataService:
             list[prisma.models.IEmissionData]: A list of `prisma.models.IEmissionData` objects.
         """
         return await self.prisma.iemissiondata.group_by(
-            count=count, by=by, sum=sum, order=order, having=having, where=where
+            count=count, by=by, sum=sum, order=order, having=having, where=published_only(where)
+        )
+
+    async def aggregate(self, dimensions=(), measures=(), filters=None, order=(), limit=None) -> dict:
+        """
+        Aggregates the emission data in one query, see AggregationQuery.compile. Replaces group_by, which cannot
+        bucket dates and takes untyped args.
+
+        Returns:
+            dict: One list per dimension and measure.
+        """
+        return await EMISSION_AGGREGATION.fetch(
+            self.prisma, dimensions=dimensions, measures=measures, filters=filters, order=order, limit=limit
         )
 
     async def _fetch_page(
-        self, cursor: str, page_size=10
-    ) -> tuple[list[prisma.models.IEmissionData], str]:
+        self, cursor: int | None, page_size=10
+    ) -> tuple[list[prisma.models.IEmissionData], int]:
         """
         Fetches a page of organizations from the database.
 
         Args:
-            cursor (str): The cursor used for pagination.
+            cursor (int): The sid of the last row of the previous page, None for the first page.
             page_size (int, optional): The number of results per page. Defaults to 10.
 
         Returns:
-            Tuple[List[prisma.models.IEmissionData], str]: A tuple containing a list of organizations
+            Tuple[List[prisma.models.IEmissionData], int]: A tuple containing a list of organizations
                 and the next cursor for pagination.
         """
         results = await self.prisma.iemissiondata.find_many(
             take=page_size,
-            cursor={"id": cursor} if cursor else None,
-            order={"id": "asc"},
+            where={"sid": {"gt": cursor}} if cursor is not None else None,
+            order={"sid": "asc"},
         )
-        next_cursor = results[-1].id if results else None
+        next_cursor = results[-1].sid if results else None
         return results, next_cursor
 
     async def fetch_paged(
@@ -240,7 +476,7 @@ class IEmissionDataService:
             list[prisma.models.IEmissionData]: The list of organizations.
         """
         results = await self.prisma.iemissiondata.find_many(
-            take=take, skip=skip, order=order, where=where, include=include
+            take=take, skip=skip, order=order, where=published_only(where), include=include
         )
         return results
 
@@ -254,7 +490,7 @@ class IEmissionDataService:
         Returns:
             int: The count of the IEmissionData table.
         """
-        return await self.prisma.iemissiondata.count(where=where)
+        return await self.prisma.iemissiondata.count(where=published_only(where))
 
     # Business logic
 
@@ -265,8 +501,8 @@ class IEmissionDataService:
         files = FileUtils()
         if "orig:gir-db4" in data_source.lower():
             df = await gir4_adp.prepare(data_source, buffer, data_source)
-        for row in tqdm(df.to_dict(orient="records"), total=len(df)):
-            await self.create(data=row)
+        await self.create_many(data=[self._to_create_input(row) for row in df.to_dict(orient="records")])
+        await self.refresh_summaries_for_rows(df)
 
     async def match_codes(self):
         """_summary_
@@ -281,148 +517,1056 @@ class IEmissionDataService:
         df["category"] = df["categoryName"].map(inverse_map)
         return df
 
-    async def fetch_grouped_by_region(  ##TODO: Refactor into smaller pieces
+    async def fetch_grouped_by_region(
         self,
         year_start: str,
         year_end: str,
         category: Dict[str, Dict[str, str]]  = None,
+        region_level: str = "district",
+        live: bool = False,
     ):
-        if category is None or not category:
-            category = {}
-            category_gir_1 = {"categoryName": {"in": list(ipcc_to_gir_code.keys())}}
-        else:
-            category_gir_1 = category
+        """
+        Fetches the map data: the calculated emissions (kt) per region and the GIR regional totals per province.
+
+        By default they are read from the IEmissionRegionRollup rows (see refresh_region_rollups), so the cost does
+        not depend on the number of sites, or from emission_store when it is enabled. With live, they are aggregated from IEmissionData by the database
+        (see region_totals), e.g. to check the rollups. The three sources are queried concurrently either way.
+
+        Args:
+            year_start (str): The start of the period, e.g. 2019-01-01.
+            year_end (str): The end of the period, e.g. 2020-01-01.
+            category (dict, optional): The categoryName filter. Defaults to the GIR regional categories.
+            region_level (str, optional): The level of the calculated emissions, one of REGION_LEVELS.
+            live (bool, optional): Aggregate IEmissionData instead of reading the rollups. Defaults to False.
+
+        Returns:
+            dict: gir4Calc, gir1Calc and gir1 records with their emissionTotal normalized between 0 and 1 (norm).
+            The responses are cached (see emission_cache) until the emissions of their years are written.
+        """
+        if region_level not in REGION_LEVELS:
+            raise ValueError(f"Unknown region level {region_level}, expected one of {REGION_LEVELS}")
+        category = {key: value for key, value in (category or {}).items() if key == "categoryName"}
+        category_gir_1 = category or {"categoryName": {"in": list(ipcc_to_gir_code.keys())}}
         if year_start is None:
             year_start = "2019-01-01T00:00:00.000Z"
         if year_end is None:
             year_end = "2020-01-01T00:00:00.000Z"
-        gir_4_calc = await self.prisma.iemissiondata.find_many(
-            where={
-                "source": "calc:gir-db4",
-                "regionUid": {"not": None},
-                "periodStartDt": {"gte": year_start},
-                "periodEndDt": {"lte": year_end},
-                **category
-            },
-            include={"region": True},
-        )
+        years = years_within(parse_to_date(year_start), parse_to_date(year_end))
+        if not years:
+            return {}
+        sources = [
+            ("calc:gir-db4", region_level, category),
+            ("calc:gir-db1", region_level, category_gir_1),
+            ("orig:gir-db1", "province", category_gir_1),
+        ]
+
+        async def compute() -> dict:
+            if not live and await self.sync_store():
+                frames = [
+                    self.store_region_totals(source, level, category_names(where), years)
+                    for source, level, where in sources
+                ]
+                return region_map_response(*frames)
+            if live:
+                queries = []
+                for source, level, where in sources:
+                    names = category_names(where)
+                    args = [years[0], years[-1], json.dumps(names) if names is not None else None]
+                    if source == "orig:gir-db1":
+                        queries.append(self.prisma.query_raw(GIR1_REGION_TOTALS, *args))
+                    else:
+                        queries.append(self.prisma.query_raw(region_totals(level), source, *args))
+            else:
+                queries = [
+                    self.prisma.iemissionregionrollup.find_many(
+                        where={"year": {"in": years}, "source": source, "regionLevel": level, **where}
+                    )
+                    for source, level, where in sources
+                ]
+            results = await asyncio.gather(*queries)
+            frames = [
+                pd.DataFrame(
+                    rows if live else list_of_objects_to_dict(rows),
+                    columns=["regionUid", "regionName", "latitude", "longitude", "emissionTotal"],
+                )
+                for rows in results
+            ]
+            return region_map_response(*frames)
 
-        gir_1_calc = await self.prisma.iemissiondata.find_many(
-            where={
-                "source": "calc:gir-db1",
-                "regionUid": {"not": None},
-                "periodStartDt": {"gte": year_start},
-                "periodEndDt": {"lte": year_end},
-                **category_gir_1
-                
+        key = ResponseCache.make_key("mapdata", years=years, category=category, region_level=region_level, live=live)
+        return await emission_cache.get_or_set(key, compute, tags=cache_tags(MAP_SOURCES, years))
 
-            },
-            include={"region": True},
+    async def sync_store(self) -> bool:
+        """
+        Loads the stale rows of emission_store (every row on the first call), one query per stale source, and the
+        regions when rows were loaded or every STORE_REGIONS_TTL seconds. Every slice is counted before it is read,
+        so that a slice exceeding the size of the store disables it without being loaded.
+
+        The slices written by other processes are found by comparing their versions (see STORE_VERSIONS) every
+        STORE_VERSION_TTL seconds. When a query fails, the slices not loaded yet stay stale for the next call.
+
+        Returns:
+            bool: Whether emission_store is enabled and can answer reads.
+        """
+        if not emission_store.enabled:
+            return False
+        async with emission_store.lock:
+            if not emission_store.loaded or emission_store.versions_expired():
+                # Before the rows are read, so that the rows written meanwhile are found by the next check
+                emission_store.expire_versions(await self.prisma.query_raw(STORE_VERSIONS, None, None))
+            slices = [(None, None)] if not emission_store.loaded else []
+            stale = emission_store.take_stale()
+            if emission_store.loaded:
+                slices += list(stale.items())
+            for index, (source, years) in enumerate(slices):
+                args = [json.dumps([source]) if source else None, json.dumps(sorted(years)) if years is not None else None]
+                try:
+                    [count] = await self.prisma.query_raw(STORE_ROW_COUNT, *args)
+                    if not emission_store.fits(count["count"], source, years):
+                        return False
+                    rows = await self.prisma.query_raw(STORE_ROWS, *args)
+                except BaseException:
+                    # A failed full load leaves the store unloaded, the failed and remaining slices stay stale
+                    for stale_source, stale_years in slices[index:]:
+                        if stale_source is not None:
+                            emission_store.mark_stale([stale_source], sorted(stale_years) if stale_years is not None else None)
+                    raise
+                emission_store.replace(pd.DataFrame(rows, columns=STORE_COLUMNS), source, years)
+            if slices or emission_store.regions_expired():
+                regions = await self.prisma.region.find_many()
+                emission_store.set_regions(pd.DataFrame(
+                    list_of_objects_to_dict(regions), columns=["uid", "name", "latitude", "longitude", "parentUid"]
+                ).set_index("uid"))
+        return emission_store.enabled
+
+    def store_region_totals(self, source: str, region_level: str, categories: list[str] | None, years: list[int]) -> pd.DataFrame:
+        """
+        The emissions (kt) of a source per region from emission_store, like region_totals (calculated sources, per
+        region of region_level) and GIR1_REGION_TOTALS (orig:gir-db1, per region name).
+
+        Returns:
+            pd.DataFrame: regionUid, regionName, latitude, longitude, emissionTotal.
+        """
+        columns = ["regionUid", "regionName", "latitude", "longitude", "emissionTotal"]
+        mask = emission_store.mask(sources=[source], year_from=years[0], year_to=years[-1], categories=categories)
+        factor = unit_factor(source_units[source], "kt")
+        if source == "orig:gir-db1":
+            totals = emission_store.totals("regionName", mask).assign(regionUid=None)
+            return totals.assign(emissionTotal=totals["emissionTotal"] * factor)[columns]
+        totals = emission_store.totals("regionUid", mask)
+        regions = emission_store.regions
+        totals = totals[totals["regionUid"].isin(regions.index)]
+        if region_level == "province":
+            totals = totals.assign(regionUid=regions["parentUid"].reindex(totals["regionUid"]).to_numpy()).dropna(subset=["regionUid"])
+            totals = totals[totals["regionUid"].isin(regions.index)].groupby("regionUid", as_index=False)["emissionTotal"].sum()
+        region_rows = regions.reindex(totals["regionUid"])
+        return pd.DataFrame({
+            "regionUid": totals["regionUid"].to_numpy(),
+            "regionName": region_rows["name"].to_numpy(),
+            "latitude": region_rows["latitude"].to_numpy(),
+            "longitude": region_rows["longitude"].to_numpy(),
+            "emissionTotal": totals["emissionTotal"].to_numpy() * factor,
+        }, columns=columns)
+
+    async def fetch_distinct(self, column: str) -> list:
+        """
+        Fetches the distinct values of a column (source, categoryName or regionName) of the served rows, from
+        emission_store when it is enabled.
+        """
+        if await self.sync_store():
+            return emission_store.distinct(column)
+        rows = await self.fetch_many(distinct=[column])
+        return [getattr(row, column) for row in rows]
+
+    async def fetch_time_series(
+        self,
+        year_from: int,
+        year_to: int,
+        sources: list[str] | None = None,
+        categories: list[str] | None = None,
+        by_region: bool = True,
+        deltas: bool = False,
+    ) -> dict:
+        """
+        Fetches the yearly emissions (kt) of a year range per source, category and region in one query
+        (see emission_time_series), e.g. to draw trends without one map query per year.
+
+        Args:
+            year_from (int): The first year.
+            year_to (int): The last year (inclusive).
+            sources (list[str], optional): The sources. Defaults to MAP_SOURCES.
+            categories (list[str], optional): Only these categories. Defaults to every category.
+            by_region (bool, optional): Also group by region (regionUid, regionName). Defaults to True.
+            deltas (bool, optional): Add the year-over-year change of every series (delta). Defaults to False.
+
+        Returns:
+            dict: Columnar arrays: year, source, categoryName, (regionUid, regionName,) emissionTotal (and delta).
+        """
+        sources = sources or MAP_SOURCES
+        columns = [
+            "year", "source", "categoryName", *(["regionUid", "regionName"] if by_region else []),
+            "emissionTotal", *(["delta"] if deltas else []),
+        ]
+
+        async def compute() -> dict:
+            rows = await self.prisma.query_raw(
+                emission_time_series(by_region=by_region, deltas=deltas),
+                year_from,
+                year_to,
+                json.dumps(sources),
+                json.dumps(categories) if categories else None,
+            )
+            return records_to_columns(rows, columns)
+
+        key = ResponseCache.make_key(
+            "timeseries", years=[year_from, year_to], sources=sources, categories=categories, by_region=by_region, deltas=deltas
         )
+        return await emission_cache.get_or_set(key, compute, tags=cache_tags(sources, list(range(year_from, year_to + 1))))
 
-        gir_1 = await self.prisma.iemissiondata.group_by(
-            where={
-                "source": "orig:gir-db1",
-                "periodStartDt": {"gte": year_start},
-                "periodEndDt": {"lte": year_end},
-                **category_gir_1,
+    async def fetch_emission_grid(
+        self,
+        year: int,
+        sources: list[str] | None = None,
+        categories: list[str] | None = None,
+        resolution: float | None = None,
+        zoom: int | None = None,
+        bbox: tuple[float, float, float, float] | None = None,
+    ) -> dict:
+        """
+        Fetches the emissions (kt) of a year summed per cell of a regular latitude/longitude grid, for heatmaps
+        that stay light however many (per site) rows there are. Rows are binned in SQL and the grid is coarsened
+        until it has at most MAX_GRID_CELLS cells. Grids are cached per snapped resolution.
 
+        Args:
+            year (int): The year.
+            sources (list[str], optional): The sources, summed together. Defaults to calc:gir-db4.
+            categories (list[str], optional): Only these categories. Defaults to every category.
+            resolution (float, optional): The cell size in degrees, see grid_resolution.
+            zoom (int, optional): The web map zoom level, used when resolution is None.
+            bbox (tuple, optional): Only the rows within (south, west, north, east).
 
-            },
-            by=[
-                "categoryName",
-                "regionName",
-                "source",
-                "latitude",
-                "longitude",
-                
-            ],
-            sum={"emissionTotal": True},
+        Returns:
+            dict: The resolution and the columnar arrays latitude, longitude (cell centers), emissionTotal, rowCount.
+        """
+        sources = sources or CALCULATION_SOURCES[:1]
+        resolution = grid_resolution(resolution, zoom)
+        if bbox is not None and len(bbox) != 4:
+            raise ValueError("The bounding box is south,west,north,east")
+
+        async def compute() -> dict:
+            cells = await self.prisma.query_raw(
+                EMISSION_GRID,
+                year,
+                resolution,
+                json.dumps(sources),
+                json.dumps(categories) if categories else None,
+                *(bbox or [None] * 4),
+            )
+            return bin_grid(pd.DataFrame(cells), resolution)
+
+        key = ResponseCache.make_key(
+            "grid", year=year, sources=sources, categories=categories, resolution=resolution, bbox=bbox
         )
-        if len(gir_1) == 0 or len(gir_4_calc) == 0 or len(gir_1_calc) == 0:
-            return {}
+        return await emission_cache.get_or_set(key, compute, tags=cache_tags(sources, [year]))
+
+    async def refresh_cube(
+        self,
+        year_from: int | None = None,
+        year_to: int | None = None,
+        sources: list[str] | None = None,
+        categories: list[str] | None = None,
+    ) -> int:
+        """
+        Recomputes the IEmissionCube rows of the years [year_from, year_to], of the sources and of the categories
+        in one transaction. Called by refresh_summaries.
+
+        Args:
+            year_from (int, optional): The first year. Defaults to the first year of the data.
+            year_to (int, optional): The last year (inclusive). Defaults to the last year of the data.
+            sources (list[str], optional): The sources. Defaults to every source.
+            categories (list[str], optional): The category names. Defaults to every category.
+
+        Returns:
+            int: The number of cube rows written.
+        """
+        where = {}
+        if year_from is not None or year_to is not None:
+            where["year"] = {key: value for key, value in {"gte": year_from, "lte": year_to}.items() if value is not None}
+        if sources is not None:
+            where["source"] = {"in": sources}
+        if categories is not None:
+            where["categoryName"] = {"in": categories}
+        async with self.long_tx() as transaction:
+            await transaction.iemissioncube.delete_many(where=where)
+            count = await transaction.execute_raw(
+                REFRESH_CUBE,
+                year_from,
+                year_to,
+                json.dumps(sources) if sources is not None else None,
+                json.dumps(categories) if categories is not None else None,
+            )
+        self.logger.info(f"refresh_cube({year_from}, {year_to}, {sources}, {categories}): {count} rows")
+        return count
 
-        gir_1_df = pd.DataFrame.from_records(gir_1)
-        gir_1_df["emissionTotal"] = gir_1_df["_sum"].apply(
-            lambda x: x.get("emissionTotal") / 1000 if x.get("emissionTotal") else 0
+    async def refresh_emitter_totals(
+        self, year_from: int | None = None, year_to: int | None = None, sources: list[str] | None = None
+    ) -> int:
+        """
+        Recomputes the IEmissionSiteTotal and IEmissionOrgTotal rows of the years [year_from, year_to] and of the
+        sources in one transaction.
+
+        Args:
+            year_from (int, optional): The first year. Defaults to the first year of the data.
+            year_to (int, optional): The last year (inclusive). Defaults to the last year of the data.
+            sources (list[str], optional): The sources. Defaults to every source.
+
+        Returns:
+            int: The number of site and organization totals written.
+        """
+        where = {}
+        if year_from is not None or year_to is not None:
+            where["year"] = {key: value for key, value in {"gte": year_from, "lte": year_to}.items() if value is not None}
+        if sources is not None:
+            where["source"] = {"in": sources}
+        args = [year_from, year_to, json.dumps(sources) if sources is not None else None]
+        async with self.long_tx() as transaction:
+            await transaction.iemissionsitetotal.delete_many(where=where)
+            await transaction.iemissionorgtotal.delete_many(where=where)
+            count = await transaction.execute_raw(REFRESH_SITE_TOTALS, *args)
+            count += await transaction.execute_raw(REFRESH_ORG_TOTALS, *args)
+        self.logger.info(f"refresh_emitter_totals({year_from}, {year_to}, {sources}): {count} rows")
+        return count
+
+    async def refresh_summaries(
+        self,
+        year_from: int | None = None,
+        year_to: int | None = None,
+        sources: list[str] | None = None,
+        categories: list[str] | None = None,
+    ) -> None:
+        """
+        Refreshes the tables summarizing IEmissionData (the cube and the emitter totals) for the years
+        [year_from, year_to] and the sources. Called after the imports and whenever calculated emissions are published.
+        The rebuilds delete and re-insert their slice, so they run one at a time under SUMMARY_LOCK_KEY, whichever
+        job or request calls them.
+
+        With categories, only the cube rows of these categories are rebuilt. The emitter totals are always rebuilt
+        for every category, as their all-category (ALL_CATEGORIES) rows depend on the other categories.
+        """
+        async with job_runner.lock([SUMMARY_LOCK_KEY]):
+            await self.refresh_cube(year_from, year_to, sources, categories)
+            await self.refresh_emitter_totals(year_from, year_to, sources)
+
+    def schedule_summary_refresh(self, sources: list[str], years: list[int]) -> Job | None:
+        """
+        Marks the summaries of the sources in the years stale and refreshes them in a background job, so that
+        single-row writes do not each rebuild the slice. The writes made until the job starts share it.
+
+        Returns:
+            Job | None: The submitted job, None when a queued job already covers the slice.
+        """
+        global summary_refresh_job
+        for source in sources:
+            pending_summaries.setdefault(source, set()).update(years)
+        # A running job has already taken its slices, and a cancelled or failed one left them pending
+        if summary_refresh_job is not None and summary_refresh_job.status == "queued":
+            return None
+        summary_refresh_job = job_runner.submit("refresh_summaries", self._refresh_pending_summaries, unit="sources")
+        return summary_refresh_job
+
+    async def _refresh_pending_summaries(self, job: Job) -> None:
+        stale = dict(pending_summaries)
+        pending_summaries.clear()
+        job.set_total(len(stale))
+        refreshed = []
+        try:
+            for source, years in stale.items():
+                await self.refresh_summaries(min(years), max(years), [source])
+                refreshed.append(source)
+                job.advance()
+        finally:
+            # Refreshed by the next summary job when the job fails or is cancelled
+            for source, years in stale.items():
+                if source not in refreshed:
+                    pending_summaries.setdefault(source, set()).update(years)
+
+    async def refresh_summaries_for_rows(self, rows: pd.DataFrame) -> None:
+        """
+        Refreshes the summaries for the sources and years of imported rows (source and periodStartDt columns).
+        """
+        if rows.empty or "source" not in rows or "periodStartDt" not in rows:
+            return
+        years = pd.to_datetime(rows["periodStartDt"]).dt.year.dropna()
+        if years.empty:
+            return
+        await self.refresh_summaries(int(years.min()), int(years.max()), rows["source"].dropna().unique().tolist())
+
+    async def fetch_top_emitters(
+        self,
+        entity: str,
+        year: int,
+        source: str = "calc:gir-db4",
+        category_name: str | None = None,
+        region_name: str | None = None,
+        limit: int = 50,
+    ) -> list[dict]:
+        """
+        Fetches the largest emitters (kt) of a year from the emitter totals, e.g. the top 50 sites of 경기도 for
+        2.A, with an index scan instead of an aggregation of IEmissionData.
+
+        Args:
+            entity (str): One of EMITTER_ENTITIES.
+            year (int): The year.
+            source (str, optional): The source. Defaults to calc:gir-db4.
+            category_name (str, optional): The category. Defaults to every category.
+            region_name (str, optional): Only the emitters of this province (address region).
+            limit (int, optional): The number of emitters, at most MAX_TOP_EMITTERS. Defaults to 50.
+
+        Returns:
+            list[dict]: rank, uid, name, regionUid, regionName and emissionTotal per emitter, and organizationUid
+                for the sites.
+        """
+        if not 0 < limit <= MAX_TOP_EMITTERS:
+            raise ValueError(f"The limit must be between 1 and {MAX_TOP_EMITTERS}")
+        query = top_emitters_query(entity, by_region=region_name is not None)
+        region_args = [region_name] if region_name is not None else []
+        return await self.prisma.query_raw(query, year, source, category_name or ALL_CATEGORIES, *region_args, limit)
+
+    async def fetch_cube(self, dimensions: list[str], filters: dict | None = None) -> dict:
+        """
+        Slices the IEmissionCube: emissionTotal, energyTotal and rowCount summed per dimensions (roll-up with fewer
+        dimensions, drill-down with more) for the rows matching the filters, without reading IEmissionData.
+
+        Args:
+            dimensions (list[str]): The dimensions to group by, from CUBE_DIMENSIONS.
+            filters (dict, optional): Dimension -> value or list of values, e.g. {"source": "calc:gir-db4", "year": [2020]}.
+
+        Returns:
+            dict: Columnar arrays of the dimensions and the measures.
+        """
+        query, args = cube_query(dimensions, filters)
+        rows = await self.prisma.query_raw(query, *args)
+        return records_to_columns(rows, [*dimensions, *CUBE_MEASURES])
+
+    async def refresh_region_rollups(self, year: int, categories: list[str] | None = None) -> int:
+        """
+        Recomputes the IEmissionRegionRollup rows of a year (see REFRESH_REGION_ROLLUPS) in one transaction.
+        Called whenever a calculation run of the year is published or updated in place.
+
+        Args:
+            year (int): The year.
+            categories (list[str], optional): Only the rollups of these category names. Defaults to every category.
+
+        Returns:
+            int: The number of rollup rows written.
+        """
+        where = {"year": year}
+        if categories is not None:
+            where["categoryName"] = {"in": categories}
+        async with self.long_tx() as transaction:
+            await transaction.iemissionregionrollup.delete_many(where=where)
+            count = await transaction.execute_raw(
+                REFRESH_REGION_ROLLUPS, year, json.dumps(categories) if categories is not None else None
+            )
+        self.invalidate_cached(MAP_SOURCES, [year])
+        self.logger.info(f"refresh_region_rollups({year}, {categories}): {count} rows")
+        return count
+
+    async def fetch_co2eq_totals(
+        self, source: str, year_from: int, year_to: int, gwp_set: str | None = None
+    ) -> list[dict]:
+        """
+        Fetches the CO2 equivalent totals (kt) per category and year of every pollutant of a source,
+        e.g. the CO2 and CH4 sheets of orig:gir-db4, converted and summed by the database in one query.
+
+        Args:
+            source (str): The source, e.g. orig:gir-db4.
+            year_from (int): The first year.
+            year_to (int): The last year (inclusive).
+            gwp_set (str, optional): The GWP values to use, one of gwp_values. Defaults to default_gwp_set.
+
+        Returns:
+            list[dict]: categoryName, year, emissionTotal and pollutantCount per category and year.
+        """
+        return await self.prisma.query_raw(co2eq_totals(gwp_set), source, year_from, year_to)
+
+    async def get_date_boundaries(self, source: str) -> dict:
+        """
+        Retrieves the maximum and minimum date boundaries of the emission data.
+
+        Parameters:
+            where (prisma.types.IEmissionDataWhereInput, optional): The filter to apply to the emission data. Defaults to None.
+
+        Returns:
+            A dictionary containing the maximum and minimum date boundaries of the emission data.
+        """
+        boundaries = await self.prisma.query_raw(
+            query=f"""SELECT MIN("periodStartDt") AS from, MAX("periodEndDt") AS to from "IEmissionData" WHERE source like '{source}'"""
         )
 
-        # gir_4_group_df = pd.DataFrame.from_records(gir_4_group)
-        # gir_1_group_df = pd.DataFrame.from_records(gir_1_group)
-        # print(gir_1_df["_sum"].head(10))
-        gir_4_calc_df = pd.DataFrame(list_of_objects_to_dict(gir_4_calc))
-        gir_4_calc_df["latitude"] = gir_4_calc_df.apply(
-            lambda x: x["region"].latitude, axis=1
+        return boundaries[0]
+
+    async def calculate_emissions(self, year: int | None = None, mode: str = "set") -> None:
+        """
+        Calculate emissions for a given year.
+
+        Args:
+            year (int): The year for which to calculate emissions. Optional in the "incremental" mode only.
+            mode (str): The calculation engine to use, one of CALCULATION_MODES.
+                "set" (default) computes the allocations in the database with a few set-based statements,
+                "reference" walks the relations one by one,
+                "incremental" only recomputes the dirty (categoryName, year) groups, see mark_dirty.
+
+        Returns:
+            None: This function does not return anything.
+        """
+        if mode not in CALCULATION_MODES:
+            raise ValueError(f"Unknown calculation mode {mode}, expected one of {CALCULATION_MODES}")
+        if mode == "reference":
+            return await self.calculate_emissions_reference(year=year)
+        if mode == "incremental":
+            return await self.calculate_emissions_incremental(year=year)
+        if year is None:
+            raise ValueError(f"A year is required by the {mode} calculation mode")
+        return await self.calculate_emissions_set_based(year=year)
+
+    async def count_active_relations(self, year: int) -> int:
+        """
+        Counts the relations taking part in the calculation of the year (their site operates on Jan 1st).
+
+        Args:
+            year (int): The calculated year.
+
+        Returns:
+            int: The number of relations.
+        """
+        return await self.rel_service.fetch_count(
+            where={"site": {"is": {"operationStartDt": {"lte": datetime(year, 1, 1)}}}}
         )
-        gir_4_calc_df["longitude"] = gir_4_calc_df.apply(
-            lambda x: x["region"].longitude, axis=1
+
+    async def calculate_emissions_range(self, year_from: int, year_to: int, mode: str = "set", job: Job | None = None) -> dict:
+        """
+        Calculate emissions for every year of [year_from, year_to), reporting the processed relations to the job.
+
+        Args:
+            year_from (int): The first year to calculate.
+            year_to (int): The end year (exclusive).
+            mode (str): The calculation engine, see calculate_emissions.
+            job (Job, optional): The background job running the calculation (see app.foundation.jobs).
+
+        Returns:
+            dict: The number of calculated rows per year.
+        """
+        years = list(range(year_from, year_to))
+        relation_counts = {year: await self.count_active_relations(year) for year in years}
+        if job:
+            job.set_total(sum(relation_counts.values()))
+        calculated = {}
+        for year in years:
+            calculated[year] = await self.calculate_emissions(year=year, mode=mode)
+            if job:
+                job.advance(relation_counts[year])
+        if years:
+            await self.refresh_category_rollups(year_from=years[0], year_to=years[-1])
+        return calculated
+
+    async def refresh_category_rollups(self, year_from: int, year_to: int) -> int:
+        """
+        Recomputes the IEmissionCategoryRollup rows of [year_from, year_to]: the emission totals of every level of
+        the Code hierarchy, for every source and pollutant, in one bottom-up pass over the category totals.
+        Runs under CATEGORY_ROLLUP_LOCK_KEY, whether called by its endpoint, a calculation or a purge.
+
+        Args:
+            year_from (int): The first year.
+            year_to (int): The last year (inclusive).
+
+        Returns:
+            int: The number of rollup rows written.
+        """
+        async with job_runner.lock([CATEGORY_ROLLUP_LOCK_KEY]):
+            codes = await self.prisma.code.find_many(where={"type": "sourcesinkcategory"})
+            tree = CodeTree.from_codes(codes)
+            totals = pd.DataFrame(
+                await self.prisma.query_raw(CATEGORY_TOTALS_BY_YEAR, year_from, year_to),
+                columns=["source", "pollutantId", "year", "categoryUid", "categoryName", "emissionTotal"],
+            )
+            rollups = rollup_category_totals(tree, totals)
+            records = [
+                {**row, "year": int(row["year"]), "treeDepth": int(row["treeDepth"]), "isReported": bool(row["isReported"])}
+                for row in rollups.to_dict("records")
+            ]
+            async with self.long_tx() as transaction:
+                await transaction.iemissioncategoryrollup.delete_many(where={"year": {"gte": year_from, "lte": year_to}})
+                for start in range(0, len(records), 1000):
+                    await transaction.iemissioncategoryrollup.create_many(data=records[start:start + 1000])
+        self.logger.info(f"refresh_category_rollups({year_from}, {year_to}): {len(records)} rows")
+        return len(records)
+
+    async def fetch_category_rollups(
+        self,
+        year: int | None = None,
+        code: str | None = None,
+        source: str | None = None,
+        pollutant_id: str | None = None,
+        depth: int | None = None,
+    ) -> list[prisma.models.IEmissionCategoryRollup]:
+        """
+        Fetches precomputed category totals (see refresh_category_rollups), e.g. the total of 2.A for 2020.
+
+        Args:
+            year (int, optional): The year.
+            code (str, optional): The category code, e.g. 2.A.
+            source (str, optional): The source, e.g. calc:gir-db4.
+            pollutant_id (str, optional): The pollutant, e.g. CO2.
+            depth (int, optional): Only the categories of this depth of the hierarchy.
+
+        Returns:
+            list[prisma.models.IEmissionCategoryRollup]: The rollups.
+        """
+        where = {
+            "year": year,
+            "categoryCode": code,
+            "source": source,
+            "pollutantId": pollutant_id,
+            "treeDepth": depth,
+        }
+        return await self.prisma.iemissioncategoryrollup.find_many(
+            where={key: value for key, value in where.items() if value is not None},
+            order=[{"year": "asc"}, {"categoryCode": "asc"}],
         )
-        gir_1_calc_df = pd.DataFrame(list_of_objects_to_dict(gir_1_calc))
-        gir_1_calc_df["latitude"] = gir_1_calc_df.apply(
-            lambda x: x["region"].latitude, axis=1
+
+    async def calculate_emissions_set_based(self, year: int) -> int:
+        """
+        Calculate emissions for a given year using set-based SQL.
+
+        The per-category GIR totals, the per-category contribution sums and the per-relation allocations
+        are computed by the database in one INSERT ... SELECT ... ON CONFLICT statement per GIR source,
+        so the number of round trips does not depend on the number of relations.
+        Produces the same rows as calculate_emissions_reference.
+        The rows are written into a new calculation run, which is published once complete.
+
+        Args:
+            year (int): The year for which to calculate emissions.
+
+        Returns:
+            int: The number of calculated (inserted or updated) rows.
+        """
+        relation_count = await self.count_active_relations(year)
+        if not relation_count:
+            raise Exception("No relations found")
+        run = await self.start_calc_run(year=year, mode="set")
+        written = False
+        try:
+            gir4_count = await self.prisma.execute_raw(ALLOCATE_GIR4_EMISSIONS, year, run.uid)
+            gir1_count = await self.prisma.execute_raw(ALLOCATE_GIR1_EMISSIONS, year, run.uid)
+            written = True
+        finally:
+            # Also on cancellation (a closed connection, a shutdown), so that no staging rows are left behind
+            if not written:
+                await self.fail_calc_run(run.uid)
+        await self.publish_calc_run(run.uid, row_count=gir4_count + gir1_count)
+        self.logger.info(
+            f"calculate_emissions({year}): {relation_count} relations, {gir4_count} calc:gir-db4 and {gir1_count} calc:gir-db1 rows, run {run.uid}"
         )
-        gir_1_calc_df["longitude"] = gir_1_calc_df.apply(
-            lambda x: x["region"].longitude, axis=1
+        return gir4_count + gir1_count
+
+    async def calculate_emissions_incremental(self, year: int | None = None) -> int:
+        """
+        Recalculates only the (categoryName, year) groups marked dirty by mark_dirty, using the set-based engine
+        restricted to the dirty categories. The processed dirty marks are removed afterwards, unless they were
+        marked again during the calculation (see IEmissionCalcDirty.version).
+
+        Every dirty year is written into a new staging run: the rows of the other categories are copied from the
+        active run and the dirty categories are reallocated, then the run is published. Readers see the active
+        run until then. A year without an active run is fully calculated into a new run.
+
+        The copy still writes every row of the year, but only the region rollups and the cube rows of the dirty
+        categories are refreshed on publish. The emitter totals of the year are rebuilt whole (see
+        refresh_summaries).
+
+        Args:
+            year (int, optional): Only recalculate the dirty groups of this year. Defaults to every dirty year.
+
+        Returns:
+            int: The number of calculated (inserted or updated) rows.
+        """
+        dirty = await self.prisma.iemissioncalcdirty.find_many(
+            where={"year": year} if year is not None else None
         )
-        gir_4_calc_groupped = gir_4_calc_df.groupby(["regionUid"], as_index=False).agg(
-            {
-                "emissionTotal": "sum",
-                "latitude": "mean",
-                "longitude": "mean",
-                "regionName": "first",
-            }
+        if not dirty:
+            return 0
+        categories_by_year: Dict[int, set] = {}
+        for group in dirty:
+            categories_by_year.setdefault(group.year, set()).add(group.categoryName)
+        calculated_count = 0
+        for dirty_year, categories in sorted(categories_by_year.items()):
+            if await self.prisma.iemissioncalcrun.find_first(where={"year": dirty_year, "isActive": True}) is None:
+                calculated_count += await self.calculate_emissions_set_based(dirty_year)
+                continue
+            run = await self.start_calc_run(year=dirty_year, mode="incremental")
+            # After start_calc_run, which may publish the adopted unversioned rows
+            active = await self.prisma.iemissioncalcrun.find_first(where={"year": dirty_year, "isActive": True})
+            categories = sorted(categories)
+            written = False
+            try:
+                copied_count = await self.prisma.execute_raw(
+                    COPY_CALC_RUN_EXCEPT_CATEGORIES, active.uid, run.uid, json.dumps(categories)
+                )
+                gir4_count = await self.prisma.execute_raw(
+                    ALLOCATE_GIR4_EMISSIONS_FOR_CATEGORIES, dirty_year, run.uid, json.dumps(categories)
+                )
+                gir1_count = await self.prisma.execute_raw(
+                    ALLOCATE_GIR1_EMISSIONS_FOR_CATEGORIES, dirty_year, run.uid, json.dumps(categories)
+                )
+                written = True
+            finally:
+                if not written:
+                    await self.fail_calc_run(run.uid)
+            # The copied rows are those of the active run, so only the summaries of the dirty categories change
+            await self.publish_calc_run(
+                run.uid, row_count=copied_count + gir4_count + gir1_count, categories=categories
+            )
+            self.logger.info(
+                f"calculate_emissions_incremental({dirty_year}): {categories}, {gir4_count + gir1_count} rows, {copied_count} copied, run {run.uid}"
+            )
+            calculated_count += gir4_count + gir1_count
+        await self.prisma.iemissioncalcdirty.delete_many(
+            where={"OR": [{"uid": group.uid, "version": group.version} for group in dirty]}
         )
-        gir_1_calc_groupped = gir_1_calc_df.groupby(
-            by=["regionUid"], as_index=False
-        ).agg(
-            {
-                "emissionTotal": "sum",
-                "latitude": "mean",
-                "longitude": "mean",
-                "regionName": "first",
+        return calculated_count
+
+    async def start_calc_run(self, year: int, mode: str) -> prisma.models.IEmissionCalcRun:
+        """
+        Creates a staging calculation run for the year. Its rows are not served until publish_calc_run.
+
+        Calc rows of the year written before calculation runs existed are attached to an active "unversioned"
+        run first, so that publishing the new run supersedes them.
+
+        Args:
+            year (int): The calculated year.
+            mode (str): The calculation mode, see CALCULATION_MODES.
+
+        Returns:
+            prisma.models.IEmissionCalcRun: The staging run.
+        """
+        unversioned = await self.prisma.iemissiondata.count(
+            where={
+                "calcRunUid": None,
+                "source": {"in": CALCULATION_SOURCES},
+                "periodStartDt": {"gte": datetime(year, 1, 1)},
+                "periodEndDt": {"lte": datetime(year, 12, 31)},
             }
         )
+        if unversioned:
+            legacy_run = await self.prisma.iemissioncalcrun.create(
+                data={"year": year, "mode": "unversioned", "status": "staging", "rowCount": unversioned}
+            )
+            await self.prisma.execute_raw(ADOPT_UNVERSIONED_EMISSIONS, year, legacy_run.uid)
+            await self.prisma.execute_raw(PUBLISH_CALC_RUN, legacy_run.uid)
+        return await self.prisma.iemissioncalcrun.create(data={"year": year, "mode": mode})
+
+    async def publish_calc_run(
+        self, uid: str, row_count: int | None = None, categories: list[str] | None = None
+    ) -> prisma.models.IEmissionCalcRun | None:
+        """
+        Makes the run the active run of its year, archiving the previously published one, in a single statement.
+        Publishing an archived run rolls the year back to it.
+
+        Args:
+            uid (str): The uid of the run.
+            row_count (int, optional): The number of rows written by the run.
+            categories (list[str], optional): The only category names whose rows differ from the active run, whose
+                region rollups and cube rows are refreshed. Defaults to every category.
 
-        gir_1_groupped = gir_1_df.groupby(by=["regionName"], as_index=False).agg(
-            {"emissionTotal": "sum", "latitude": "mean", "longitude": "mean"}
+        Returns:
+            prisma.models.IEmissionCalcRun | None: The published run, None if it does not exist.
+        """
+        run = await self.prisma.iemissioncalcrun.find_unique(where={"uid": uid})
+        if run is None:
+            return None
+        if run.status == "failed":
+            raise ValueError(f"Run {uid} failed and cannot be published")
+        if row_count is not None:
+            await self.prisma.iemissioncalcrun.update(where={"uid": uid}, data={"rowCount": row_count})
+        await self.prisma.execute_raw(PUBLISH_CALC_RUN, uid)
+        await self.expire_calc_runs(run.year)
+        await self.refresh_region_rollups(run.year, categories)
+        await self.refresh_summaries(run.year, run.year, CALCULATION_SOURCES, categories)
+        return await self.prisma.iemissioncalcrun.find_unique(where={"uid": uid})
+
+    async def expire_calc_runs(self, year: int, keep: int = CALC_RUN_RETENTION) -> int:
+        """
+        Deletes the rows of the archived runs of the year but the keep most recently published ones, so that
+        every calculation does not keep a full copy of the calc rows. The expired runs are kept, without rows.
+
+        Args:
+            year (int): The year.
+            keep (int, optional): The number of archived runs kept for rollbacks. Defaults to CALC_RUN_RETENTION.
+
+        Returns:
+            int: The number of deleted rows.
+        """
+        archived = await self.prisma.iemissioncalcrun.find_many(
+            where={"year": year, "status": "archived"},
+            order={"datePublished": "desc"},
         )
-        gir_1_groupped.fillna("")
-        gir_1_calc_groupped.fillna("")
-        gir_4_calc_groupped.fillna("")
-        scaler = MinMaxScaler(feature_range=(0, 1))
-
-        gir_1_groupped["norm"] = scaler.fit_transform(gir_1_groupped[["emissionTotal"]])
-        gir_4_calc_groupped["norm"] = scaler.transform(
-            gir_4_calc_groupped[["emissionTotal"]]
+        expired = [run.uid for run in archived[keep:]]
+        if not expired:
+            return 0
+        deleted = await self.prisma.iemissiondata.delete_many(where={"calcRunUid": {"in": expired}})
+        await self.prisma.iemissioncalcrun.update_many(
+            where={"uid": {"in": expired}}, data={"status": "expired", "dateModified": datetime.now()}
+        )
+        self.logger.info(f"expire_calc_runs({year}): {len(expired)} runs, {deleted} rows")
+        return deleted
+
+    async def rollback_calc_run(self, year: int) -> prisma.models.IEmissionCalcRun | None:
+        """
+        Re-publishes the run that was active before the current one.
+
+        Args:
+            year (int): The year to roll back.
+
+        Returns:
+            prisma.models.IEmissionCalcRun | None: The re-published run, None if there is no previous run.
+        """
+        previous = await self.prisma.iemissioncalcrun.find_first(
+            where={"year": year, "status": "archived"},
+            order={"datePublished": "desc"},
         )
-        gir_1_calc_groupped["norm"] = scaler.transform(
-            gir_1_calc_groupped[["emissionTotal"]]
+        if previous is None:
+            return None
+        return await self.publish_calc_run(previous.uid)
+
+    async def fail_calc_run(self, uid: str) -> None:
+        """
+        Marks a staging run as failed and removes its rows.
+
+        Args:
+            uid (str): The uid of the run.
+        """
+        await self.prisma.iemissiondata.delete_many(where={"calcRunUid": uid})
+        await self.prisma.iemissioncalcrun.update(where={"uid": uid}, data={"status": "failed", "dateModified": datetime.now()})
+
+    async def fetch_calc_run(self, uid: str) -> prisma.models.IEmissionCalcRun | None:
+        """
+        Fetches a calculation run.
+
+        Args:
+            uid (str): The uid of the run.
+
+        Returns:
+            prisma.models.IEmissionCalcRun | None: The run, None if it does not exist.
+        """
+        return await self.prisma.iemissioncalcrun.find_unique(where={"uid": uid})
+
+    async def fetch_calc_runs(self, year: int | None = None) -> list[prisma.models.IEmissionCalcRun]:
+        """
+        Fetches the calculation runs, most recent first.
+
+        Args:
+            year (int, optional): Only the runs of this year.
+
+        Returns:
+            list[prisma.models.IEmissionCalcRun]: The runs.
+        """
+        return await self.prisma.iemissioncalcrun.find_many(
+            where={"year": year} if year is not None else None,
+            order={"dateCreated": "desc"},
         )
-        return {
-            "gir4Calc": gir_4_calc_groupped.to_dict("records"),
-            "gir1Calc": gir_1_calc_groupped.to_dict("records"),
-            "gir1": gir_1_groupped.to_dict("records"),
+
+    async def diff_calc_runs(self, base_uid: str, compared_uid: str) -> list[dict]:
+        """
+        Compares the totals of two runs per (categoryName, source, pollutantId).
+
+        Args:
+            base_uid (str): The uid of the base run, e.g. the active one.
+            compared_uid (str): The uid of the compared run, e.g. a staging one.
+
+        Returns:
+            list[dict]: baseTotal, comparedTotal, delta, baseRows and comparedRows per group, largest delta first.
+        """
+        return await self.prisma.query_raw(DIFF_CALC_RUNS, base_uid, compared_uid)
+
+    async def purge_emissions(
+        self,
+        source_prefix: str,
+        date_from: datetime | None = None,
+        date_to: datetime | None = None,
+        category_name: str | None = None,
+        batch_size: int = 5000,
+        job: Job | None = None,
+    ) -> dict:
+        """
+        Deletes derived emissions by source prefix, period and category in bounded batches. Every batch is a
+        separate statement (and transaction), so locks are held briefly and readers are never blocked for long.
+        The summaries and rollups of the purged sources are refreshed afterwards.
+
+        Args:
+            source_prefix (str): The source prefix, e.g. "calc:" or "calc:gir-db4". Must be one of DERIVED_SOURCE_PREFIXES.
+            date_from (datetime, optional): Only rows with periodStartDt >= date_from.
+            date_to (datetime, optional): Only rows with periodEndDt <= date_to.
+            category_name (str, optional): Only rows of this category.
+            batch_size (int, optional): The number of rows deleted per batch. Defaults to 5000.
+            job (Job, optional): The background job running the purge (see app.foundation.jobs).
+
+        Returns:
+            dict: The deleted rows, the number of batches, the elapsed seconds and the rows per second.
+        """
+        if not any(source_prefix.startswith(prefix) for prefix in DERIVED_SOURCE_PREFIXES):
+            raise ValueError(f"Only derived emissions can be purged, source must start with one of {DERIVED_SOURCE_PREFIXES}")
+        if batch_size <= 0:
+            raise ValueError("batch_size must be positive")
+        sources = [row["source"] for row in await self.prisma.query_raw(SOURCES_WITH_PREFIX, source_prefix)]
+        deleted, batches = 0, 0
+        started = time.monotonic()
+        if sources:
+            args = (
+                json.dumps(sources),
+                date_from.isoformat() if date_from else None,
+                date_to.isoformat() if date_to else None,
+                category_name,
+                batch_size,
+            )
+            while True:
+                count = await self.prisma.execute_raw(PURGE_EMISSIONS_BATCH, *args)
+                deleted += count
+                batches += 1
+                if job:
+                    job.advance(count)
+                if count < batch_size:
+                    break
+            self.invalidate_cached(sources)
+            await self.refresh_summaries(sources=sources)
+            await self.refresh_rollups_after_purge(sources, date_from, date_to)
+        elapsed = time.monotonic() - started
+        stats = {
+            "sources": sources,
+            "deleted": deleted,
+            "batches": batches,
+            "seconds": round(elapsed, 3),
+            "rowsPerSecond": round(deleted / elapsed, 1) if elapsed > 0 else None,
         }
+        self.logger.info(f"purge_emissions({source_prefix}): {stats}")
+        return stats
 
-    async def get_date_boundaries(self, source: str) -> dict:
+    async def refresh_rollups_after_purge(
+        self, sources: list[str], date_from: datetime | None = None, date_to: datetime | None = None
+    ) -> None:
         """
-        Retrieves the maximum and minimum date boundaries of the emission data.
+        Recomputes the category rollups, and the region rollups of the calc: sources, of the years that had rollups
+        of the purged sources within [date_from, date_to].
 
-        Parameters:
-            where (prisma.types.IEmissionDataWhereInput, optional): The filter to apply to the emission data. Defaults to None.
+        Args:
+            sources (list[str]): The purged sources.
+            date_from (datetime, optional): The start of the purged periods.
+            date_to (datetime, optional): The end of the purged periods.
+        """
+        def purged_years(rollups) -> list[int]:
+            return sorted(
+                rollup.year for rollup in rollups
+                if (date_from is None or rollup.year >= date_from.year) and (date_to is None or rollup.year <= date_to.year)
+            )
+
+        where = {"source": {"in": sources}}
+        category_years = purged_years(await self.prisma.iemissioncategoryrollup.find_many(where=where, distinct=["year"]))
+        if category_years:
+            await self.refresh_category_rollups(category_years[0], category_years[-1])
+        if any(source.startswith("calc:") for source in sources):
+            for year in purged_years(await self.prisma.iemissionregionrollup.find_many(where=where, distinct=["year"])):
+                await self.refresh_region_rollups(year)
+
+    async def mark_dirty(self, categories: list[str], years: list[int] | None = None, reason: str | None = None) -> int:
+        """
+        Records that the calculated emissions of the given categories are stale, so that
+        calculate_emissions(mode="incremental") recomputes them.
+
+        Args:
+            categories (list[str]): The category names (e.g. 2.A.1) of the allocation groups.
+            years (list[int], optional): The years of the allocation groups. Defaults to every calculated year,
+                which is what a site or relation change affects.
+            reason (str, optional): What made the groups dirty.
 
         Returns:
-            A dictionary containing the maximum and minimum date boundaries of the emission data.
+            int: The number of marked groups, including the already dirty ones, whose version is incremented.
         """
-        boundaries = await self.prisma.query_raw(
-            query=f"""SELECT MIN("periodStartDt") AS from, MAX("periodEndDt") AS to from "IEmissionData" WHERE source like '{source}'"""
+        categories = sorted({category for category in categories if category})
+        if not categories:
+            return 0
+        # The relations or proxies of the sites changed
+        emission_cache.invalidate([ALLOCATION_ENGINE_TAG])
+        if years is None:
+            return await self.prisma.execute_raw(MARK_CALCULATION_DIRTY_ALL_YEARS, json.dumps(categories), reason)
+        return await self.prisma.execute_raw(
+            MARK_CALCULATION_DIRTY, json.dumps(categories), json.dumps(sorted(set(years))), reason
         )
 
-        return boundaries[0]
+    async def mark_gir_rows_dirty(self, rows: list[dict]) -> None:
+        """
+        Marks the allocation groups of the written orig:gir-* rows as dirty. Other rows are ignored.
 
-    async def calculate_emissions(self, year: int) -> None:
+        Args:
+            rows (list[dict]): The written IEmissionData rows.
         """
-        Calculate emissions for a given year.
+        groups: Dict[tuple[str, int], str] = {}
+        for row in rows:
+            if not isinstance(row, dict) or not str(row.get("source") or "").startswith(GIR_SOURCE_PREFIX):
+                continue
+            period_start = parse_to_date(row.get("periodStartDt"))
+            if not row.get("categoryName") or period_start is None:
+                continue
+            groups.setdefault((row["categoryName"], period_start.year), row["source"])
+        if groups:
+            await self.prisma.execute_raw(MARK_CALCULATION_DIRTY_GROUPS, json.dumps([
+                {"categoryName": category, "year": year, "reason": source}
+                for (category, year), source in sorted(groups.items())
+            ]))
+
+    def invalidate_cached(self, sources: list[str] | None = None, years: list[int] | None = None) -> int:
+        """
+        Drops the cached responses (see emission_cache) reading the sources in the years, and marks their rows
+        stale in emission_store.
+
+        Args:
+            sources (list[str], optional): The written sources. Defaults to every source.
+            years (list[int], optional): The written years. Defaults to every year.
+
+        Returns:
+            int: The number of dropped responses.
+        """
+        emission_store.mark_stale(sources, years)
+        if sources is None:
+            return emission_cache.invalidate()
+        if years is None:
+            return emission_cache.invalidate(sources)
+        return emission_cache.invalidate([f"{source}:{year}" for source in sources for year in years])
+
+    def invalidate_cached_rows(self, rows: list[dict]) -> int:
+        """
+        Drops the cached responses reading the (source, year) of the written IEmissionData rows, every
+        cached response when a row does not tell its source or period.
+
+        Args:
+            rows (list[dict]): The written IEmissionData rows.
+
+        Returns:
+            int: The number of dropped responses.
+        """
+        tags = set()
+        for row in rows:
+            period_start = parse_to_date(row.get("periodStartDt")) if isinstance(row, dict) else None
+            if not isinstance(row, dict) or not row.get("source") or period_start is None:
+                return self.invalidate_cached()
+            tags.add(f"{row['source']}:{period_start.year}")
+            emission_store.mark_stale([row["source"]], [period_start.year])
+        return emission_cache.invalidate(tags)
+
+    async def calculate_emissions_reference(self, year: int) -> None:
+        """
+        Calculate emissions for a given year, relation by relation.
+
+        This is the reference implementation of the allocation: it is slow (several round trips per relation)
+        but straightforward, and it is used to verify the set-based engine.
 
         Args:
             year (int): The year for which to calculate emissions.
@@ -440,11 +1584,14 @@ class IEmissionDataService:
 
         if not relations or len(relations) == 0:
             raise Exception("No relations found")
+        run = await self.start_calc_run(year=year, mode="reference")
         relations_df = [to_dict(rel) for rel in relations]
         relations_df = pd.DataFrame(relations_df)
         totalContributionMagnitudeInSector = relations_df.groupby("categoryName")[
             "contributionMagnitudeSector"
         ].sum()
+        # Every relation writes one row of the new run, created at once before it is published
+        rows = []
 
         for relation in tqdm(
             relations, total=len(relations), desc="calculate_emission_ratios"
@@ -482,9 +1629,9 @@ class IEmissionDataService:
                 if total_emission is None or len(total_emission) == 0:
                     continue
                 total_emission = total_emission[0]
-                total_emission["emissionTotal"] = (
-                    total_emission["_sum"]["emissionTotal"] / 1000
-                )  ##TODO: Create unit conversion function
+                total_emission["emissionTotal"] = convert_units(
+                    total_emission["_sum"]["emissionTotal"], source_units["orig:gir-db1"], "kt"
+                )
                 total_emission = create_partial_gir1(
                     total_emission=total_emission,
                     categoryName=category_name,
@@ -500,8 +1647,8 @@ class IEmissionDataService:
                 contributionRatio = relation.contributionMagnitudeSector / matching_item
 
                 emission = contributionRatio * total_emission_gas
-                await self.update_or_create(
-                    data={
+                rows.append(
+                    {
                         "categoryName": category_name,
                         "periodStartDt": total_emission.periodStartDt,
                         "periodEndDt": total_emission.periodEndDt,
@@ -516,18 +1663,44 @@ class IEmissionDataService:
                         "latitude": relation.site.latitude,
                         "categoryRelUid": relation.uid,
                         "categoryUid": total_emission.categoryUid,
-                    },
-                    where={
-                        "categoryName": relation.categoryName,
-                        "periodStartDt": total_emission.periodStartDt,
-                        "periodEndDt": total_emission.periodEndDt,
-                        "siteUid": relation.siteUid,
-                        "pollutantId": total_emission.pollutantId,
-                        "source": "calc:" + total_emission.source,
-                        "regionUid": relation.site.addressRegionUid,
-                        "categoryRelUid": relation.uid,
-                    },
+                        "calcRunUid": run.uid,
+                    }
                 )
+        await self.create_many(data=rows)
+        await self.publish_calc_run(run.uid)
+
+    async def allocate_what_if(
+        self,
+        year_from: int,
+        year_to: int,
+        overrides: Dict[str, Dict[str, float]] = None,
+        pollutants: list[str] = None,
+        reload: bool = False,
+    ) -> pd.DataFrame:
+        """
+        Allocates the GIR totals of several years in memory, optionally with proxy overrides (what-if scenario).
+        Nothing is written to the database. The relations and totals are loaded once and cached in emission_cache
+        for the same year range, until the GIR rows of those years are written, a site or relation change marks
+        the calculation dirty (see mark_dirty), or reload is set.
+
+        Args:
+            year_from (int): The first year to allocate.
+            year_to (int): The last year (inclusive) to allocate.
+            overrides (dict, optional): {siteUid: {"manufacturingFacilityArea": value}}.
+            pollutants (list[str], optional): Restrict the result to these pollutantIds.
+            reload (bool): Reload the relations and totals from the database.
+
+        Returns:
+            pd.DataFrame: The allocated calc rows.
+        """
+        key = emission_cache.make_key("allocation_engine", year_from=year_from, year_to=year_to)
+        tags = [ALLOCATION_ENGINE_TAG, *cache_tags([GIR4_SOURCE, GIR1_SOURCE], list(range(year_from, year_to + 1)))]
+        if reload:
+            emission_cache.set(key, await AllocationEngine.load(self.prisma, year_from, year_to), tags)
+        engine = await emission_cache.get_or_set(
+            key, lambda: AllocationEngine.load(self.prisma, year_from, year_to), tags=tags
+        )
+        return engine.allocate(years=range(year_from, year_to + 1), overrides=overrides, pollutants=pollutants)
 
     async def create_org_emission(self, data: Emission):
         iorg = await self.prisma.iorganization.find_first(
@@ -585,32 +1758,163 @@ class IEmissionDataService:
             },
             where={"organizationUid": data["uid"], "periodStartDt": period_start_dt, "periodEndDt": period_end_dt, "source": data["source"], "site": None},
         )
+        self.schedule_summary_refresh([data["source"]], [period_start_dt.year])
+
+    async def create_org_emissions_bulk(
+        self,
+        org_totals: pd.DataFrame | list[dict],
+        distribute: bool = True,
+        batch_size: int = 1000,
+        pollutant_id: str | None = ORG_EMISSION_POLLUTANT,
+        fill_value: float | None = 0.0,
+    ) -> dict:
+        """
+        Bulk version of create_org_emission: writes many organization totals and distributes them to the sites.
+
+        The sites of every organization are fetched in one query and the area ratios are applied to all the
+        distributed fields at once. The existing rows of the same (organization, source, period) are replaced,
+        so importing the same file twice does not duplicate the site rows. When the same (organization, source,
+        period) appears several times, the last total is written.
+
+        Args:
+            org_totals (pd.DataFrame | list[dict]): The organization totals, e.g. the emissions of
+                EtsReportImporter.prepare with their organizationUid, or a list of Emission bodies with "uid".
+            distribute (bool, optional): Also write the per-site rows. Defaults to True.
+            batch_size (int, optional): The number of rows per create_many call. Defaults to 1000.
+            pollutant_id (str, optional): The pollutantId of the rows, see normalize_org_totals. Defaults to tCO2eq.
+            fill_value (float, optional): The value of the missing fields, None keeps them NULL. Defaults to 0.
+
+        Returns:
+            dict: The number of organization and site rows written.
+        """
+        totals = pd.DataFrame(org_totals) if not isinstance(org_totals, pd.DataFrame) else org_totals.copy()
+        if "organizationUid" not in totals and "uid" in totals:
+            totals = totals.rename(columns={"uid": "organizationUid"})
+        totals = normalize_org_totals(
+            totals[totals["organizationUid"].notna()], pollutant_id=pollutant_id, fill_value=fill_value
+        )
+        totals = totals.drop_duplicates(
+            subset=["organizationUid", "source", "periodStartDt", "periodEndDt"], keep="last"
+        ).reset_index(drop=True)
+        if totals.empty:
+            return {"organizations": 0, "sites": 0}
+
+        site_rows = pd.DataFrame()
+        if distribute:
+            sites = await self.prisma.iorgsite.find_many(
+                where={"organizationUid": {"in": totals["organizationUid"].unique().tolist()}}
+            )
+            sites_df = pd.DataFrame(
+                [to_dict(site) for site in sites],
+                columns=["uid", "organizationUid", "manufacturingFacilityArea", "longitude", "latitude", "addressRegionUid", "addressRegionName"],
+            )
+            site_rows = distribute_org_emissions(totals, sites_df)
+
+        org_rows = totals[["organizationUid", "periodStartDt", "periodEndDt", "periodLength", "source", "pollutantId", *DISTRIBUTED_FIELDS]]
+        keys = org_rows[["organizationUid", "source", "periodStartDt", "periodEndDt"]].drop_duplicates()
+        keys = keys.assign(
+            periodStartDt=keys["periodStartDt"].dt.strftime("%Y-%m-%dT%H:%M:%S"),
+            periodEndDt=keys["periodEndDt"].dt.strftime("%Y-%m-%dT%H:%M:%S"),
+        )
+        records = [self._to_create_input(row) for row in pd.concat([org_rows, site_rows], ignore_index=True).to_dict("records")]
+        async with self.long_tx() as transaction:
+            await transaction.execute_raw(DELETE_ORG_EMISSIONS, json.dumps(keys.to_dict("records")))
+            for start in range(0, len(records), batch_size):
+                await transaction.iemissiondata.create_many(data=records[start:start + batch_size])
+        sources, years = keys["source"].unique().tolist(), keys["periodStartDt"].str[:4].astype(int).unique().tolist()
+        self.invalidate_cached(sources, years)
+        await self.refresh_summaries(min(years), max(years), sources)
+        self.logger.info(f"create_org_emissions_bulk: {len(org_rows)} organization and {len(site_rows)} site rows")
+        return {"organizations": len(org_rows), "sites": len(site_rows)}
+
+    async def estimate_emissions_by_intensity(
+        self, year_from: int, year_to: int, batch_size: int = 1000, job: Job | None = None
+    ) -> dict:
+        """
+        Estimates the emissions of the sites the calculation cannot allocate to (no mapped relation or no area)
+        from the emission_intensity table, and writes them as the INTENSITY_SOURCE (est:intensity).
+
+        Every eligible site of a year is fetched in one query and estimated in one DataFrame operation (see
+        estimate_site_emissions). The previous estimates of the year are replaced in the same transaction.
+
+        Args:
+            year_from (int): The first year.
+            year_to (int): The last year (exclusive).
+            batch_size (int, optional): The number of rows per create_many call. Defaults to 1000.
+            job (Job, optional): The job reporting the progress, in years.
+
+        Returns:
+            dict: The number of estimated sites and rows per year, and the elapsed seconds.
+        """
+        years = list(range(year_from, year_to))
+        if job:
+            job.set_total(len(years))
+        started = time.monotonic()
+        estimated = {}
+        for year in years:
+            sites = pd.DataFrame(
+                await self.prisma.query_raw(SITES_WITHOUT_ALLOCATIONS, year),
+                columns=[
+                    "uid", "organizationUid", "sectorIds", "sectorIdMain", "numEmployeesTotal",
+                    "manufacturingFacilityArea", "longitude", "latitude", "addressRegionUid", "addressRegionName",
+                ],
+            )
+            estimates = estimate_site_emissions(sites, year)
+            records = [self._to_create_input(row) for row in estimates.drop(columns=["basis"]).to_dict("records")]
+            async with self.long_tx() as transaction:
+                await transaction.execute_raw(DELETE_SOURCE_EMISSIONS_FOR_YEAR, INTENSITY_SOURCE, year)
+                for start in range(0, len(records), batch_size):
+                    await transaction.iemissiondata.create_many(data=records[start:start + batch_size])
+            self.invalidate_cached([INTENSITY_SOURCE], [year])
+            await self.refresh_summaries(year, year, [INTENSITY_SOURCE])
+            estimated[year] = {
+                "sites": int(estimates["siteUid"].nunique()),
+                "rows": len(records),
+                "basis": estimates["basis"].value_counts().to_dict(),
+            }
+            if job:
+                job.advance()
+        stats = {"years": estimated, "seconds": round(time.monotonic() - started, 3)}
+        self.logger.info(f"estimate_emissions_by_intensity({year_from}, {year_to}): {stats}")
+        return stats
+
+    @staticmethod
+    def _to_create_input(row: dict) -> dict:
+        """Drops the missing values of a DataFrame record and converts the timestamps for create_many."""
+        data = {}
+        for key, value in row.items():
+            if value is None or (not isinstance(value, str) and pd.isna(value)):
+                continue
+            data[key] = value.to_pydatetime() if isinstance(value, pd.Timestamp) else value
+        return data
 
-    async def export_region_groupped(       
+    async def export_region_groupped(
         self,
         year_start: str,
         year_end: str,
         category: Dict[str, Dict[str, str]]  = None,
-    ) -> BytesIO:
-        df = pd.DataFrame()
-        data = await self.fetch_grouped_by_region( year_start=year_start, year_end=year_end, category=category)
-        if len(data) == 0:
-            return "No data to export"
-        df = pd.DataFrame(data.get("gir1"))
-        df.index = df.apply(lambda x: str(round(x['latitude'], 2)) + " " + str(round(x['longitude'], 2)), axis=1)
-        df.drop(columns=['longitude', 'latitude', 'norm'], inplace=True)
-        df.rename(columns={'emissionTotal': 'gir1'}, inplace=True)
-        for item in data.keys():
-            if item == "gir1":
-                continue
-            _df = pd.DataFrame(data.get(item))
-            _df.index = _df.apply(lambda x: str(round(x['latitude'], 2)) + " " + str(round(x['longitude'], 2)), axis=1)
-            _df.drop(columns=['regionUid', 'longitude', 'latitude', 'norm', 'regionName'], inplace=True)
-            _df.rename(columns={'emissionTotal': item}, inplace=True)
-            df = _df.join(df, how='outer')
-        df.index = df['regionName']
-        df.drop(columns=['regionName'], inplace=True)
-        df.columns = pd.MultiIndex.from_tuples([('emissions tCO2eq', 'gir1Calc'),('emissions tCO2eq', 'gir4Calc'),('emissions tCO2eq', 'gir1')])
-        df.index.name = 'region name'
-        csv_str = df.to_csv()
-        return csv_str    
+    ) -> list[tuple]:
+        """
+        Returns the map data (see fetch_grouped_by_region) at province level as export rows: one row per region
+        name with the emissions (kt) of every source, see REGION_EXPORT_COLUMNS and app.utils.export.stream_export.
+
+        Args:
+            year_start (str): The start of the period, e.g. 2019-01-01.
+            year_end (str): The end of the period, e.g. 2020-01-01.
+            category (dict, optional): The categoryName filter.
+
+        Returns:
+            list[tuple]: The rows sorted by region name, empty when there is no data.
+        """
+        data = await self.fetch_grouped_by_region(
+            year_start=year_start, year_end=year_end, category=category, region_level="province"
+        )
+        sources = REGION_EXPORT_COLUMNS[1:]
+        totals: Dict[str, dict] = {}
+        for source in sources:
+            for record in data.get(source, []):
+                totals.setdefault(record["regionName"], {})[source] = record["emissionTotal"]
+        return [
+            (region_name, *[totals[region_name].get(source) for source in sources])
+            for region_name in sorted(totals, key=str)
+        ]
@@ -0,0 +1,238 @@
+import asyncio
+import logging
+import time
+import numpy as np
+import pandas as pd
+
+# Categorical columns, stored as int32 codes into a list of values per column (-1 for None)
+STORE_CATEGORICALS = ["source", "categoryName", "regionUid", "regionName", "pollutantId"]
+# Bytes per row: periodStartDt (datetime64, 8), the codes (5 x int32, 20), emissionTotal (float64, 8),
+# latitude and longitude (2 x float32, 8). About 44 MB per million rows, plus the sort on refreshes.
+STORE_BYTES_PER_ROW = 8 + 4 * len(STORE_CATEGORICALS) + 8 + 2 * 4
+# Seconds the regions are kept before the next sync reloads them
+STORE_REGIONS_TTL = 300
+# Seconds between two checks of the slice versions, which find the rows written by other processes
+STORE_VERSION_TTL = 60
+
+
+class EmissionStore:
+    """
+    An in-process columnar copy of the served IEmissionData rows (imported rows and the rows of the active
+    calculation runs) for the hot read paths, answering filters and aggregations with vectorized masks.
+
+    Rows are kept sorted by periodStartDt, so that a year range is a slice found by binary search. Writes mark
+    (source, year) slices stale (see mark_stale) and only those are replaced on the next read. The store disables
+    itself when it would hold more than max_rows rows (see STORE_BYTES_PER_ROW), checked with fits before the rows
+    are read, and the readers fall back to SQL.
+    """
+
+    def __init__(self, enabled: bool = False, max_rows: int = 2_000_000) -> None:
+        self.enabled = enabled
+        self.max_rows = max_rows
+        self.lock = asyncio.Lock()
+        self.logger = logging.getLogger(__name__)
+        self.stale: dict[str, set[int] | None] = {}
+        # (source, year) -> version of the slice at the last check, see expire_versions
+        self.versions: dict[tuple[str, int], tuple] = {}
+        self.versions_checked_at: float | None = None
+        self.clear()
+
+    def clear(self) -> None:
+        """Drops every row, so that the next read loads the whole table."""
+        self.period_start = np.empty(0, dtype="datetime64[s]")
+        self.codes = {column: np.empty(0, dtype=np.int32) for column in STORE_CATEGORICALS}
+        self.values: dict[str, list] = {column: [] for column in STORE_CATEGORICALS}
+        self.value_codes: dict[str, dict] = {column: {} for column in STORE_CATEGORICALS}
+        self.emission_total = np.empty(0, dtype=np.float64)
+        self.latitude = np.empty(0, dtype=np.float32)
+        self.longitude = np.empty(0, dtype=np.float32)
+        # Region rows (name, latitude, longitude, parentUid) by uid, for the region totals
+        self.regions = pd.DataFrame(columns=["name", "latitude", "longitude", "parentUid"])
+        self.regions_loaded_at: float | None = None
+        self.loaded = False
+
+    def __len__(self) -> int:
+        return len(self.period_start)
+
+    def memory_bytes(self) -> int:
+        return len(self) * STORE_BYTES_PER_ROW
+
+    def stats(self) -> dict:
+        return {
+            "enabled": self.enabled, "loaded": self.loaded, "rows": len(self), "maxRows": self.max_rows,
+            "memoryBytes": self.memory_bytes(), "staleSources": sorted(self.stale),
+        }
+
+    def mark_stale(self, sources: list[str] | None = None, years: list[int] | None = None) -> None:
+        """
+        Marks the rows of the sources in the years stale, every row of the sources when years is None, and the
+        whole store when sources is None.
+        """
+        if sources is None:
+            self.loaded = False
+            self.stale = {}
+            return
+        for source in sources:
+            if years is None or self.stale.get(source, set()) is None:
+                self.stale[source] = None
+            else:
+                self.stale[source] = self.stale.get(source, set()) | set(years)
+
+    def set_regions(self, regions: pd.DataFrame) -> None:
+        """Replaces the regions (name, latitude, longitude, parentUid indexed by uid)."""
+        self.regions = regions
+        self.regions_loaded_at = time.monotonic()
+
+    def regions_expired(self) -> bool:
+        return self.regions_loaded_at is None or time.monotonic() - self.regions_loaded_at > STORE_REGIONS_TTL
+
+    def versions_expired(self) -> bool:
+        return self.versions_checked_at is None or time.monotonic() - self.versions_checked_at > STORE_VERSION_TTL
+
+    def expire_versions(self, rows: list[dict]) -> None:
+        """
+        Marks stale the (source, year) slices whose version changed since the last check, e.g. written by another
+        process, and keeps the versions for the next check.
+
+        Args:
+            rows (list[dict]): source, year, count, modified and run of every served slice (see STORE_VERSIONS).
+        """
+        versions = {(row["source"], row["year"]): (row["count"], row["modified"], row["run"]) for row in rows}
+        if self.loaded:
+            for source, year in versions.keys() | self.versions.keys():
+                if versions.get((source, year)) != self.versions.get((source, year)):
+                    self.mark_stale([source], [year])
+        self.versions = versions
+        self.versions_checked_at = time.monotonic()
+
+    def fits(self, count: int, source: str | None = None, years: set[int] | None = None) -> bool:
+        """
+        Whether replacing the rows of the source in the years (every row when source is None) with count rows
+        keeps the store within max_rows. Disables the store otherwise, so that the rows are never read.
+        """
+        if source is None:
+            kept = 0
+        else:
+            replaced = self.mask(sources=[source])
+            if years is not None:
+                replaced &= np.isin(self.period_start.astype("datetime64[Y]").astype(int) + 1970, list(years))
+            kept = len(self) - int(replaced.sum())
+        if kept + count <= self.max_rows:
+            return True
+        self.disable()
+        return False
+
+    def disable(self) -> None:
+        self.logger.warning(f"The emission store would exceed {self.max_rows} rows, it is disabled")
+        self.enabled = False
+        self.clear()
+
+    def take_stale(self) -> dict[str, set[int] | None]:
+        """Returns and forgets the stale slices: source -> years, None for every year."""
+        stale, self.stale = self.stale, {}
+        return stale
+
+    def replace(self, rows: pd.DataFrame, source: str | None = None, years: set[int] | None = None) -> None:
+        """
+        Replaces the rows of the source in the years (every year when None) with rows, or every row when source
+        is None. Disables the store when it would exceed max_rows.
+
+        Args:
+            rows (pd.DataFrame): periodStartDt, the STORE_CATEGORICALS, emissionTotal, latitude and longitude.
+            source (str, optional): The replaced source. Defaults to every source.
+            years (set[int], optional): The replaced years. Defaults to every year.
+        """
+        if source is None:
+            self.clear()
+            keep = np.empty(0, dtype=bool)
+        else:
+            keep = ~self.mask(sources=[source])
+            if years is not None:
+                keep |= ~np.isin(self.period_start.astype("datetime64[Y]").astype(int) + 1970, list(years))
+        if int(keep.sum()) + len(rows) > self.max_rows:
+            self.disable()
+            return
+        added = pd.to_datetime(rows["periodStartDt"], utc=True).dt.tz_localize(None) if len(rows) else pd.Series([], dtype="datetime64[s]")
+        period_start = np.concatenate([self.period_start[keep], added.to_numpy().astype("datetime64[s]")])
+        order = np.argsort(period_start, kind="stable")
+        self.period_start = period_start[order]
+        for column in STORE_CATEGORICALS:
+            self.codes[column] = self._concat(self.codes[column][keep], self._encode(column, rows), order)
+        self.emission_total = self._concat(self.emission_total[keep], self._numbers(rows, "emissionTotal", np.float64), order)
+        self.latitude = self._concat(self.latitude[keep], self._numbers(rows, "latitude", np.float32), order)
+        self.longitude = self._concat(self.longitude[keep], self._numbers(rows, "longitude", np.float32), order)
+        self.loaded = True
+
+    def mask(
+        self,
+        sources: list[str] | None = None,
+        year_from: int | None = None,
+        year_to: int | None = None,
+        categories: list[str] | None = None,
+    ) -> np.ndarray:
+        """
+        Returns the boolean mask of the rows of the sources, with a periodStartDt in the years [year_from, year_to]
+        and of the categories (None for no filter).
+        """
+        mask = np.zeros(len(self), dtype=bool)
+        start = 0 if year_from is None else np.searchsorted(self.period_start, np.datetime64(f"{year_from}-01-01"))
+        end = len(self) if year_to is None else np.searchsorted(self.period_start, np.datetime64(f"{year_to + 1}-01-01"))
+        mask[start:end] = True
+        for column, values in [("source", sources), ("categoryName", categories)]:
+            if values is not None:
+                codes = [self.value_codes[column][value] for value in values if value in self.value_codes[column]]
+                mask[start:end] &= np.isin(self.codes[column][start:end], codes)
+        return mask
+
+    def distinct(self, column: str) -> list:
+        """Returns the distinct values of a categorical column, None included when there are missing values."""
+        return [self.values[column][code] if code >= 0 else None for code in np.unique(self.codes[column])]
+
+    def totals(self, column: str, mask: np.ndarray) -> pd.DataFrame:
+        """
+        Returns the emissionTotal sum and the mean latitude and longitude (of the rows having them) per value
+        of a categorical column, for the rows of the mask. Rows without a value are left out.
+
+        Returns:
+            pd.DataFrame: column, emissionTotal, latitude, longitude.
+        """
+        codes = self.codes[column][mask]
+        present = codes >= 0
+        codes = codes[present]
+        size = len(self.values[column])
+        totals = np.bincount(codes, weights=self.emission_total[mask][present], minlength=size)
+        rows = np.bincount(codes, minlength=size)
+        means = {}
+        for name, coordinates in [("latitude", self.latitude[mask][present]), ("longitude", self.longitude[mask][present])]:
+            known = ~np.isnan(coordinates)
+            counts = np.bincount(codes[known], minlength=size)
+            sums = np.bincount(codes[known], weights=coordinates[known].astype(np.float64), minlength=size)
+            means[name] = np.divide(sums, counts, out=np.full(size, np.nan), where=counts > 0)
+        found = np.flatnonzero(rows)
+        return pd.DataFrame({
+            column: [self.values[column][code] for code in found],
+            "emissionTotal": totals[found],
+            "latitude": means["latitude"][found],
+            "longitude": means["longitude"][found],
+        })
+
+    def _encode(self, column: str, rows: pd.DataFrame) -> np.ndarray:
+        if not len(rows):
+            return np.empty(0, dtype=np.int32)
+        values = rows[column].where(rows[column].notna(), None)
+        value_codes = self.value_codes[column]
+        for value in values.unique():
+            if value is not None and value not in value_codes:
+                value_codes[value] = len(self.values[column])
+                self.values[column].append(value)
+        return values.map(value_codes).fillna(-1).to_numpy(dtype=np.int32)
+
+    @staticmethod
+    def _numbers(rows: pd.DataFrame, column: str, dtype) -> np.ndarray:
+        if not len(rows):
+            return np.empty(0, dtype=dtype)
+        return pd.to_numeric(rows[column], errors="coerce").to_numpy(dtype=dtype, na_value=np.nan)
+
+    @staticmethod
+    def _concat(kept: np.ndarray, added: np.ndarray, order: np.ndarray) -> np.ndarray:
+        return np.concatenate([kept, added])[order]
@@ -0,0 +1,114 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+from app.emission_data.allocation import RESULT_COLUMNS, AllocationEngine
+
+
+def make_relations():
+    rows = []
+    for site, area, start in [("site-1", 75.0, datetime(2010, 1, 1)), ("site-2", 25.0, datetime(2020, 6, 1))]:
+        for category in ["2.A", "2.A.1"]:
+            rows.append({
+                "uid": f"{site}:{category}",
+                "siteUid": site,
+                "categoryName": category,
+                "categoryLevel": len(category.split(".")),
+                "contributionMagnitudeSector": area,
+                "operationStartDt": start,
+                "manufacturingFacilityArea": area,
+                "sectorIds": "23311",
+                "addressRegionUid": f"region-{site}",
+                "addressSubRegion": f"district-{site}",
+                "longitude": 127.0,
+                "latitude": 37.0,
+            })
+    return pd.DataFrame(rows)
+
+
+def make_totals():
+    rows = []
+    for year in [2020, 2021]:
+        period = {"year": year, "periodStartDt": datetime(year, 1, 1), "periodEndDt": datetime(year, 12, 31), "periodLength": "1Y"}
+        rows.append({**period, "source": "orig:gir-db4", "categoryName": "2.A.1", "categoryUid": "code-2.A.1", "pollutantId": "CO2", "emissionTotal": 100.0})
+        rows.append({**period, "source": "orig:gir-db4", "categoryName": "2.A.1", "categoryUid": "code-2.A.1", "pollutantId": "CH4", "emissionTotal": 10.0})
+        rows.append({**period, "source": "orig:gir-db1", "categoryName": "2.A", "categoryUid": "code-2.A", "pollutantId": "CO2eq", "emissionTotal": 10.0})
+    return pd.DataFrame(rows)
+
+
+def totals_by(result: pd.DataFrame):
+    return {
+        (row.siteUid, row.categoryName, row.pollutantId, row.periodStartDt.year): row.emissionTotal
+        for row in result.itertuples()
+    }
+
+
+def test_allocate_single_year_only_operating_sites():
+    engine = AllocationEngine(make_relations(), make_totals())
+    result = engine.allocate(years=[2020])
+    assert list(result.columns) == RESULT_COLUMNS
+    # site-2 starts operating after Jan 1st 2020 and gets nothing
+    assert totals_by(result) == {
+        ("site-1", "2.A.1", "CO2", 2020): 100.0,
+        ("site-1", "2.A.1", "CH4", 2020): 10.0,
+        ("site-1", "2.A", "CO2eq", 2020): 10.0,
+    }
+    row = result[result["pollutantId"] == "CO2"].iloc[0]
+    assert row["source"] == "calc:gir-db4"
+    assert row["categoryUid"] == "code-2.A.1"
+    assert row["categoryRelUid"] == "site-1:2.A.1"
+    assert row["regionUid"] == "region-site-1"
+    assert row["regionName"] == "district-site-1"
+
+
+def test_allocate_multiple_years():
+    engine = AllocationEngine(make_relations(), make_totals())
+    result = totals_by(engine.allocate(years=[2020, 2021], pollutants=["CO2"]))
+    assert result == {
+        ("site-1", "2.A.1", "CO2", 2020): 100.0,
+        ("site-1", "2.A.1", "CO2", 2021): pytest.approx(75.0),
+        ("site-2", "2.A.1", "CO2", 2021): pytest.approx(25.0),
+    }
+
+
+def test_allocate_with_proxy_override():
+    engine = AllocationEngine(make_relations(), make_totals())
+    result = totals_by(engine.allocate(years=[2021], overrides={"site-2": {"manufacturingFacilityArea": 75.0}}, pollutants=["CO2eq"]))
+    assert result == {
+        ("site-1", "2.A", "CO2eq", 2021): pytest.approx(5.0),
+        ("site-2", "2.A", "CO2eq", 2021): pytest.approx(5.0),
+    }
+    # Overrides do not modify the loaded relations
+    assert totals_by(engine.allocate(years=[2021], pollutants=["CO2eq"]))[("site-2", "2.A", "CO2eq", 2021)] == pytest.approx(2.5)
+
+
+def test_allocate_override_to_zero_removes_site():
+    engine = AllocationEngine(make_relations(), make_totals())
+    result = totals_by(engine.allocate(years=[2021], overrides={"site-1": {"manufacturingFacilityArea": 0}}, pollutants=["CO2"]))
+    assert result == {("site-2", "2.A.1", "CO2", 2021): pytest.approx(100.0)}
+
+
+def test_allocate_override_splits_proxy_between_sectors():
+    relations = make_relations()
+    relations.loc[relations["siteUid"] == "site-2", "sectorIds"] = "23311, 24111"
+    engine = AllocationEngine(relations, make_totals())
+    contributions = engine.contributions({"site-2": {"manufacturingFacilityArea": 50.0}})
+    assert list(contributions) == [75.0, 75.0, 25.0, 25.0]
+
+
+def test_allocate_unknown_override_field():
+    engine = AllocationEngine(make_relations(), make_totals())
+    with pytest.raises(ValueError):
+        engine.allocate(years=[2020], overrides={"site-1": {"landArea": 10}})
+
+
+def test_allocate_unknown_site():
+    engine = AllocationEngine(make_relations(), make_totals())
+    with pytest.raises(ValueError, match="site-9"):
+        engine.allocate(years=[2020], overrides={"site-9": {"manufacturingFacilityArea": 10}})
+
+
+def test_allocate_without_totals():
+    engine = AllocationEngine(make_relations(), make_totals())
+    result = engine.allocate(years=[2019])
+    assert result.empty
+    assert list(result.columns) == RESULT_COLUMNS
@@ -0,0 +1,63 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+from app.emission_data.distribution import DISTRIBUTED_FIELDS, distribute_org_emissions, normalize_org_totals
+
+
+def make_sites():
+    return pd.DataFrame([
+        {"uid": "site-1", "organizationUid": "org-1", "manufacturingFacilityArea": 30.0, "longitude": 127.0, "latitude": 37.0, "addressRegionUid": "r-1", "addressRegionName": "Seoul"},
+        {"uid": "site-2", "organizationUid": "org-1", "manufacturingFacilityArea": 10.0, "longitude": 128.0, "latitude": 36.0, "addressRegionUid": "r-2", "addressRegionName": "Busan"},
+        {"uid": "site-3", "organizationUid": "org-1", "manufacturingFacilityArea": None, "longitude": None, "latitude": None, "addressRegionUid": None, "addressRegionName": None},
+        {"uid": "site-4", "organizationUid": "org-2", "manufacturingFacilityArea": 0.0, "longitude": None, "latitude": None, "addressRegionUid": None, "addressRegionName": None},
+    ])
+
+
+def make_totals():
+    return normalize_org_totals(pd.DataFrame([
+        {"organizationUid": "org-1", "source": "orig:gir-ets", "periodStartDt": datetime(2022, 1, 1), "emissionTotal": 100.0, "emissionScope1": 60.0, "emissionScope2": 40.0, "energyTotal": 8.0},
+        {"organizationUid": "org-2", "source": "orig:gir-ets", "periodStartDt": datetime(2022, 1, 1), "emissionTotal": 50.0},
+        {"organizationUid": "org-3", "source": "orig:gir-ets", "periodStartDt": datetime(2022, 1, 1), "emissionTotal": 10.0},
+    ]))
+
+
+def test_normalize_org_totals():
+    totals = make_totals()
+    assert totals.loc[0, "emissionDirect"] == 60.0
+    assert totals.loc[1, "emissionDirect"] == 0.0
+    assert totals.loc[0, "periodEndDt"] == pd.Timestamp(2023, 1, 1)
+    assert set(totals["periodLength"]) == {"1Y"}
+    assert set(totals["pollutantId"]) == {"tCO2eq"}
+
+
+def test_distribute_org_emissions_by_area():
+    rows = distribute_org_emissions(make_totals(), make_sites()).set_index("siteUid")
+    assert rows.loc["site-1", "emissionTotal"] == pytest.approx(75.0)
+    assert rows.loc["site-2", "emissionTotal"] == pytest.approx(25.0)
+    assert rows.loc["site-1", "emissionDirect"] == pytest.approx(45.0)
+    assert rows.loc["site-2", "emissionIndirect"] == pytest.approx(10.0)
+    assert rows.loc["site-1", "energyTotal"] == pytest.approx(6.0)
+    assert rows.loc["site-2", "regionUid"] == "r-2"
+    # Sites without area, and organizations without any area, get nothing
+    assert rows.loc["site-3", DISTRIBUTED_FIELDS].sum() == 0
+    assert rows.loc["site-4", DISTRIBUTED_FIELDS].sum() == 0
+    # Organizations without sites are not distributed
+    assert set(rows["organizationUid"]) == {"org-1", "org-2"}
+
+
+def test_distribute_org_emissions_without_sites():
+    rows = distribute_org_emissions(make_totals(), make_sites().iloc[0:0])
+    assert rows.empty
+    assert "emissionTotal" in rows
+
+
+def test_normalize_org_totals_keeps_missing_fields():
+    totals = normalize_org_totals(pd.DataFrame([
+        {"organizationUid": "org-1", "source": "orig:gir-ets", "periodStartDt": datetime(2022, 1, 1), "emissionTotal": 100.0},
+    ]), pollutant_id=None, fill_value=None)
+    assert totals.loc[0, "emissionTotal"] == 100.0
+    assert totals[["emissionDirect", "energyTotal"]].isna().all(axis=None)
+    assert totals.loc[0, "pollutantId"] is None
+    rows = distribute_org_emissions(totals, make_sites()).set_index("siteUid")
+    assert rows.loc["site-1", "emissionTotal"] == pytest.approx(75.0)
+    assert rows["emissionDirect"].isna().all()
@@ -0,0 +1,45 @@
+import pandas as pd
+import pytest
+from app.emission_data.grid import DEFAULT_GRID_RESOLUTION, bin_grid, grid_resolution
+
+
+def test_grid_resolution():
+    assert grid_resolution() == DEFAULT_GRID_RESOLUTION
+    assert grid_resolution(resolution=0.1) == 0.125
+    assert grid_resolution(resolution=0.125) == 0.125
+    assert grid_resolution(resolution=5) == 1
+    assert grid_resolution(resolution=0.0001) == 2.0**-7
+    assert grid_resolution(zoom=7) == 0.125
+    with pytest.raises(ValueError):
+        grid_resolution(resolution=0)
+
+
+def test_bin_grid():
+    cells = pd.DataFrame([
+        {"row": 296, "column": 1016, "emissionTotal": 1.0, "rowCount": 1},
+        {"row": 297, "column": 1017, "emissionTotal": 2.0, "rowCount": 3},
+        {"row": -1, "column": 0, "emissionTotal": 4.0, "rowCount": 1},
+    ])
+    grid = bin_grid(cells, 0.125)
+    assert grid["resolution"] == 0.125
+    assert grid["latitude"] == [-0.0625, 37.0625, 37.1875]
+    assert grid["longitude"] == [0.0625, 127.0625, 127.1875]
+    assert grid["emissionTotal"] == [4.0, 1.0, 2.0]
+
+
+def test_bin_grid_coarsens_to_max_cells():
+    cells = pd.DataFrame([
+        {"row": 296, "column": 1016, "emissionTotal": 1.0, "rowCount": 1},
+        {"row": 297, "column": 1017, "emissionTotal": 2.0, "rowCount": 3},
+        {"row": 0, "column": 0, "emissionTotal": 4.0, "rowCount": 1},
+    ])
+    grid = bin_grid(cells, 0.125, max_cells=2)
+    assert grid["resolution"] == 0.25
+    assert grid["latitude"] == [0.125, 37.125]
+    assert grid["emissionTotal"] == [4.0, 3.0]
+    assert grid["rowCount"] == [1, 4]
+
+
+def test_bin_grid_without_cells():
+    grid = bin_grid(pd.DataFrame(), 0.125)
+    assert grid["latitude"] == [] and grid["emissionTotal"] == []
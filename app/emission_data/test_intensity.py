@@ -0,0 +1,49 @@
+from datetime import datetime
+import pandas as pd
+import pytest
+from app.emission_data.intensity import INTENSITY_SOURCE, estimate_site_emissions, site_intensity_categories
+
+INTENSITIES = {"2.A": {"per_capita": 2.0, "per_sqrmt": 0.5}, "2.C": {"per_capita": 3.0, "per_sqrmt": 0.1}}
+
+
+def make_sites():
+    site = {"organizationUid": "org-1", "longitude": 127.0, "latitude": 37.0, "addressRegionUid": "r-1", "addressRegionName": "Seoul"}
+    return pd.DataFrame([
+        {**site, "uid": "area", "sectorIds": "23311", "sectorIdMain": "23311", "manufacturingFacilityArea": 100.0, "numEmployeesTotal": 10},
+        {**site, "uid": "employees", "sectorIds": None, "sectorIdMain": "24111", "manufacturingFacilityArea": 0.0, "numEmployeesTotal": 10},
+        {**site, "uid": "two-sectors", "sectorIds": "23311, 24113", "sectorIdMain": "23311", "manufacturingFacilityArea": 100.0, "numEmployeesTotal": None},
+        {**site, "uid": "unmapped", "sectorIds": "99999", "sectorIdMain": "99999", "manufacturingFacilityArea": 100.0, "numEmployeesTotal": 10},
+        {**site, "uid": "no-proxy", "sectorIds": "23311", "sectorIdMain": "23311", "manufacturingFacilityArea": None, "numEmployeesTotal": 0},
+    ])
+
+
+def test_site_intensity_categories():
+    categories = site_intensity_categories(make_sites(), INTENSITIES)
+    shares = {(row.siteUid, row.categoryName): row.share for row in categories.itertuples()}
+    assert shares == {
+        ("area", "2.A"): 1.0,
+        ("employees", "2.C"): 1.0,
+        ("two-sectors", "2.A"): 0.5,
+        ("two-sectors", "2.C"): 0.5,
+        ("no-proxy", "2.A"): 1.0,
+    }
+
+
+def test_estimate_site_emissions():
+    estimates = estimate_site_emissions(make_sites(), 2021, INTENSITIES)
+    totals = {(row.siteUid, row.categoryName): (row.emissionTotal, row.basis) for row in estimates.itertuples()}
+    assert totals == {
+        ("area", "2.A"): (pytest.approx(50.0), "per_sqrmt"),
+        ("employees", "2.C"): (pytest.approx(30.0), "per_capita"),
+        ("two-sectors", "2.A"): (pytest.approx(25.0), "per_sqrmt"),
+        ("two-sectors", "2.C"): (pytest.approx(5.0), "per_sqrmt"),
+    }
+    assert set(estimates["source"]) == {INTENSITY_SOURCE}
+    assert set(estimates["periodStartDt"]) == {datetime(2021, 1, 1)}
+    assert set(estimates["regionUid"]) == {"r-1"}
+
+
+def test_estimate_site_emissions_without_sites():
+    estimates = estimate_site_emissions(make_sites().iloc[0:0], 2021, INTENSITIES)
+    assert estimates.empty
+    assert "emissionTotal" in estimates
@@ -0,0 +1,44 @@
+import json
+import pytest
+from app.emission_data.queries import cube_query, emission_time_series, top_emitters_query
+
+
+def test_cube_query_rolls_up_the_dimensions():
+    query, args = cube_query(["year", "categoryName"], {"source": "calc:gir-db4", "year": [2020, 2021]})
+    assert 'c."year", NULLIF(c."categoryName", \'\') AS "categoryName"' in query
+    assert 'GROUP BY c."year", c."categoryName"' in query
+    assert 'c."source" IN (SELECT jsonb_array_elements_text($1::jsonb))' in query
+    assert 'c."year" IN (SELECT jsonb_array_elements_text($2::jsonb)::int)' in query
+    assert [json.loads(arg) for arg in args] == [["calc:gir-db4"], ["2020", "2021"]]
+
+
+def test_cube_query_grand_total():
+    query, args = cube_query([])
+    assert "GROUP BY" not in query and "WHERE" not in query
+    assert args == []
+
+
+def test_cube_query_rejects_unknown_dimensions():
+    with pytest.raises(ValueError):
+        cube_query(["siteUid"])
+    with pytest.raises(ValueError):
+        cube_query(["year"], {"emissionTotal": 1})
+
+
+def test_emission_time_series_deltas():
+    assert "LAG" not in emission_time_series(deltas=False)
+    query = emission_time_series(by_region=False, deltas=True)
+    assert 'WINDOW w AS (PARTITION BY t."source", t."categoryName" ORDER BY t."year")' in query
+    assert "regionUid" not in query
+
+
+def test_top_emitters_query():
+    query = " ".join(top_emitters_query("sites", by_region=True).split())
+    assert 'FROM "IEmissionSiteTotal" t' in query
+    assert 't."regionName" = $4' in query
+    assert "LIMIT $5::int" in query
+    query = " ".join(top_emitters_query("organizations").split())
+    assert 'FROM "IEmissionOrgTotal" t' in query
+    assert "$5" not in query and "LIMIT $4::int" in query
+    with pytest.raises(ValueError):
+        top_emitters_query("regions")
@@ -1,9 +1,16 @@
+import json
+import os
 import pytest
+import pytest_asyncio
 from datetime import datetime
 from dateutil.relativedelta import relativedelta
-from app.emission_data.service import IEmissionDataService
+from app.emission_data.queries import MARK_CALCULATION_DIRTY_GROUPS
+from app.emission_data.service import IEmissionDataService, cache_tags, category_names, emission_cache, pending_summaries, published_only, years_within
+from app.foundation.jobs import job_runner
 from pytest_mock import mocker
 import prisma
+from app.database import get_connection
+from app.config.env_config import ENV_IS_GITHUB
 
 # Test case 1: No sites
 @pytest.mark.asyncio
@@ -24,6 +31,7 @@ async def test_create_org_emission_no_sites(mocker):
     model_data = prisma.models.IOrganization.model_construct(**{"uid": "org_uid", "sites": []})
     mocker.patch("app.emission_data.service.IEmissionDataService.create")
     mocker.patch("app.emission_data.service.IEmissionDataService.update_or_create")
+    mocker.patch("app.emission_data.service.IEmissionDataService.refresh_summaries")
     mocker.patch("prisma.client.actions.IOrganizationActions.find_first", return_value=model_data)
     await service.create_org_emission(data)
     prisma.client.actions.IOrganizationActions.find_first.assert_called_once()
@@ -73,6 +81,7 @@ async def test_create_org_emission_one_site_zero_area(mocker):
     model_data = prisma.models.IOrganization.model_construct(**{"uid": "org_uid", "sites": [site]})
     mocker.patch("app.emission_data.service.IEmissionDataService.create")
     mocker.patch("app.emission_data.service.IEmissionDataService.update_or_create")
+    mocker.patch("app.emission_data.service.IEmissionDataService.refresh_summaries")
     mocker.patch("prisma.client.actions.IOrganizationActions.find_first", return_value=model_data)
     return_value = await service.create_org_emission(data)
     prisma.client.actions.IOrganizationActions.find_first.assert_called_once()
@@ -153,8 +162,484 @@ async def test_create_org_emission_one_site_non_zero_area(mocker):
     model_data = prisma.models.IOrganization.model_construct(**{"uid": "org_uid", "sites": [site_1, site_2]})
     mocker.patch("app.emission_data.service.IEmissionDataService.create")
     mocker.patch("app.emission_data.service.IEmissionDataService.update_or_create")
+    mocker.patch("app.emission_data.service.IEmissionDataService.refresh_summaries")
     mocker.patch("prisma.client.actions.IOrganizationActions.find_first", return_value=model_data)
     await service.create_org_emission(data)
     prisma.client.actions.IOrganizationActions.find_first.assert_called_once()
     call_args = [kwargs['data'] for args, kwargs in service.create.call_args_list]
     assert call_args == expected_data
+
+
+@pytest_asyncio.fixture
+async def calculation_db():
+    test_db_url = os.getenv("TEST_DATABASE_URL")
+    pytest.MonkeyPatch().setenv("DATABASE_URL", test_db_url)
+    db_connection = get_connection()
+    await db_connection.connect()
+    sites = []
+    for index, area in enumerate([75.0, 25.0]):
+        sites.append(await db_connection.iorgsite.create(data={
+            "companyName": f"calc-parity-{index}",
+            "factoryManagementNumber": f"calc-parity-{index}",
+            "landAddress": f"calc-parity-{index}",
+            "dataSource": "test",
+            "keyHash": f"calc-parity-{index}",
+            "manufacturingFacilityArea": area,
+            "operationStartDt": datetime(2010, 1, 1),
+        }))
+        for category in ["2.A", "2.A.1"]:
+            await db_connection.isitecategoryrel.create(data={
+                "siteUid": sites[-1].uid,
+                "sectorId": "23311",
+                "categoryName": category,
+                "categoryLevel": len(category.split(".")),
+                "contributionMagnitudeSector": area,
+            })
+    period = {"periodStartDt": datetime(2020, 1, 1), "periodEndDt": datetime(2020, 12, 31), "periodLength": "1Y"}
+    await db_connection.iemissiondata.create(data={**period, "categoryName": "2.A.1", "pollutantId": "CO2", "source": "orig:gir-db4", "emissionTotal": 100})
+    await db_connection.iemissiondata.create(data={**period, "categoryName": "2.A", "pollutantId": "CO2eq", "source": "orig:gir-db1", "regionName": "a", "emissionTotal": 4000})
+    await db_connection.iemissiondata.create(data={**period, "categoryName": "2.A", "pollutantId": "CO2eq", "source": "orig:gir-db1", "regionName": "b", "emissionTotal": 6000})
+    yield db_connection
+    await db_connection.iemissiondata.delete_many(where={"source": {"in": ["orig:gir-db4", "orig:gir-db1", "calc:gir-db4", "calc:gir-db1"]}})
+    await db_connection.isitecategoryrel.delete_many(where={"siteUid": {"in": [site.uid for site in sites]}})
+    await db_connection.iorgsite.delete_many(where={"uid": {"in": [site.uid for site in sites]}})
+    await db_connection.iemissioncalcdirty.delete_many()
+    await db_connection.iemissioncategoryrollup.delete_many()
+    await db_connection.iemissionregionrollup.delete_many()
+    await db_connection.iemissioncube.delete_many()
+    await db_connection.iemissionsitetotal.delete_many()
+    await db_connection.iemissionorgtotal.delete_many()
+    await db_connection.iemissioncalcrun.delete_many()
+    await db_connection.disconnect()
+
+
+async def _calc_rows(db_connection):
+    rows = await db_connection.iemissiondata.find_many(
+        where={"source": {"in": ["calc:gir-db4", "calc:gir-db1"]}, "calcRun": {"is": {"isActive": True}}},
+        order=[{"categoryRelUid": "asc"}, {"source": "asc"}],
+    )
+    fields = ["categoryName", "categoryUid", "periodStartDt", "periodEndDt", "periodLength", "source", "regionUid",
+              "regionName", "siteUid", "pollutantId", "longitude", "latitude", "categoryRelUid"]
+    return [({field: getattr(row, field) for field in fields}, row.emissionTotal) for row in rows]
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_calculate_emissions_set_based_matches_reference(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020, mode="reference")
+    reference_rows = await _calc_rows(calculation_db)
+    await calculation_db.iemissiondata.delete_many(where={"source": {"in": ["calc:gir-db4", "calc:gir-db1"]}})
+
+    await service.calculate_emissions(year=2020, mode="set")
+    set_based_rows = await _calc_rows(calculation_db)
+
+    assert len(reference_rows) == 4
+    assert [fields for fields, _ in set_based_rows] == [fields for fields, _ in reference_rows]
+    assert [total for _, total in set_based_rows] == pytest.approx([total for _, total in reference_rows])
+    assert sorted(total for _, total in set_based_rows) == pytest.approx([2.5, 7.5, 25, 75])
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_calculate_emissions_set_based_is_idempotent(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    first_run = await _calc_rows(calculation_db)
+    await service.calculate_emissions(year=2020)
+    assert await _calc_rows(calculation_db) == first_run
+
+
+@pytest.mark.asyncio
+async def test_calculate_emissions_unknown_mode():
+    service = IEmissionDataService()
+    with pytest.raises(ValueError):
+        await service.calculate_emissions(year=2020, mode="unknown")
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_calculate_emissions_incremental_recomputes_dirty_categories(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    before = await _calc_rows(calculation_db)
+
+    site_uid = before[0][0]["siteUid"]
+    await calculation_db.isitecategoryrel.update_many(
+        where={"siteUid": site_uid, "categoryName": "2.A.1"}, data={"contributionMagnitudeSector": 0}
+    )
+    assert await service.mark_dirty(["2.A.1"], years=[2020], reason="test") == 1
+    assert await service.calculate_emissions(year=2020, mode="incremental") == 2
+    assert await calculation_db.iemissioncalcdirty.count() == 0
+    # Written into a new run, published once complete
+    runs = await service.fetch_calc_runs(year=2020)
+    assert [(run.mode, run.status) for run in runs] == [("incremental", "published"), ("set", "archived")]
+
+    after = {(fields["siteUid"], fields["categoryName"]): total for fields, total in await _calc_rows(calculation_db)}
+    assert after[(site_uid, "2.A.1")] == 0
+    # The other category was not dirty and is left untouched
+    assert after[(site_uid, "2.A")] == pytest.approx(
+        {(fields["siteUid"], fields["categoryName"]): total for fields, total in before}[(site_uid, "2.A")]
+    )
+    # Nothing dirty, nothing to do
+    assert await service.calculate_emissions(year=2020, mode="incremental") == 0
+
+
+@pytest.mark.asyncio
+async def test_mark_gir_rows_dirty(mocker):
+    service = IEmissionDataService()
+    mocker.patch.object(service.prisma, "execute_raw")
+    await service.mark_gir_rows_dirty([
+        {"source": "orig:gir-db4", "categoryName": "2.A.1", "periodStartDt": datetime(2020, 1, 1)},
+        {"source": "orig:gir-db4", "categoryName": "2.A.2", "periodStartDt": "2020-01-01"},
+        {"source": "orig:gir-db1", "categoryName": "2.A", "periodStartDt": datetime(2021, 1, 1)},
+        {"source": "orig:gir-db1", "categoryName": "2.A.1", "periodStartDt": datetime(2020, 1, 1)},
+        {"source": "calc:gir-db4", "categoryName": "2.A.1", "periodStartDt": datetime(2020, 1, 1)},
+        {"source": "orig:gir-db4", "categoryName": None, "periodStartDt": datetime(2020, 1, 1)},
+    ])
+    # A single statement, one mark per (categoryName, year)
+    [(query, groups)] = [call.args for call in service.prisma.execute_raw.call_args_list]
+    assert query == MARK_CALCULATION_DIRTY_GROUPS
+    assert json.loads(groups) == [
+        {"categoryName": "2.A", "year": 2021, "reason": "orig:gir-db1"},
+        {"categoryName": "2.A.1", "year": 2020, "reason": "orig:gir-db4"},
+        {"categoryName": "2.A.2", "year": 2020, "reason": "orig:gir-db4"},
+    ]
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_calculate_emissions_incremental_keeps_marks_made_during_the_run(calculation_db, mocker):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    await service.mark_dirty(["2.A.1"], years=[2020], reason="test")
+    publish_calc_run = service.publish_calc_run
+
+    async def mark_and_publish(*args, **kwargs):
+        await service.mark_dirty(["2.A.1"], years=[2020], reason="written during the run")
+        return await publish_calc_run(*args, **kwargs)
+
+    mocker.patch.object(service, "publish_calc_run", side_effect=mark_and_publish)
+    await service.calculate_emissions(year=2020, mode="incremental")
+    [dirty] = await calculation_db.iemissioncalcdirty.find_many()
+    assert (dirty.categoryName, dirty.version, dirty.reason) == ("2.A.1", 2, "written during the run")
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_calculate_emissions_incremental_refreshes_the_dirty_categories_only(calculation_db):
+    service = IEmissionDataService()
+
+    async def summaries():
+        cube = await calculation_db.iemissioncube.find_many(where={"year": 2020})
+        rollups = await calculation_db.iemissionregionrollup.find_many(where={"year": 2020})
+        return (
+            sorted((row.source, row.categoryName, row.regionUid, row.emissionTotal) for row in cube),
+            sorted((row.source, row.categoryName, row.regionLevel, row.regionUid, row.emissionTotal) for row in rollups),
+        )
+
+    await service.calculate_emissions(year=2020)
+    await service.mark_dirty(["2.A.1"], years=[2020], reason="test")
+    await service.calculate_emissions(year=2020, mode="incremental")
+    incremental = await summaries()
+    await service.refresh_region_rollups(2020)
+    await service.refresh_summaries(2020, 2020)
+    assert incremental == await summaries()
+
+
+def test_invalidate_cached_rows():
+    service = IEmissionDataService()
+    emission_cache.set("2020", 1, tags=cache_tags(["orig:gir-db1"], [2020]))
+    emission_cache.set("2021", 2, tags=cache_tags(["orig:gir-db1"], [2021]))
+    assert service.invalidate_cached_rows([{"source": "orig:gir-db1", "periodStartDt": "2020-01-01"}]) == 1
+    assert emission_cache.get("2021") == (True, 2)
+    assert service.invalidate_cached_rows([{"categoryName": "2.A"}]) == 1
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_calculation_runs_publish_and_rollback(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    first_run = (await service.fetch_calc_runs(year=2020))[0]
+    first_rows = await _calc_rows(calculation_db)
+
+    await calculation_db.isitecategoryrel.update_many(
+        where={"categoryName": "2.A.1", "contributionMagnitudeSector": 25}, data={"contributionMagnitudeSector": 75}
+    )
+    await service.calculate_emissions(year=2020)
+    runs = await service.fetch_calc_runs(year=2020)
+    second_run = runs[0]
+    assert [(run.status, run.isActive) for run in runs] == [("published", True), ("archived", False)]
+    assert sorted(total for fields, total in await _calc_rows(calculation_db) if fields["categoryName"] == "2.A.1") == pytest.approx([50, 50])
+    # Archived rows are kept but not served
+    assert await service.fetch_count(where={"source": "calc:gir-db4"}) == 2
+    assert await calculation_db.iemissiondata.count(where={"source": "calc:gir-db4"}) == 4
+
+    diff = {(row["categoryName"], row["source"]): row for row in await service.diff_calc_runs(first_run.uid, second_run.uid)}
+    assert diff[("2.A.1", "calc:gir-db4")]["delta"] == pytest.approx(0)
+    assert diff[("2.A.1", "calc:gir-db4")]["comparedRows"] == 2
+
+    rolled_back = await service.rollback_calc_run(2020)
+    assert rolled_back.uid == first_run.uid and rolled_back.isActive
+    assert await _calc_rows(calculation_db) == first_rows
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_expire_calc_runs(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    await service.calculate_emissions(year=2020)
+    assert await service.expire_calc_runs(2020, keep=0) == 4
+    runs = await service.fetch_calc_runs(year=2020)
+    assert [run.status for run in runs] == ["published", "expired"]
+    assert await calculation_db.iemissiondata.count(where={"calcRunUid": runs[1].uid}) == 0
+    assert await service.fetch_count(where={"source": "calc:gir-db4"}) == 2
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_published_only_serves_rows_without_run(calculation_db):
+    service = IEmissionDataService()
+    period = {"periodStartDt": datetime(2019, 1, 1), "periodEndDt": datetime(2019, 12, 31), "periodLength": "1Y"}
+    await calculation_db.iemissiondata.create(data={**period, "categoryName": "2.A.1", "source": "calc:gir-db4", "emissionTotal": 1})
+    staging = await calculation_db.iemissioncalcrun.create(data={"year": 2019, "mode": "set"})
+    await calculation_db.iemissiondata.create(
+        data={**period, "categoryName": "2.A", "source": "calc:gir-db4", "emissionTotal": 2, "calcRunUid": staging.uid}
+    )
+    rows = await service.fetch_many(where={"source": "calc:gir-db4"})
+    assert [(row.categoryName, row.calcRunUid) for row in rows] == [("2.A.1", None)]
+    assert await service.fetch_count(where={"source": "calc:gir-db4"}) == 1
+
+
+def test_published_only():
+    assert published_only(None) == {"NOT": {"calcRun": {"is": {"isActive": False}}}}
+    assert published_only({"source": "calc:gir-db4", "NOT": {"regionUid": None}}) == {
+        "source": "calc:gir-db4",
+        "NOT": [{"regionUid": None}, {"calcRun": {"is": {"isActive": False}}}],
+    }
+
+
+def test_category_names():
+    assert category_names({}) is None
+    assert category_names({"categoryName": "2.A"}) == ["2.A"]
+    assert category_names({"categoryName": {"in": ["2.A", "2.B"]}}) == ["2.A", "2.B"]
+    with pytest.raises(ValueError):
+        category_names({"categoryName": {"contains": "2."}})
+
+
+def test_years_within():
+    assert years_within(datetime(2019, 1, 1), datetime(2020, 1, 1)) == [2019]
+    assert years_within(datetime(2019, 1, 1), datetime(2021, 12, 31)) == [2019, 2020, 2021]
+    assert years_within(datetime(2019, 6, 1), datetime(2020, 1, 1)) == []
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_map_data_is_read_from_region_rollups(calculation_db):
+    service = IEmissionDataService()
+    province = await calculation_db.region.create(data={"createdByUid": "test", "type": "province", "id": "kr-test", "name": "test-province", "latitude": 37.0, "longitude": 127.0})
+    district = await calculation_db.region.create(data={"createdByUid": "test", "type": "district", "id": "kr-test-1", "name": "test-district", "parentUid": province.uid, "latitude": 37.5, "longitude": 127.5})
+    await calculation_db.iorgsite.update_many(where={"companyName": {"startswith": "calc-parity-"}}, data={"addressRegionUid": district.uid})
+    try:
+        await service.calculate_emissions(year=2020)
+        rollups = await calculation_db.iemissionregionrollup.find_many(where={"year": 2020, "source": "calc:gir-db4"})
+        assert {(rollup.regionLevel, rollup.regionUid) for rollup in rollups} == {("district", district.uid), ("province", province.uid)}
+        assert [rollup.emissionTotal for rollup in rollups] == pytest.approx([100, 100])
+
+        map_data = await service.fetch_grouped_by_region("2020-01-01", "2021-01-01", region_level="province")
+        assert [row["regionUid"] for row in map_data["gir4Calc"]] == [province.uid]
+        assert sorted(row["regionName"] for row in map_data["gir1"]) == ["a", "b"]
+        live_data = await service.fetch_grouped_by_region("2020-01-01", "2021-01-01", region_level="province", live=True)
+        assert [row["regionUid"] for row in live_data["gir4Calc"]] == [province.uid]
+        assert live_data["gir4Calc"][0]["emissionTotal"] == pytest.approx(map_data["gir4Calc"][0]["emissionTotal"])
+    finally:
+        await calculation_db.iorgsite.update_many(where={"addressRegionUid": district.uid}, data={"addressRegionUid": None})
+        await calculation_db.region.delete(where={"uid": district.uid})
+        await calculation_db.region.delete(where={"uid": province.uid})
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_fetch_time_series(calculation_db):
+    service = IEmissionDataService()
+    period = {"periodStartDt": datetime(2021, 1, 1), "periodEndDt": datetime(2021, 12, 31), "periodLength": "1Y"}
+    await calculation_db.iemissiondata.create(data={**period, "categoryName": "2.A", "pollutantId": "CO2eq", "source": "orig:gir-db1", "regionName": "a", "emissionTotal": 5000})
+    series = await service.fetch_time_series(2020, 2021, sources=["orig:gir-db1"], categories=["2.A"], deltas=True)
+    assert series["year"] == [2020, 2021, 2020]
+    assert series["regionName"] == ["a", "a", "b"]
+    assert series["emissionTotal"] == pytest.approx([4, 5, 6])
+    assert series["delta"][0] is None
+    assert series["delta"][1] == pytest.approx(1)
+    totals = await service.fetch_time_series(2020, 2021, sources=["orig:gir-db1"], by_region=False)
+    assert totals["emissionTotal"] == pytest.approx([10, 5])
+    assert "regionName" not in totals
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_aggregate(calculation_db):
+    service = IEmissionDataService()
+    result = await service.aggregate(
+        dimensions=["periodStartDt:year", "regionName"],
+        measures=["sum:emissionTotal", "count"],
+        filters={"source": {"in": ["orig:gir-db1"]}},
+        order=["regionName:desc"],
+    )
+    assert result["periodStartDt:year"] == [2020, 2020]
+    assert result["regionName"] == ["b", "a"]
+    assert sum(result["sum:emissionTotal"]) == pytest.approx(10000)
+    assert result["count"] == [1, 1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_cube_is_maintained_and_sliced(calculation_db):
+    service = IEmissionDataService()
+    await service.refresh_cube(2020, 2020, ["orig:gir-db1", "orig:gir-db4"])
+    await service.calculate_emissions(year=2020)
+    by_source = await service.fetch_cube(["source"], {"year": 2020})
+    totals = dict(zip(by_source["source"], by_source["emissionTotal"]))
+    assert totals["orig:gir-db1"] == pytest.approx(10000)
+    assert totals["calc:gir-db4"] == pytest.approx(100)
+    drill_down = await service.fetch_cube(["source", "regionName"], {"source": "orig:gir-db1"})
+    assert drill_down["regionName"] == ["a", "b"]
+    assert drill_down["rowCount"] == [1, 1]
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_top_emitters(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    top = await service.fetch_top_emitters("sites", 2020, category_name="2.A.1")
+    assert [row["name"] for row in top] == ["calc-parity-0", "calc-parity-1"]
+    assert [row["rank"] for row in top] == [1, 2]
+    assert top[0]["emissionTotal"] == pytest.approx(3 * top[1]["emissionTotal"])
+    assert len(await service.fetch_top_emitters("sites", 2020, category_name="2.A.1", limit=1)) == 1
+    assert await service.fetch_top_emitters("sites", 2020, region_name="none") == []
+    with pytest.raises(ValueError):
+        await service.fetch_top_emitters("sites", 2020, limit=0)
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_top_emitters_are_in_the_province_of_their_district(calculation_db):
+    service = IEmissionDataService()
+    province = await calculation_db.region.create(data={"createdByUid": "test", "type": "province", "id": "kr-test", "name": "test-province", "latitude": 37.0, "longitude": 127.0})
+    district = await calculation_db.region.create(data={"createdByUid": "test", "type": "district", "id": "kr-test-1", "name": "test-district", "parentUid": province.uid, "latitude": 37.5, "longitude": 127.5})
+    await calculation_db.iorgsite.update_many(
+        where={"companyName": {"startswith": "calc-parity-"}},
+        data={"addressRegionUid": district.uid, "addressRegionName": province.name},
+    )
+    try:
+        await service.calculate_emissions(year=2020)
+        top = await service.fetch_top_emitters("sites", 2020, region_name=province.name)
+        assert {(row["regionUid"], row["regionName"]) for row in top} == {(province.uid, province.name)}
+    finally:
+        await calculation_db.iorgsite.update_many(where={"addressRegionUid": district.uid}, data={"addressRegionUid": None, "addressRegionName": None})
+        await calculation_db.region.delete(where={"uid": district.uid})
+        await calculation_db.region.delete(where={"uid": province.uid})
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_purge_emissions_in_batches(calculation_db):
+    service = IEmissionDataService()
+    await service.calculate_emissions(year=2020)
+    stats = await service.purge_emissions("calc:gir-db4", date_from=datetime(2020, 1, 1), date_to=datetime(2020, 12, 31), batch_size=1)
+    assert stats["sources"] == ["calc:gir-db4"]
+    assert stats["deleted"] == 2
+    assert stats["batches"] == 3
+    assert await calculation_db.iemissiondata.count(where={"source": "calc:gir-db4"}) == 0
+    assert await calculation_db.iemissiondata.count(where={"source": "calc:gir-db1"}) == 2
+    # The rollups no longer serve the purged rows
+    assert await calculation_db.iemissionregionrollup.count(where={"year": 2020, "source": "calc:gir-db4"}) == 0
+    assert (await service.purge_emissions("calc:", category_name="2.B"))["deleted"] == 0
+
+
+@pytest.mark.asyncio
+async def test_purge_emissions_refuses_imported_data():
+    service = IEmissionDataService()
+    with pytest.raises(ValueError):
+        await service.purge_emissions("orig:gir-db4")
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_create_org_emissions_bulk_is_idempotent(calculation_db):
+    service = IEmissionDataService()
+    organization = await calculation_db.iorganization.create(data={"legalName": "bulk-org"})
+    sites = await calculation_db.iorgsite.find_many(where={"companyName": {"startswith": "calc-parity-"}})
+    for site in sites:
+        await calculation_db.iorgsite.update(where={"uid": site.uid}, data={"organizationUid": organization.uid})
+    totals = [{"uid": organization.uid, "source": "orig:gir-ets", "periodStartDt": "2022-01-01", "emissionTotal": 100, "emissionScope1": 40}]
+    try:
+        assert await service.create_org_emissions_bulk(totals) == {"organizations": 1, "sites": 2}
+        # The same organization in both sheets of a report is written once
+        assert await service.create_org_emissions_bulk(totals + totals) == {"organizations": 1, "sites": 2}
+        rows = await calculation_db.iemissiondata.find_many(where={"organizationUid": organization.uid, "source": "orig:gir-ets"})
+        assert len(rows) == 3
+        assert sorted(row.emissionTotal for row in rows if row.siteUid) == pytest.approx([25, 75])
+        assert sorted(row.emissionDirect for row in rows if row.siteUid) == pytest.approx([10, 30])
+    finally:
+        await calculation_db.iemissiondata.delete_many(where={"organizationUid": organization.uid})
+        await calculation_db.iorgsite.update_many(where={"organizationUid": organization.uid}, data={"organizationUid": None})
+        await calculation_db.iorganization.delete(where={"uid": organization.uid})
+
+
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_refresh_category_rollups(calculation_db):
+    service = IEmissionDataService()
+    codes = []
+    parent = None
+    for code in ["2", "2.A", "2.A.1"]:
+        parent = await calculation_db.code.create(data={"createdByUid": "test", "type": "sourcesinkcategory", "code": code, "name": code, "parentUid": parent.uid if parent else None})
+        codes.append(parent)
+    try:
+        assert await service.refresh_category_rollups(year_from=2020, year_to=2020) > 0
+        rollups = await service.fetch_category_rollups(year=2020, source="orig:gir-db4", pollutant_id="CO2")
+        assert {rollup.categoryCode: (rollup.emissionTotal, rollup.isReported) for rollup in rollups} == {
+            "2": (100, False), "2.A": (100, False), "2.A.1": (100, True),
+        }
+        db1 = await service.fetch_category_rollups(year=2020, code="2", source="orig:gir-db1")
+        assert [rollup.emissionTotal for rollup in db1] == pytest.approx([10000])
+    finally:
+        await calculation_db.code.delete_many(where={"uid": {"in": [code.uid for code in codes]}})
+
+
+@pytest.mark.asyncio
+async def test_schedule_summary_refresh_coalesces_writes(mocker):
+    service = IEmissionDataService()
+    mocker.patch.object(service, "refresh_summaries")
+    job = service.schedule_summary_refresh(["orig:ets"], [2021])
+    assert service.schedule_summary_refresh(["orig:ets"], [2022]) is None
+    assert service.schedule_summary_refresh(["orig:other"], [2021]) is None
+    await job_runner.wait(job.uid)
+    assert job.status == "completed"
+    assert sorted(call.args for call in service.refresh_summaries.call_args_list) == [
+        (2021, 2021, ["orig:other"]), (2021, 2022, ["orig:ets"]),
+    ]
+    assert pending_summaries == {}
+    # Writes made after the job started get their own job
+    job = service.schedule_summary_refresh(["orig:ets"], [2021])
+    assert job is not None
+    await job_runner.wait(job.uid)
+
+
+@pytest.mark.asyncio
+async def test_schedule_summary_refresh_resubmits_after_a_failed_job(mocker):
+    service = IEmissionDataService()
+    mocker.patch.object(service, "refresh_summaries", side_effect=[Exception("database down"), None])
+    job = service.schedule_summary_refresh(["orig:ets"], [2021])
+    await job_runner.wait(job.uid)
+    assert job.status == "failed"
+    assert pending_summaries == {"orig:ets": {2021}}
+    job = service.schedule_summary_refresh(["orig:ets"], [2022])
+    assert job is not None
+    await job_runner.wait(job.uid)
+    assert job.status == "completed"
+    assert service.refresh_summaries.call_args.args == (2021, 2022, ["orig:ets"])
+    assert pending_summaries == {}
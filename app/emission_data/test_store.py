@@ -0,0 +1,93 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.emission_data.store import STORE_BYTES_PER_ROW, EmissionStore
+
+
+def make_rows(source: str, year: int, totals: list[float], region_names=("a", "b")) -> pd.DataFrame:
+    return pd.DataFrame([
+        {
+            "periodStartDt": f"{year}-01-01T00:00:00+00:00", "source": source, "categoryName": "2.A",
+            "regionUid": None, "regionName": region_names[index % len(region_names)], "pollutantId": "CO2",
+            "emissionTotal": total, "latitude": 37.0 + index, "longitude": None,
+        }
+        for index, total in enumerate(totals)
+    ])
+
+
+def make_store() -> EmissionStore:
+    store = EmissionStore(enabled=True)
+    store.replace(pd.concat([make_rows("orig:gir-db1", 2021, [1.0, 2.0]), make_rows("calc:gir-db4", 2020, [3.0, 4.0, 5.0])]))
+    return store
+
+
+def test_rows_are_sorted_by_period():
+    store = make_store()
+    assert len(store) == 5
+    assert store.memory_bytes() == 5 * STORE_BYTES_PER_ROW
+    assert list(store.period_start.astype("datetime64[Y]").astype(int) + 1970) == [2020, 2020, 2020, 2021, 2021]
+    assert store.distinct("source") == ["orig:gir-db1", "calc:gir-db4"]
+    assert store.distinct("regionUid") == [None]
+
+
+def test_mask_and_totals():
+    store = make_store()
+    mask = store.mask(sources=["calc:gir-db4"], year_from=2020, year_to=2020, categories=["2.A"])
+    assert mask.sum() == 3
+    assert store.mask(sources=["calc:gir-db4"], year_from=2021).sum() == 0
+    assert store.mask(categories=["unknown"]).sum() == 0
+    totals = store.totals("regionName", mask)
+    assert totals["regionName"].tolist() == ["a", "b"]
+    assert totals["emissionTotal"].tolist() == [8.0, 4.0]
+    assert totals["latitude"].tolist() == [38.0, 38.0]
+    assert np.isnan(totals["longitude"]).all()
+
+
+def test_replace_stale_slices():
+    store = make_store()
+    store.mark_stale(["calc:gir-db4"], [2020])
+    store.mark_stale(["orig:gir-db1"])
+    assert store.take_stale() == {"calc:gir-db4": {2020}, "orig:gir-db1": None}
+    assert store.take_stale() == {}
+    store.replace(make_rows("calc:gir-db4", 2020, [10.0]), "calc:gir-db4", {2020})
+    assert store.totals("source", store.mask()).set_index("source")["emissionTotal"].to_dict() == {
+        "orig:gir-db1": 3.0, "calc:gir-db4": 10.0
+    }
+    store.mark_stale()
+    assert not store.loaded
+
+
+def test_store_is_disabled_above_max_rows():
+    store = EmissionStore(enabled=True, max_rows=4)
+    store.replace(make_rows("calc:gir-db4", 2020, [1.0] * 5))
+    assert not store.enabled
+    assert len(store) == 0
+
+
+def test_fits_counts_the_kept_rows():
+    store = make_store()
+    store.max_rows = 6
+    assert store.fits(4, "calc:gir-db4", {2020})
+    assert store.fits(6)
+    assert store.enabled
+    assert not store.fits(5, "calc:gir-db4", {2021})
+    assert not store.enabled
+    assert len(store) == 0
+
+
+def test_expire_versions_marks_the_changed_slices_stale():
+    store = make_store()
+    versions = [
+        {"source": "calc:gir-db4", "year": 2020, "count": 3, "modified": "2024-01-01", "run": "a"},
+        {"source": "orig:gir-db1", "year": 2021, "count": 2, "modified": "2024-01-01", "run": None},
+    ]
+    store.expire_versions(versions)
+    assert not store.versions_expired()
+    assert store.take_stale() == {"calc:gir-db4": {2020}, "orig:gir-db1": {2021}}
+    store.expire_versions(versions)
+    assert store.take_stale() == {}
+    store.expire_versions([
+        {"source": "calc:gir-db4", "year": 2020, "count": 3, "modified": "2024-01-01", "run": "b"},
+        {"source": "calc:gir-db1", "year": 2020, "count": 1, "modified": "2024-01-01", "run": "b"},
+    ])
+    assert store.take_stale() == {"calc:gir-db4": {2020}, "calc:gir-db1": {2020}, "orig:gir-db1": {2021}}
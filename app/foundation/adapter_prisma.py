@@ -1,4 +1,8 @@
-from typing import Optional
+import base64
+import binascii
+import json
+from datetime import datetime
+from typing import Optional, get_args
 from fastapi import Request
 from pydantic import BaseModel
 
@@ -14,6 +18,14 @@ class PageableResponse(BaseModel):
     first: bool = True
     last: bool = False
     content: list = []
+    # Token of the next page (query param _cursor), None on the last page
+    nextCursor: Optional[str] = None
+    # Whether totalElements (and totalPages) is an estimate, see fetch_page_and_count
+    approximateTotal: bool = False
+
+
+# Tie breaker of every paged sort, so that the rows are in a stable order
+KEYSET_FIELD = "sid"
 
 
 class PrismaAdapter:
@@ -40,22 +52,209 @@ class PrismaAdapter:
 
         return operands
 
+    def to_aggregation_args(self, query: dict) -> dict:
+        """
+        Converts the query params of an aggregate endpoint to the args of AggregationQuery.compile.
+
+        Args:
+            query (dict): _dimensions, _measures and _sort as comma separated lists, _limit, and the filters.
+                E.g. {"_dimensions": "periodStartDt:year", "_measures": "sum:emissionTotal", "source:in": "a,b"}
+
+        Returns:
+            dict: The dimensions, measures, filters, order and limit.
+        """
+        def to_list(key: str) -> list[str]:
+            return [value for value in query.get(key, "").split(",") if value]
+
+        return {
+            "dimensions": to_list("_dimensions"),
+            "measures": to_list("_measures"),
+            "filters": self.to_query_args(query) or {},
+            "order": to_list("_sort"),
+            "limit": int(query["_limit"]) if query.get("_limit") else None,
+        }
+
+    def to_offset_args(self, query: dict, default_page_size: int = 10) -> dict:
+        """
+        Converts _pageSize and _pageNum to the take and skip args of an unpaged search.
+
+        Args:
+            query (dict): _pageSize (default default_page_size) and _pageNum (default 0).
+            default_page_size (int, optional): The take without _pageSize. Defaults to 10.
+
+        Returns:
+            dict: The take and skip args.
+        """
+        page_size = int(query.get("_pageSize", default_page_size))
+        page_num = int(query.get("_pageNum", 0))
+        if page_size <= 0 or page_num < 0:
+            raise ValueError("_pageSize must be positive and _pageNum not negative")
+        return {"take": page_size, "skip": page_size * page_num}
+
+    def to_page_args(self, query: dict, model_fields: dict) -> dict:
+        """
+        Converts the query params of a paged endpoint to the find_many args of the page: _pageSize rows in the
+        _sort order, with sid as the tie breaker. With _cursor (the nextCursor of the previous page) the page
+        starts after the last row of the previous page (keyset pagination), so that every page costs the same.
+        Without it, the page is skipped to with _pageNum.
+
+        Args:
+            query (dict): _pageSize, _cursor or _pageNum, _sort, and the filters.
+            model_fields (dict): The model_fields of the prisma model, for the nullable sort fields.
+
+        Returns:
+            dict: The take, skip, order and where args.
+        """
+        page_size = int(query["_pageSize"])
+        order = self.to_sort_object(query.get("_sort")) or []
+        for term in order:
+            if list(term)[0] not in model_fields:
+                raise ValueError(f"Unknown sort field {list(term)[0]}")
+        if not any(KEYSET_FIELD in term for term in order):
+            order.append({KEYSET_FIELD: "asc"})
+        where = self.to_query_args(query) or {}
+        if query.get("_cursor"):
+            where = {"AND": [where, self._after_cursor(order, self.decode_cursor(query["_cursor"]), model_fields)]}
+            skip = 0
+        else:
+            skip = page_size * int(query.get("_pageNum", 0))
+        return {"take": page_size, "skip": skip, "order": order, "where": where}
+
+    def encode_cursor(self, row, order: list[dict]) -> str:
+        """Returns the opaque token of the position of a row (model or dict) in the order."""
+        values = []
+        for term in order:
+            field = list(term)[0]
+            value = row.get(field) if isinstance(row, dict) else getattr(row, field)
+            values.append({"$date": value.isoformat()} if isinstance(value, datetime) else value)
+        return base64.urlsafe_b64encode(json.dumps(values, separators=(",", ":")).encode()).decode().rstrip("=")
+
+    def decode_cursor(self, cursor: str) -> list:
+        try:
+            values = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        except (binascii.Error, ValueError):
+            raise ValueError(f"Invalid cursor {cursor}")
+        if not isinstance(values, list):
+            raise ValueError(f"Invalid cursor {cursor}")
+        return [
+            datetime.fromisoformat(value["$date"]) if isinstance(value, dict) and "$date" in value else value
+            for value in values
+        ]
+
+    def _after_cursor(self, order: list[dict], values: list, model_fields: dict) -> dict:
+        """
+        The where condition of the rows after the cursor values in the order: for one of the sort fields, the
+        previous fields are equal and the field is after its value. Nulls are last in ascending order and first
+        in descending order, as in Postgres.
+        """
+        if len(values) != len(order):
+            raise ValueError("The cursor does not match the sort")
+        branches = []
+        for index, (term, value) in enumerate(zip(order, values)):
+            field, direction = list(term.items())[0]
+            nullable = field != KEYSET_FIELD and type(None) in get_args(model_fields[field].annotation)
+            if direction == "desc":
+                after = {field: {"not": None}} if value is None else {field: {"lt": value}}
+            elif value is None:
+                after = None
+            else:
+                after = {"OR": [{field: {"gt": value}}, {field: None}]} if nullable else {field: {"gt": value}}
+            if after is not None:
+                previous = [{list(previous)[0]: previous_value} for previous, previous_value in zip(order[:index], values)]
+                branches.append({"AND": [*previous, after]} if previous else after)
+        return {"OR": branches}
+
+    def to_fields_args(self, query: dict, model_fields: dict) -> dict | None:
+        """
+        Converts the _fields query param (comma separated, relation fields as relation.field) to the projection
+        of project, e.g. "uid,region.name" -> {"uid": True, "region": {"name": True}}. None without _fields.
+
+        Args:
+            query (dict): The query params.
+            model_fields (dict): The model_fields of the prisma model, to check the fields.
+        """
+        if not query.get("_fields"):
+            return None
+        fields = {}
+        for path in query["_fields"].split(","):
+            names = [name.strip() for name in path.split(".") if name.strip()]
+            if not names:
+                continue
+            if names[0] not in model_fields:
+                raise ValueError(f"Unknown field {names[0]}")
+            projection = fields
+            for name in names[:-1]:
+                if projection.get(name) is True:
+                    break
+                projection = projection.setdefault(name, {})
+            else:
+                projection[names[-1]] = True
+        return fields
+
+    def include_projected(self, include: dict | None, fields: dict | None) -> dict | None:
+        """Adds the relations projected by fields (see to_fields_args) to the include args."""
+        relations = [name for name, projection in (fields or {}).items() if isinstance(projection, dict)]
+        if not relations:
+            return include
+        return {**(include or {}), **{name: True for name in relations if not (include or {}).get(name)}}
+
+    def project(self, rows: list, fields: dict | None) -> list:
+        """
+        Keeps the projected fields of rows (prisma models or dicts) as dicts, and every field without fields.
+        prisma-client-py has no select, so the rows are read whole and the projection only trims the response.
+        """
+        if fields is None:
+            return rows
+        return [self._project_row(row, fields) for row in rows]
+
+    def _project_row(self, row, fields: dict):
+        if row is None:
+            return None
+        if isinstance(row, list):
+            return [self._project_row(item, fields) for item in row]
+        projected = {}
+        for name, projection in fields.items():
+            value = row.get(name) if isinstance(row, dict) else getattr(row, name, None)
+            projected[name] = value if projection is True else self._project_row(value, projection)
+        return projected
+
     def to_pageable_response(
-        self, query: Request, response, count: int
+        self,
+        query: Request,
+        response,
+        count: int,
+        order: list[dict] | None = None,
+        approximate: bool = False,
+        fields: dict | None = None,
     ) -> PageableResponse:
-        if not response and isinstance(query["_pageNum"], int) and query["_pageSize"]:
+        """
+        Wraps a page. With the order of the page (see to_page_args), a full page has the nextCursor of the
+        following page. approximate flags an estimated count, and fields projects the content (see project).
+        """
+        if not response and isinstance(query.get("_pageNum"), int) and query["_pageSize"]:
             return
+        page_num = int(query["_pageNum"]) if "_pageNum" in query else None
+        next_cursor = (
+            self.encode_cursor(response[-1], order) if order and response and len(response) >= int(query["_pageSize"]) else None
+        )
+        if "_cursor" in query:
+            first, last = False, next_cursor is None
+        else:
+            first = not page_num
+            last = (page_num or 0) == (count // int(query["_pageSize"]) ) if count > int(query["_pageSize"]) else True
         response = PageableResponse(
-            number=int(query["_pageNum"]),
+            number=page_num,
             numberOfElements=len(response),
             size=int(query["_pageSize"]),
-            first=int(query["_pageNum"]) == 0,
-            last=int(query["_pageNum"]) == (count // int(query["_pageSize"]) ) if count > int(query["_pageSize"]) else True,
+            first=first,
+            last=last,
             totalPages=count // int(query["_pageSize"]) + 1
             if count % int(query["_pageSize"]) > 0
             else count // int(query["_pageSize"]),
             totalElements=count,
-            content=response,
+            content=self.project(response, fields),
+            nextCursor=next_cursor,
+            approximateTotal=approximate,
         )
         return response
 
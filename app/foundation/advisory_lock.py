@@ -0,0 +1,55 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+from datetime import timedelta
+from typing import AsyncIterator, Iterable
+from app.config.env_config import JOB_LOCK_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+# Longest time a lock is held. The transaction holding it is rolled back by prisma afterwards, which releases it.
+ADVISORY_LOCK_TIMEOUT = timedelta(seconds=JOB_LOCK_TIMEOUT_SECONDS)
+ADVISORY_LOCK_MAX_WAIT = timedelta(seconds=10)
+
+# pg_advisory_xact_lock returns void, which query_raw cannot deserialize, hence the SELECT 1.
+LOCK_KEY = 'SELECT 1 AS "locked" FROM pg_advisory_xact_lock(hashtext($1))'
+
+
+@asynccontextmanager
+async def advisory_lock(client, keys: Iterable[str], timeout: timedelta = ADVISORY_LOCK_TIMEOUT) -> AsyncIterator[None]:
+    """
+    Holds the Postgres advisory locks of the keys, so that the processes sharing the database (e.g. several API
+    workers) run the jobs writing the same data one after the other. See JobRunner.cross_process_lock.
+
+    The locks are transaction-level locks of an interactive transaction that stays open, and keeps a connection,
+    until the block exits or timeout elapses. Nothing is written in it, it is rolled back to release the locks.
+    As the locks are released when the transaction expires, the block is cancelled at the same time and raises
+    TimeoutError, so that a job never keeps writing without its locks.
+
+    Args:
+        client: The prisma client (see app.database.get_connection).
+        keys (Iterable[str]): The lock keys, acquired in sorted order like the in-process locks.
+        timeout (timedelta, optional): The longest time the locks are held. Defaults to JOB_LOCK_TIMEOUT_SECONDS.
+    """
+    keys = sorted(set(keys))
+    # Taken before the transaction starts, so that the block stops no later than the transaction expires
+    deadline = asyncio.get_running_loop().time() + timeout.total_seconds()
+    manager = client.tx(max_wait=ADVISORY_LOCK_MAX_WAIT, timeout=timeout)
+    transaction = await manager.start()
+    try:
+        for key in keys:
+            await transaction.query_raw(LOCK_KEY, key)
+        expiry = asyncio.timeout_at(deadline)
+        try:
+            async with expiry:
+                yield
+        except TimeoutError as e:
+            if not expiry.expired():
+                raise
+            raise TimeoutError(f"The advisory locks {keys} expired after {timeout}, the work holding them was stopped") from e
+    finally:
+        try:
+            await manager.rollback()
+        except Exception as e:
+            # The transaction expired after timeout, its locks are already released
+            logger.warning(f"Releasing the advisory locks {keys} failed: {e}")
@@ -0,0 +1,188 @@
+import json
+from typing import Any, Iterable, Optional
+from app.utils.data_types import parse_to_date
+from app.utils.object import records_to_columns
+
+# Postgres type of every aggregatable annotation of model_fields_into_type_map; Json, lists and relations are not
+SQL_TYPES = {"str": "text", "int": "bigint", "float": "double precision", "datetime": "timestamp", "bool": "boolean"}
+NUMBER_TYPES = ["int", "float"]
+AGGREGATES = {"sum": "SUM", "avg": "AVG", "min": "MIN", "max": "MAX", "count": "COUNT"}
+TIME_BUCKETS = ["year", "quarter", "month", "week", "day"]
+COMPARISONS = {"equals": "=", "not": "<>", "lt": "<", "lte": "<=", "gt": ">", "gte": ">="}
+PATTERNS = {"contains": "%{}%", "startsWith": "{}%", "endsWith": "%{}"}
+
+
+class AggregationQuery:
+    """
+    Compiles typed aggregations of a table into one parameterized SQL statement.
+
+    Dimensions are fields, or datetime fields bucketed by TIME_BUCKETS ("periodStartDt:year"). Measures are
+    "<aggregate>:<field>" with an aggregate of AGGREGATES, or "count" for the number of rows. Filters are the
+    where of PrismaAdapter.to_query_args. Every field is checked against the field types of the model, and every
+    value is passed as a parameter, so that nothing of the request is pasted into the query.
+    """
+
+    def __init__(self, table: str, field_types: dict[str, list[str]], condition: Optional[str] = None) -> None:
+        """
+        Args:
+            table (str): The table, read as t.
+            field_types (dict[str, list[str]]): Annotation -> fields, see model_fields_into_type_map.
+            condition (str, optional): A condition on t always applied, e.g. the active calculation runs.
+        """
+        self.table = table
+        self.types = {field: annotation for annotation in SQL_TYPES for field in field_types.get(annotation, [])}
+        self.condition = condition
+
+    def compile(
+        self,
+        dimensions: Iterable[str] = (),
+        measures: Iterable[str] = (),
+        filters: Optional[dict] = None,
+        order: Iterable[str] = (),
+        limit: Optional[int] = None,
+    ) -> tuple[str, list, list[str]]:
+        """
+        Compiles an aggregation.
+
+        Args:
+            dimensions (Iterable[str]): The keys to group by, e.g. ["periodStartDt:year", "source"].
+            measures (Iterable[str]): The aggregates per group, e.g. ["sum:emissionTotal", "count"].
+            filters (dict, optional): The where, e.g. {"source": {"in": ["calc:gir-db4"]}}.
+            order (Iterable[str]): Output columns with an optional direction, e.g. ["sum:emissionTotal:desc"].
+                Defaults to the dimensions.
+            limit (int, optional): The maximum number of groups.
+
+        Returns:
+            tuple[str, list, list[str]]: The query, its parameters and its output columns.
+        """
+        dimensions, measures = list(dimensions), list(measures)
+        if not dimensions and not measures:
+            raise ValueError("At least one dimension or measure is required")
+        columns = dimensions + measures
+        if len(set(columns)) < len(columns):
+            raise ValueError(f"Repeated dimensions or measures in {columns}")
+        expressions = [self._dimension(dimension) for dimension in dimensions] + [self._measure(measure) for measure in measures]
+        args = []
+        conditions = [self.condition] if self.condition else []
+        for field, condition in (filters or {}).items():
+            conditions.extend(self._conditions(field, condition, args))
+        positions = ", ".join(str(position) for position in range(1, len(dimensions) + 1))
+        query = f"""
+            SELECT {", ".join(f'{expression} AS "{column}"' for expression, column in zip(expressions, columns))}
+            FROM "{self.table}" t
+            {"WHERE " + " AND ".join(conditions) if conditions else ""}
+            {f"GROUP BY {positions}" if dimensions else ""}
+            {self._order(list(order), columns, len(dimensions))}
+            {f"LIMIT {_positive_int(limit)}" if limit is not None else ""}
+        """
+        return query, args, columns
+
+    async def fetch(self, client, **kwargs) -> dict:
+        """
+        Runs an aggregation (see compile) with the prisma client.
+
+        Returns:
+            dict: One list per dimension and measure, e.g. {"source": ["a", "b"], "sum:emissionTotal": [1.0, 2.0]}.
+        """
+        query, args, columns = self.compile(**kwargs)
+        return records_to_columns(await client.query_raw(query, *args), columns)
+
+    def _type(self, field: str) -> str:
+        if field not in self.types:
+            raise ValueError(f"Unknown field {field} of {self.table}")
+        return self.types[field]
+
+    def _dimension(self, dimension: str) -> str:
+        field, _, bucket = dimension.partition(":")
+        field_type = self._type(field)
+        if not bucket:
+            return f't."{field}"'
+        if bucket not in TIME_BUCKETS or field_type != "datetime":
+            raise ValueError(f"{dimension}: only datetime fields can be bucketed, by one of {TIME_BUCKETS}")
+        if bucket == "year":
+            return f'EXTRACT(YEAR FROM t."{field}")::int'
+        return f"date_trunc('{bucket}', t.\"{field}\")"
+
+    def _measure(self, measure: str) -> str:
+        aggregate, _, field = measure.partition(":")
+        if aggregate not in AGGREGATES:
+            raise ValueError(f"{measure}: unknown aggregate, expected one of {list(AGGREGATES)}")
+        if aggregate == "count":
+            if not field:
+                return "COUNT(*)::int"
+            self._type(field)
+            return f'COUNT(t."{field}")::int'
+        field_type = self._type(field)
+        if aggregate in ["sum", "avg"]:
+            if field_type not in NUMBER_TYPES:
+                raise ValueError(f"{measure}: {aggregate} requires a number field")
+            return f'{AGGREGATES[aggregate]}(t."{field}")::double precision'
+        if field_type == "bool":
+            raise ValueError(f"{measure}: {aggregate} does not apply to a boolean field")
+        return f'{AGGREGATES[aggregate]}(t."{field}")'
+
+    def _conditions(self, field: str, condition: Any, args: list) -> list[str]:
+        field_type = self._type(field)
+        sql_type = SQL_TYPES[field_type]
+        if not isinstance(condition, dict):
+            condition = {"equals": condition}
+        conditions = []
+        for operator, value in condition.items():
+            if isinstance(value, dict):
+                raise ValueError(f"{field}: relation filters are not supported by aggregations")
+            if operator in ["in", "notIn"]:
+                values = value if isinstance(value, list) else [value]
+                args.append(json.dumps([_parameter(field_type, value) for value in values]))
+                negation = "NOT " if operator == "notIn" else ""
+                conditions.append(f't."{field}" {negation}IN (SELECT jsonb_array_elements_text(${len(args)}::jsonb)::{sql_type})')
+            elif isinstance(value, list):
+                raise ValueError(f"{field}: {operator} takes a single value")
+            elif operator in COMPARISONS:
+                args.append(_parameter(field_type, value))
+                conditions.append(f't."{field}" {COMPARISONS[operator]} ${len(args)}::{sql_type}')
+            elif operator in PATTERNS and field_type == "str":
+                escaped = str(value).replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+                args.append(PATTERNS[operator].format(escaped))
+                conditions.append(f't."{field}" LIKE ${len(args)}')
+            else:
+                raise ValueError(f"{field}: unsupported operator {operator}")
+        return conditions
+
+    @staticmethod
+    def _order(order: list[str], columns: list[str], dimension_count: int) -> str:
+        terms = []
+        for term in order:
+            column, _, direction = term.rpartition(":")
+            if direction.lower() not in ["asc", "desc"]:
+                column, direction = term, "asc"
+            if column not in columns:
+                raise ValueError(f"Cannot order by {column}, expected one of {columns}")
+            terms.append(f"{columns.index(column) + 1} {direction.upper()}")
+        if not terms:
+            terms = [str(position) for position in range(1, dimension_count + 1)]
+        return "ORDER BY " + ", ".join(terms) if terms else ""
+
+
+def _parameter(field_type: str, value: Any) -> str:
+    """Returns the value as the text of a parameter cast to the field type, raising ValueError when it is not one."""
+    if field_type == "int":
+        return str(int(value))
+    if field_type == "float":
+        return str(float(value))
+    if field_type == "datetime":
+        date = parse_to_date(value)
+        if date is None:
+            raise ValueError(f"{value} is not a date")
+        return date.isoformat()
+    if field_type == "bool":
+        if str(value).lower() not in ["true", "false"]:
+            raise ValueError(f"{value} is not a boolean")
+        return str(value).lower()
+    return str(value)
+
+
+def _positive_int(value: Any) -> int:
+    value = int(value)
+    if value <= 0:
+        raise ValueError("limit must be positive")
+    return value
@@ -0,0 +1,93 @@
+import json
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Iterable, Optional
+
+
+class ResponseCache:
+    """
+    A size-bounded LRU cache whose entries expire after ttl seconds and can be invalidated by tag.
+
+    Entries are tagged with the data they were computed from (e.g. "calc:gir-db4" and "calc:gir-db4:2020"), so
+    that writes drop only the entries reading the written data. The cache lives in the process: writes made by
+    other processes (e.g. the scripts) are only picked up once the entries expire.
+
+    Every invalidation bumps the generation of its tags (of the whole cache without tags), so that get_or_set does
+    not cache a value computed while its tags were invalidated, which would hold pre-write data until the ttl.
+    """
+
+    def __init__(self, max_size: int = 256, ttl: float = 600, clock: Callable[[], float] = time.monotonic) -> None:
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self.entries: "OrderedDict[str, tuple[float, Any, frozenset]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.generation = 0
+        self.tag_generations: dict[str, int] = {}
+
+    @staticmethod
+    def make_key(namespace: str, **params) -> str:
+        """Returns the key of a call, independent of the order of the params (and of the keys of dict params)."""
+        return namespace + ":" + json.dumps(params, sort_keys=True, default=str)
+
+    def get(self, key: str) -> tuple[bool, Any]:
+        """
+        Returns (True, value) when the key is cached and not expired, (False, None) otherwise.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry[0] <= self.clock():
+            if entry is not None:
+                del self.entries[key]
+            self.misses += 1
+            return False, None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return True, entry[1]
+
+    def set(self, key: str, value: Any, tags: Iterable[str] = ()) -> None:
+        self.entries[key] = (self.clock() + self.ttl, value, frozenset(tags))
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    async def get_or_set(self, key: str, func: Callable[[], Awaitable[Any]], tags: Iterable[str] = ()) -> Any:
+        """
+        Returns the cached value of the key, computing and caching it with func on a miss.
+        """
+        hit, value = self.get(key)
+        if hit:
+            return value
+        tags = list(tags)
+        generations = self.generations(tags)
+        value = await func()
+        if self.generations(tags) == generations:
+            self.set(key, value, tags)
+        return value
+
+    def generations(self, tags: Iterable[str]) -> tuple:
+        """The generation of the cache and of every tag, which change when they are invalidated."""
+        return self.generation, tuple(self.tag_generations.get(tag, 0) for tag in tags)
+
+    def invalidate(self, tags: Optional[Iterable[str]] = None) -> int:
+        """
+        Drops the entries having any of the tags, every entry when tags is None.
+
+        Returns:
+            int: The number of dropped entries.
+        """
+        if tags is None:
+            self.generation += 1
+            count = len(self.entries)
+            self.entries.clear()
+            return count
+        tags = set(tags)
+        for tag in tags:
+            self.tag_generations[tag] = self.tag_generations.get(tag, 0) + 1
+        keys = [key for key, (_, _, entry_tags) in self.entries.items() if entry_tags & tags]
+        for key in keys:
+            del self.entries[key]
+        return len(keys)
+
+    def stats(self) -> dict:
+        return {"size": len(self.entries), "maxSize": self.max_size, "ttl": self.ttl, "hits": self.hits, "misses": self.misses}
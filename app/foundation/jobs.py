@@ -0,0 +1,201 @@
+import asyncio
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from contextlib import asynccontextmanager, nullcontext
+from datetime import datetime
+from typing import Any, AsyncContextManager, AsyncIterator, Awaitable, Callable, Iterable, Optional
+
+logger = logging.getLogger(__name__)
+
+JOB_STATUSES = ["queued", "running", "completed", "failed", "cancelled"]
+FINISHED_STATUSES = ["completed", "failed", "cancelled"]
+
+
+class Job:
+    """
+    A unit of background work submitted to the JobRunner. The job function receives the job and reports
+    its progress through set_total / advance.
+    """
+
+    def __init__(self, name: str, lock_keys: Iterable[str] = (), unit: str = "items") -> None:
+        self.uid = str(uuid.uuid4())
+        self.name = name
+        self.lock_keys = sorted(set(lock_keys))
+        self.unit = unit
+        self.status = "queued"
+        self.total: Optional[int] = None
+        self.processed = 0
+        self.result: Any = None
+        self.error: Optional[str] = None
+        self.date_created = datetime.now()
+        self.date_started: Optional[datetime] = None
+        self.date_finished: Optional[datetime] = None
+        self._started_at: Optional[float] = None
+        self._finished_at: Optional[float] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def set_total(self, total: int) -> None:
+        self.total = total
+
+    def advance(self, count: int = 1) -> None:
+        self.processed += count
+
+    @property
+    def elapsed(self) -> float:
+        if self._started_at is None:
+            return 0.0
+        return (self._finished_at or time.monotonic()) - self._started_at
+
+    @property
+    def rate(self) -> Optional[float]:
+        """Processed units per second."""
+        elapsed = self.elapsed
+        return self.processed / elapsed if elapsed > 0 else None
+
+    @property
+    def is_finished(self) -> bool:
+        return self.status in FINISHED_STATUSES
+
+    def to_dict(self) -> dict:
+        rate = self.rate
+        return {
+            "uid": self.uid,
+            "name": self.name,
+            "status": self.status,
+            "lockKeys": self.lock_keys,
+            "unit": self.unit,
+            "total": self.total,
+            "processed": self.processed,
+            "progress": self.processed / self.total if self.total else None,
+            "rate": round(rate, 2) if rate is not None else None,
+            "elapsed": round(self.elapsed, 3),
+            "result": self.result,
+            "error": self.error,
+            "dateCreated": self.date_created,
+            "dateStarted": self.date_started,
+            "dateFinished": self.date_finished,
+        }
+
+
+class JobRunner:
+    """
+    Runs long operations (emission calculation, address population, ...) as asyncio tasks of the API process
+    so that the HTTP request returns immediately with the job uid.
+
+    Jobs declaring the same lock key (e.g. "calculate:2020:calc:gir-db4") run one after the other. The keys of a
+    job are acquired in sorted order, so jobs sharing several keys cannot deadlock. These locks and the job registry
+    live in the process: with several API workers, cross_process_lock (e.g. app.foundation.advisory_lock) also
+    locks the keys across the processes, while a job is only listed by the worker that runs it.
+    """
+
+    def __init__(
+        self,
+        max_history: int = 100,
+        cross_process_lock: Optional[Callable[[list[str]], AsyncContextManager]] = None,
+    ) -> None:
+        self.max_history = max_history
+        self.jobs: "OrderedDict[str, Job]" = OrderedDict()
+        self.locks: dict[str, asyncio.Lock] = {}
+        self.cross_process_lock = cross_process_lock
+
+    def submit(
+        self,
+        name: str,
+        func: Callable[[Job], Awaitable[Any]],
+        lock_keys: Iterable[str] = (),
+        unit: str = "items",
+    ) -> Job:
+        """
+        Schedules func(job) on the running event loop.
+
+        Args:
+            name (str): A human readable name of the job.
+            func (Callable[[Job], Awaitable]): The coroutine function to run. Its return value becomes job.result.
+            lock_keys (Iterable[str], optional): The resources the job writes to.
+            unit (str, optional): What the progress counts (e.g. "relations").
+
+        Returns:
+            Job: The queued job.
+        """
+        job = Job(name=name, lock_keys=lock_keys, unit=unit)
+        self.jobs[job.uid] = job
+        self._prune()
+        job._task = asyncio.create_task(self._run(job, func))
+        return job
+
+    def get(self, uid: str) -> Optional[Job]:
+        return self.jobs.get(uid)
+
+    def list(self, status: Optional[str] = None) -> list[Job]:
+        return [job for job in reversed(self.jobs.values()) if status is None or job.status == status]
+
+    def cancel(self, uid: str) -> Optional[Job]:
+        """
+        Requests the cancellation of a queued or running job. The job is marked cancelled once its task stops.
+
+        Args:
+            uid (str): The uid of the job.
+
+        Returns:
+            Job | None: The job, None if it does not exist.
+        """
+        job = self.jobs.get(uid)
+        if job and not job.is_finished and job._task:
+            job._task.cancel()
+        return job
+
+    async def wait(self, uid: str) -> Optional[Job]:
+        """Waits until the job is finished, mostly for scripts and tests."""
+        job = self.jobs.get(uid)
+        if job and job._task:
+            await asyncio.wait([job._task])
+        return job
+
+    @asynccontextmanager
+    async def lock(self, keys: Iterable[str]) -> AsyncIterator[None]:
+        """
+        Holds lock keys like a job declaring them, in this process and, with cross_process_lock, across the
+        processes. For the work called inline by several jobs (e.g. the summary rebuilds), which locks its own
+        shared key instead of relying on the keys of its callers. The locks are not reentrant.
+        """
+        keys = sorted(set(keys))
+        acquired: list[asyncio.Lock] = []
+        try:
+            for key in keys:
+                lock = self.locks.setdefault(key, asyncio.Lock())
+                await lock.acquire()
+                acquired.append(lock)
+            async with self.cross_process_lock(keys) if self.cross_process_lock and keys else nullcontext():
+                yield
+        finally:
+            for lock in reversed(acquired):
+                lock.release()
+
+    async def _run(self, job: Job, func: Callable[[Job], Awaitable[Any]]) -> None:
+        try:
+            async with self.lock(job.lock_keys):
+                job.status = "running"
+                job.date_started = datetime.now()
+                job._started_at = time.monotonic()
+                job.result = await func(job)
+            job.status = "completed"
+        except asyncio.CancelledError:
+            job.status = "cancelled"
+        except Exception as e:
+            logger.exception(f"Job {job.name} ({job.uid}) failed")
+            job.status = "failed"
+            job.error = str(e)
+        finally:
+            if job._started_at is not None:
+                job._finished_at = time.monotonic()
+            job.date_finished = datetime.now()
+
+    def _prune(self) -> None:
+        finished = [uid for uid, job in self.jobs.items() if job.is_finished]
+        for uid in finished[: max(0, len(self.jobs) - self.max_history)]:
+            del self.jobs[uid]
+
+
+job_runner = JobRunner()
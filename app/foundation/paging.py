@@ -0,0 +1,64 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from app.config.env_config import PAGE_COUNT_CACHE_TTL
+from app.foundation.cache import ResponseCache
+
+# Values of the _count query param of the paged endpoints: an exact count per page, or an estimate (the planner
+# row estimate of the table without filters, otherwise the count of the filters cached PAGE_COUNT_CACHE_TTL seconds)
+COUNT_MODES = ["exact", "estimate"]
+
+# Planner estimate of the rows of the table $1 (a quoted name, e.g. '"IEmissionData"'), -1 or 0 when never analyzed
+TABLE_ROW_ESTIMATE = """
+    SELECT reltuples::bigint AS "count" FROM pg_class WHERE oid = to_regclass($1)
+"""
+
+page_counts = ResponseCache(max_size=1024, ttl=PAGE_COUNT_CACHE_TTL)
+
+
+def page_count_mode(query: dict) -> str:
+    """Returns the count mode of the query params (_count), exact by default."""
+    mode = query.get("_count") or "exact"
+    if mode not in COUNT_MODES:
+        raise ValueError(f"Unknown count mode {mode}, expected one of {COUNT_MODES}")
+    return mode
+
+
+async def fetch_page_and_count(
+    query: dict,
+    page_args: dict,
+    filters: dict | None,
+    fetch_content: Callable[[], Awaitable[list]],
+    fetch_count: Callable[[], Awaitable[int]],
+    client: Any,
+    table: str,
+) -> tuple[list, int, bool]:
+    """
+    Fetches a page and the total count of its filters. The exact count runs concurrently with the page. When
+    the count is estimated (_count=estimate), the page is read first: an offset page that is not full gives
+    the total without counting. Otherwise the total is the planner estimate of the table without filters, or
+    the count of the filters cached for PAGE_COUNT_CACHE_TTL seconds.
+
+    Args:
+        query (dict): The query params, for _count and _cursor.
+        page_args (dict): The args of the page (see PrismaAdapter.to_page_args), for take and skip.
+        filters (dict, optional): The filters of the count, without the keyset condition of the page.
+        fetch_content (Callable[[], Awaitable[list]]): Fetches the page.
+        fetch_count (Callable[[], Awaitable[int]]): Fetches the exact count of the filters.
+        client (Any): The prisma client, for the planner estimate.
+        table (str): The table name, e.g. IEmissionData.
+
+    Returns:
+        tuple[list, int, bool]: The page, the total, and whether the total is approximate.
+    """
+    if page_count_mode(query) == "exact":
+        content, count = await asyncio.gather(fetch_content(), fetch_count())
+        return content or [], count, False
+    content = await fetch_content() or []
+    if "_cursor" not in query and (content or not page_args["skip"]) and len(content) < page_args["take"]:
+        return content, page_args["skip"] + len(content), False
+    if not filters:
+        rows = await client.query_raw(TABLE_ROW_ESTIMATE, f'"{table}"')
+        if rows and rows[0]["count"] > 0:
+            return content, int(rows[0]["count"]), True
+    count = await page_counts.get_or_set(ResponseCache.make_key(table, where=filters or {}), fetch_count)
+    return content, count, True
@@ -0,0 +1,43 @@
+import asyncio
+from typing import Any, Awaitable, Callable
+from urllib.parse import urlencode
+from fastapi import Request
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls: while a call of a key is in flight, the other callers of the same key
+    wait for its result instead of running it again. Nothing is kept once the call is finished (see ResponseCache
+    for that).
+    """
+
+    def __init__(self) -> None:
+        self.flights: dict[str, asyncio.Future] = {}
+        self.coalesced = 0
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        Returns the result of func(), or of the call of the same key already in flight. Its exceptions are raised
+        to every caller.
+
+        Args:
+            key (str): The key of the call, e.g. request_key(request).
+            func (Callable[[], Awaitable]): The coroutine function computing the result.
+        """
+        flight = self.flights.get(key)
+        if flight is not None:
+            self.coalesced += 1
+        else:
+            flight = asyncio.ensure_future(func())
+            self.flights[key] = flight
+            flight.add_done_callback(lambda _: self.flights.pop(key, None))
+        # A caller going away (e.g. a closed browser tab) does not cancel the call of the others
+        return await asyncio.shield(flight)
+
+
+def request_key(request: Request) -> str:
+    """The key of a request: its path and its query params in sorted order."""
+    return request.url.path + "?" + urlencode(sorted(request.query_params.multi_items()))
+
+
+single_flight = SingleFlight()
@@ -1,3 +1,7 @@
+from datetime import datetime
+from typing import Optional
+import pytest
+from pydantic import BaseModel
 from app.foundation.adapter_prisma import PrismaAdapter
 
 adapter = PrismaAdapter()
@@ -99,3 +103,122 @@ class TestToIncludeExcludeArgs:
     def test_non_list_arg(self):
         arg = "element"
         assert self.obj.to_include_exclude_args(arg) == {"element": True}
+
+
+def test_to_aggregation_args():
+    test = adapter.to_aggregation_args(
+        query={"_dimensions": "periodStartDt:year,source", "_measures": "sum:emissionTotal", "_limit": "10", "source:in": "a,b"}
+    )
+    assert test == {
+        "dimensions": ["periodStartDt:year", "source"],
+        "measures": ["sum:emissionTotal"],
+        "filters": {"source": {"in": ["a", "b"]}},
+        "order": [],
+        "limit": 10,
+    }
+
+
+def test_to_offset_args():
+    assert adapter.to_offset_args({"_pageSize": "5", "_pageNum": "2", "source": "a"}) == {"take": 5, "skip": 10}
+    assert adapter.to_offset_args({}) == {"take": 10, "skip": 0}
+    with pytest.raises(ValueError):
+        adapter.to_offset_args({"_pageSize": "0"})
+
+
+class Row(BaseModel):
+    sid: int
+    name: Optional[str] = None
+    periodStartDt: datetime
+
+
+def test_to_page_args_with_page_number():
+    test = adapter.to_page_args({"_pageSize": "10", "_pageNum": "2", "_sort": "name:desc", "source": "a"}, Row.model_fields)
+    assert test == {"take": 10, "skip": 20, "order": [{"name": "desc"}, {"sid": "asc"}], "where": {"source": "a"}}
+
+
+def test_to_page_args_with_cursor():
+    rows = [Row(sid=7, name="b", periodStartDt=datetime(2020, 1, 1)), Row(sid=3, name=None, periodStartDt=datetime(2021, 1, 1))]
+    query = {"_pageSize": "2", "_sort": "name:asc"}
+    order = adapter.to_page_args(query, Row.model_fields)["order"]
+    cursor = adapter.to_pageable_response(query, rows[:1] * 2, 10, order=order).nextCursor
+    test = adapter.to_page_args({**query, "_cursor": cursor, "_pageNum": "5"}, Row.model_fields)
+    assert test["skip"] == 0
+    assert test["where"] == {"AND": [{}, {"OR": [
+        {"OR": [{"name": {"gt": "b"}}, {"name": None}]},
+        {"AND": [{"name": "b"}, {"sid": {"gt": 7}}]},
+    ]}]}
+    cursor = adapter.encode_cursor(rows[1], order)
+    test = adapter.to_page_args({**query, "_cursor": cursor}, Row.model_fields)
+    assert test["where"]["AND"][1] == {"OR": [{"AND": [{"name": None}, {"sid": {"gt": 3}}]}]}
+
+
+def test_cursor_round_trip():
+    order = [{"periodStartDt": "desc"}, {"sid": "asc"}]
+    row = Row(sid=3, periodStartDt=datetime(2021, 1, 1))
+    assert adapter.decode_cursor(adapter.encode_cursor(row, order)) == [datetime(2021, 1, 1), 3]
+    assert adapter.decode_cursor(adapter.encode_cursor({"sid": 3, "periodStartDt": None}, order)) == [None, 3]
+    with pytest.raises(ValueError):
+        adapter.decode_cursor("not a cursor")
+    with pytest.raises(ValueError):
+        adapter.to_page_args({"_pageSize": "2", "_cursor": adapter.encode_cursor(row, order)}, Row.model_fields)
+    with pytest.raises(ValueError):
+        adapter.to_page_args({"_pageSize": "2", "_sort": "unknown:asc"}, Row.model_fields)
+
+
+def test_to_pageable_response_with_cursor():
+    order = [{"sid": "asc"}]
+    rows = [{"sid": 1}, {"sid": 2}]
+    full = adapter.to_pageable_response({"_pageSize": "2", "_cursor": "x"}, rows, 3, order=order)
+    assert full.nextCursor == adapter.encode_cursor(rows[1], order)
+    assert not full.first and not full.last and full.number is None
+    partial = adapter.to_pageable_response({"_pageSize": "2", "_cursor": "x"}, rows[:1], 3, order=order)
+    assert partial.nextCursor is None and partial.last
+
+
+class Region(BaseModel):
+    name: str
+    latitude: Optional[float] = None
+
+
+class Site(BaseModel):
+    sid: int
+    companyName: str
+    addressDetails: Optional[dict] = None
+    region: Optional[Region] = None
+
+
+def test_to_fields_args():
+    test = adapter.to_fields_args({"_fields": "sid,region.name, region.latitude"}, Site.model_fields)
+    assert test == {"sid": True, "region": {"name": True, "latitude": True}}
+    assert adapter.to_fields_args({"_fields": "region.name,region"}, Site.model_fields) == {"region": True}
+    assert adapter.to_fields_args({}, Site.model_fields) is None
+    with pytest.raises(ValueError):
+        adapter.to_fields_args({"_fields": "unknown"}, Site.model_fields)
+
+
+def test_include_projected():
+    fields = {"sid": True, "region": {"name": True}}
+    assert adapter.include_projected(None, fields) == {"region": True}
+    assert adapter.include_projected({"sites": True}, fields) == {"sites": True, "region": True}
+    assert adapter.include_projected({"sites": True}, {"sid": True}) == {"sites": True}
+
+
+def test_project():
+    rows = [
+        Site(sid=1, companyName="a", addressDetails={"large": "json"}, region=Region(name="r", latitude=37.5)),
+        {"sid": 2, "companyName": "b", "region": None},
+    ]
+    fields = {"companyName": True, "region": {"name": True}}
+    assert adapter.project(rows, fields) == [
+        {"companyName": "a", "region": {"name": "r"}},
+        {"companyName": "b", "region": None},
+    ]
+    assert adapter.project(rows, None) is rows
+
+
+def test_to_pageable_response_projects_after_the_cursor():
+    rows = [Site(sid=1, companyName="a"), Site(sid=2, companyName="b")]
+    order = [{"sid": "asc"}]
+    test = adapter.to_pageable_response({"_pageSize": "2", "_pageNum": "0"}, rows, 4, order=order, fields={"companyName": True})
+    assert test.content == [{"companyName": "a"}, {"companyName": "b"}]
+    assert adapter.decode_cursor(test.nextCursor) == [2]
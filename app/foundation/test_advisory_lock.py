@@ -0,0 +1,52 @@
+import asyncio
+from datetime import timedelta
+import pytest
+from app.foundation.advisory_lock import advisory_lock
+
+
+class FakeTransactionManager:
+    def __init__(self, events: list):
+        self.events = events
+
+    async def start(self):
+        return self
+
+    async def query_raw(self, query: str, key: str):
+        self.events.append(("lock", key))
+
+    async def rollback(self):
+        self.events.append(("rollback",))
+
+
+class FakeClient:
+    def __init__(self):
+        self.events = []
+
+    def tx(self, max_wait, timeout):
+        return FakeTransactionManager(self.events)
+
+
+@pytest.mark.asyncio
+async def test_advisory_lock_locks_the_sorted_keys():
+    client = FakeClient()
+    async with advisory_lock(client, ["b", "a", "b"]):
+        client.events.append(("run",))
+    assert client.events == [("lock", "a"), ("lock", "b"), ("run",), ("rollback",)]
+
+
+@pytest.mark.asyncio
+async def test_advisory_lock_stops_the_block_when_the_locks_expire():
+    client = FakeClient()
+    with pytest.raises(TimeoutError, match="expired"):
+        async with advisory_lock(client, ["a"], timeout=timedelta(seconds=0.05)):
+            await asyncio.sleep(10)
+    assert client.events == [("lock", "a"), ("rollback",)]
+
+
+@pytest.mark.asyncio
+async def test_advisory_lock_keeps_the_errors_of_the_block():
+    client = FakeClient()
+    with pytest.raises(TimeoutError, match="from the block"):
+        async with advisory_lock(client, ["a"]):
+            raise TimeoutError("from the block")
+    assert client.events[-1] == ("rollback",)
@@ -0,0 +1,81 @@
+import json
+import pytest
+from app.foundation.aggregation import AggregationQuery
+
+FIELD_TYPES = {
+    "str": ["categoryName", "source"],
+    "float": ["emissionTotal"],
+    "datetime": ["periodStartDt"],
+    "bool": ["deleteFlag"],
+    "Json": ["settings"],
+    "NoneType": ["categoryName"],
+}
+query = AggregationQuery("IEmissionData", FIELD_TYPES, condition='NOT t."deleteFlag"')
+
+
+def normalize(sql: str) -> str:
+    return " ".join(sql.split())
+
+
+def test_compile_groups_by_dimensions_and_time_buckets():
+    sql, args, columns = query.compile(
+        dimensions=["periodStartDt:year", "source"], measures=["sum:emissionTotal", "count"]
+    )
+    assert columns == ["periodStartDt:year", "source", "sum:emissionTotal", "count"]
+    assert args == []
+    sql = normalize(sql)
+    assert 'EXTRACT(YEAR FROM t."periodStartDt")::int AS "periodStartDt:year"' in sql
+    assert 'SUM(t."emissionTotal")::double precision AS "sum:emissionTotal"' in sql
+    assert 'COUNT(*)::int AS "count"' in sql
+    assert 'WHERE NOT t."deleteFlag" GROUP BY 1, 2 ORDER BY 1, 2' in sql
+
+
+def test_compile_groups_dimensions_without_measures():
+    sql, _, columns = query.compile(dimensions=["source"])
+    assert columns == ["source"]
+    assert 'GROUP BY 1 ORDER BY 1' in normalize(sql)
+
+
+def test_compile_passes_typed_filters_as_parameters():
+    sql, args, _ = query.compile(
+        dimensions=["periodStartDt:month"],
+        measures=["max:emissionTotal"],
+        filters={
+            "source": {"in": ["calc:gir-db4", "calc:gir-db1"]},
+            "periodStartDt": {"gte": "2020-01-01"},
+            "emissionTotal": {"gt": "0"},
+            "categoryName": {"startsWith": "2_A"},
+            "deleteFlag": "false",
+        },
+        order=["max:emissionTotal:desc"],
+        limit=5,
+    )
+    assert args == [
+        json.dumps(["calc:gir-db4", "calc:gir-db1"]), "2020-01-01T00:00:00", "0.0", "2\\_A%", "false"
+    ]
+    sql = normalize(sql)
+    assert "date_trunc('month', t.\"periodStartDt\")" in sql
+    assert 't."source" IN (SELECT jsonb_array_elements_text($1::jsonb)::text)' in sql
+    assert 't."periodStartDt" >= $2::timestamp' in sql
+    assert 't."emissionTotal" > $3::double precision' in sql
+    assert 't."categoryName" LIKE $4' in sql
+    assert 't."deleteFlag" = $5::boolean' in sql
+    assert sql.endswith("ORDER BY 2 DESC LIMIT 5")
+
+
+@pytest.mark.parametrize("kwargs", [
+    {},
+    {"dimensions": ["unknown"]},
+    {"dimensions": ["settings"]},
+    {"dimensions": ["source:year"]},
+    {"measures": ["sum:source"]},
+    {"measures": ["median:emissionTotal"]},
+    {"measures": ["count"], "filters": {"emissionTotal": {"gt": "a lot"}}},
+    {"measures": ["count"], "filters": {"source": {"like": "x"}}},
+    {"measures": ["count"], "filters": {"source": {"region": {"name": "x"}}}},
+    {"measures": ["count"], "order": ["source"]},
+    {"measures": ["count"], "limit": 0},
+])
+def test_compile_rejects_invalid_aggregations(kwargs):
+    with pytest.raises(ValueError):
+        query.compile(**kwargs)
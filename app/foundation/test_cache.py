@@ -0,0 +1,81 @@
+import pytest
+from app.foundation.cache import ResponseCache
+
+
+class FakeClock:
+    def __init__(self) -> None:
+        self.now = 0.0
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def test_make_key_is_order_independent():
+    first = ResponseCache.make_key("mapdata", years=[2020], category={"categoryName": "2.A", "source": "x"})
+    second = ResponseCache.make_key("mapdata", category={"source": "x", "categoryName": "2.A"}, years=[2020])
+    assert first == second
+    assert first != ResponseCache.make_key("mapdata", years=[2021], category={"categoryName": "2.A", "source": "x"})
+
+
+def test_entries_expire():
+    clock = FakeClock()
+    cache = ResponseCache(ttl=10, clock=clock)
+    cache.set("key", "value")
+    assert cache.get("key") == (True, "value")
+    clock.now = 11
+    assert cache.get("key") == (False, None)
+    assert cache.stats()["hits"] == 1
+    assert cache.stats()["size"] == 0
+
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(max_size=2)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    cache.get("a")
+    cache.set("c", 3)
+    assert cache.get("b") == (False, None)
+    assert cache.get("a") == (True, 1)
+    assert cache.get("c") == (True, 3)
+
+
+def test_invalidate_by_tag():
+    cache = ResponseCache()
+    cache.set("2020", 1, tags=["calc:gir-db4", "calc:gir-db4:2020"])
+    cache.set("2021", 2, tags=["calc:gir-db4", "calc:gir-db4:2021"])
+    cache.set("other", 3, tags=["orig:gir-db1"])
+    assert cache.invalidate(["calc:gir-db4:2020"]) == 1
+    assert cache.get("2021") == (True, 2)
+    assert cache.invalidate(["calc:gir-db4"]) == 1
+    assert cache.invalidate() == 1
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_computes_once():
+    cache = ResponseCache()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        return "value"
+
+    assert await cache.get_or_set("key", compute) == "value"
+    assert await cache.get_or_set("key", compute) == "value"
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_get_or_set_skips_values_invalidated_during_compute():
+    cache = ResponseCache()
+
+    async def compute_during(tags):
+        cache.invalidate(tags)
+        return "stale"
+
+    assert await cache.get_or_set("key", lambda: compute_during(["calc:gir-db4:2020"]), tags=["calc:gir-db4:2020"]) == "stale"
+    assert cache.get("key") == (False, None)
+    assert await cache.get_or_set("key", lambda: compute_during(None), tags=["calc:gir-db4:2020"]) == "stale"
+    assert cache.get("key") == (False, None)
+    # Other tags do not prevent caching
+    assert await cache.get_or_set("key", lambda: compute_during(["orig:gir-db1"]), tags=["calc:gir-db4:2020"]) == "stale"
+    assert cache.get("key") == (True, "stale")
@@ -0,0 +1,137 @@
+import asyncio
+from contextlib import asynccontextmanager
+import pytest
+from app.foundation.jobs import Job, JobRunner
+
+
+@pytest.mark.asyncio
+async def test_job_completes_with_progress():
+    runner = JobRunner()
+
+    async def work(job: Job):
+        job.set_total(4)
+        for _ in range(4):
+            await asyncio.sleep(0)
+            job.advance()
+        return "done"
+
+    job = runner.submit("work", work, unit="relations")
+    assert job.status == "queued"
+    await runner.wait(job.uid)
+    status = job.to_dict()
+    assert status["status"] == "completed"
+    assert status["result"] == "done"
+    assert status["processed"] == 4
+    assert status["progress"] == 1
+    assert status["unit"] == "relations"
+    assert status["rate"] is None or status["rate"] > 0
+
+
+@pytest.mark.asyncio
+async def test_job_failure_is_recorded():
+    runner = JobRunner()
+
+    async def work(job: Job):
+        raise ValueError("boom")
+
+    job = runner.submit("work", work)
+    await runner.wait(job.uid)
+    assert job.status == "failed"
+    assert job.error == "boom"
+
+
+@pytest.mark.asyncio
+async def test_job_cancel():
+    runner = JobRunner()
+    started = asyncio.Event()
+
+    async def work(job: Job):
+        started.set()
+        await asyncio.sleep(60)
+
+    job = runner.submit("work", work)
+    await started.wait()
+    assert runner.cancel(job.uid) is job
+    await runner.wait(job.uid)
+    assert job.status == "cancelled"
+    assert runner.cancel("unknown") is None
+
+
+@pytest.mark.asyncio
+async def test_jobs_sharing_a_lock_key_do_not_overlap():
+    runner = JobRunner()
+    running, overlaps = set(), []
+
+    def make_work(name):
+        async def work(job: Job):
+            if running:
+                overlaps.append(name)
+            running.add(name)
+            await asyncio.sleep(0.01)
+            running.discard(name)
+        return work
+
+    first = runner.submit("first", make_work("first"), lock_keys=["calculate:2020:calc:gir-db4", "calculate:2020:calc:gir-db1"])
+    second = runner.submit("second", make_work("second"), lock_keys=["calculate:2020:calc:gir-db1"])
+    other = runner.submit("other", make_work("other"), lock_keys=["calculate:2021:calc:gir-db1"])
+    await asyncio.sleep(0)
+    assert second.status == "queued"
+    for job in [first, second, other]:
+        await runner.wait(job.uid)
+    assert [job.status for job in [first, second, other]] == ["completed"] * 3
+    # Only the job with an unrelated key ran concurrently
+    assert "second" not in overlaps
+
+
+@pytest.mark.asyncio
+async def test_finished_jobs_are_pruned():
+    runner = JobRunner(max_history=2)
+
+    async def work(job: Job):
+        return None
+
+    jobs = []
+    for index in range(4):
+        jobs.append(runner.submit(f"work-{index}", work))
+        await runner.wait(jobs[-1].uid)
+    assert len(runner.jobs) <= 3
+    assert runner.get(jobs[-1].uid) is jobs[-1]
+    assert [job.uid for job in runner.list(status="completed")][0] == jobs[-1].uid
+
+
+@pytest.mark.asyncio
+async def test_cross_process_lock_wraps_the_job():
+    events = []
+
+    @asynccontextmanager
+    async def cross_process_lock(keys):
+        events.append(("lock", keys))
+        yield
+        events.append(("unlock", keys))
+
+    runner = JobRunner(cross_process_lock=cross_process_lock)
+
+    async def work(job: Job):
+        events.append(("run", job.status))
+
+    await runner.wait(runner.submit("work", work, lock_keys=["b", "a"]).uid)
+    await runner.wait(runner.submit("unlocked", work).uid)
+    assert events == [("lock", ["a", "b"]), ("run", "running"), ("unlock", ["a", "b"]), ("run", "running")]
+
+
+@pytest.mark.asyncio
+async def test_lock_serializes_inline_work():
+    runner = JobRunner()
+    events = []
+
+    async def work(job: Job):
+        async with runner.lock(["summaries"]):
+            events.append(("start", job.name))
+            await asyncio.sleep(0)
+            events.append(("end", job.name))
+
+    first = runner.submit("first", work)
+    second = runner.submit("second", work)
+    await runner.wait(first.uid)
+    await runner.wait(second.uid)
+    assert events == [("start", "first"), ("end", "first"), ("start", "second"), ("end", "second")]
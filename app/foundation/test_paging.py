@@ -0,0 +1,79 @@
+import pytest
+from app.foundation.paging import TABLE_ROW_ESTIMATE, fetch_page_and_count, page_counts, page_count_mode
+
+
+class Client:
+    def __init__(self, estimate: int) -> None:
+        self.estimate = estimate
+        self.queries = []
+
+    async def query_raw(self, query: str, *args):
+        self.queries.append((query, args))
+        return [{"count": self.estimate}]
+
+
+def fetchers(content: list, count: int):
+    calls = []
+
+    async def fetch_content():
+        calls.append("content")
+        return content
+
+    async def fetch_count():
+        calls.append("count")
+        return count
+
+    return fetch_content, fetch_count, calls
+
+
+def setup_function():
+    page_counts.invalidate()
+
+
+def test_page_count_mode():
+    assert page_count_mode({}) == "exact"
+    assert page_count_mode({"_count": "estimate"}) == "estimate"
+    with pytest.raises(ValueError):
+        page_count_mode({"_count": "none"})
+
+
+@pytest.mark.asyncio
+async def test_exact_count():
+    fetch_content, fetch_count, calls = fetchers(None, 42)
+    result = await fetch_page_and_count({}, {"take": 10, "skip": 0}, {}, fetch_content, fetch_count, Client(100), "T")
+    assert result == ([], 42, False)
+    assert sorted(calls) == ["content", "count"]
+
+
+@pytest.mark.asyncio
+async def test_estimate_of_a_partial_page_is_exact():
+    fetch_content, fetch_count, calls = fetchers([1, 2], 42)
+    query = {"_count": "estimate"}
+    result = await fetch_page_and_count(query, {"take": 10, "skip": 20}, {"a": 1}, fetch_content, fetch_count, Client(100), "T")
+    assert result == ([1, 2], 22, False)
+    assert calls == ["content"]
+
+
+@pytest.mark.asyncio
+async def test_estimate_without_filters_reads_the_planner():
+    fetch_content, fetch_count, calls = fetchers([1, 2], 42)
+    client = Client(1000)
+    query = {"_count": "estimate", "_cursor": "x"}
+    result = await fetch_page_and_count(query, {"take": 2, "skip": 0}, {}, fetch_content, fetch_count, client, "T")
+    assert result == ([1, 2], 1000, True)
+    assert client.queries == [(TABLE_ROW_ESTIMATE, ('"T"',))]
+    assert calls == ["content"]
+    # Never analyzed
+    client.estimate = -1
+    result = await fetch_page_and_count(query, {"take": 2, "skip": 0}, {}, fetch_content, fetch_count, client, "T")
+    assert result == ([1, 2], 42, True)
+
+
+@pytest.mark.asyncio
+async def test_estimate_with_filters_is_cached():
+    fetch_content, fetch_count, calls = fetchers([1, 2], 42)
+    query = {"_count": "estimate"}
+    for filters in [{"a": 1, "b": 2}, {"b": 2, "a": 1}]:
+        result = await fetch_page_and_count(query, {"take": 2, "skip": 0}, filters, fetch_content, fetch_count, Client(1000), "T")
+        assert result == ([1, 2], 42, True)
+    assert calls == ["content", "count", "content"]
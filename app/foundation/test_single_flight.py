@@ -0,0 +1,50 @@
+import asyncio
+import pytest
+from app.foundation.single_flight import SingleFlight
+
+
+@pytest.mark.asyncio
+async def test_concurrent_calls_share_one_computation():
+    flight = SingleFlight()
+    calls = []
+
+    async def compute():
+        calls.append(1)
+        count = len(calls)
+        await asyncio.sleep(0.01)
+        return count
+
+    results = await asyncio.gather(*[flight.do("key", compute) for _ in range(5)], flight.do("other", compute))
+    assert results[:5] == [1] * 5
+    assert len(calls) == 2
+    assert flight.coalesced == 4
+    assert flight.flights == {}
+    # Finished calls are not cached
+    assert await flight.do("key", compute) == 3
+
+
+@pytest.mark.asyncio
+async def test_errors_are_raised_to_every_caller():
+    flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    results = await asyncio.gather(flight.do("key", compute), flight.do("key", compute), return_exceptions=True)
+    assert [str(result) for result in results] == ["boom", "boom"]
+
+
+@pytest.mark.asyncio
+async def test_cancelled_caller_does_not_cancel_the_others():
+    flight = SingleFlight()
+
+    async def compute():
+        await asyncio.sleep(0.01)
+        return "done"
+
+    first = asyncio.ensure_future(flight.do("key", compute))
+    second = asyncio.ensure_future(flight.do("key", compute))
+    await asyncio.sleep(0)
+    first.cancel()
+    assert await second == "done"
@@ -67,4 +67,5 @@ class EmissionDataImporter:
                 print(f'Inserting row {row} failed. Perhaps it already exists. {e}')   
             finally:
                 pass
+        await service.refresh_summaries_for_rows(df_data)
         
\ No newline at end of file
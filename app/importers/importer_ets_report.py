@@ -16,7 +16,7 @@ class EtsReportImporter:
         self.data_start_row = 5
         self.sheet_def = {"명세서 주요정보(2022)_할당대상업체_23.12":{"start_row": 5, "end_row": 712}, "명세서 주요정보(2022)_목표관리업체_23.12":{"start_row": 5, "end_row": 394}}
 
-    async def import_data(self, filepath: str):
+    async def import_data(self, filepath: str, distribute: bool = False):
         filetype = self.files.get_file_extension(filepath)
         sheets = self.files.get_excel_sheet_names(filepath, filepath)
         df = pd.DataFrame()
@@ -25,14 +25,18 @@ class EtsReportImporter:
             _sheet_data.rename(columns=ets_report_col_map, inplace=True)
             df = pd.concat([df, _sheet_data], ignore_index=True)
         emissions_df, iorganization_df = await self.prepare(df)
-        emission_types = model_fields_into_type_map(prisma.models.IEmissionData.model_fields)
         iorganization_types = model_fields_into_type_map(prisma.models.IOrganization.model_fields)
-        for row1, row2 in tqdm(zip(emissions_df.to_dict(orient="records"), iorganization_df.to_dict(orient="records")), total=len(emissions_df)):
-            row2 = cast_dict_to_types(row2, iorganization_types)
-            created_org = await self.organization_service.update_or_create(data=row2, where={"legalName": row2["legalName"]})
-            row1["organizationUid"] = created_org.uid
-            row1 = cast_dict_to_types(row1, emission_types)
-            await self.emission_service.update_or_create(data=row1, where={"source": row1["source"], "periodStartDt": row1["periodStartDt"], "periodEndDt": row1["periodEndDt"], "organizationUid": row1["organizationUid"]})
+        organization_uids = []
+        for row in tqdm(iorganization_df.to_dict(orient="records"), total=len(iorganization_df)):
+            row = cast_dict_to_types(row, iorganization_types)
+            created_org = await self.organization_service.update_or_create(data=row, where={"legalName": row["legalName"]})
+            organization_uids.append(created_org.uid)
+        emissions_df["organizationUid"] = organization_uids
+        # The emission rows (and with distribute, the rows of every site of the organizations) are written in bulk.
+        # The report has no pollutant and only the totals, the other fields stay NULL.
+        await self.emission_service.create_org_emissions_bulk(
+            emissions_df, distribute=distribute, pollutant_id=None, fill_value=None
+        )
 
 
     async def prepare(self, df: pd.DataFrame):
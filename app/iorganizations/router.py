@@ -1,8 +1,10 @@
 import logging
+from functools import partial
 from fastapi import APIRouter, HTTPException, Request, UploadFile
 import prisma
 from app.foundation.adapter_prisma import PrismaAdapter
 from app.foundation.field_type_match import cast_dict_to_types, model_fields_into_type_map
+from app.foundation.paging import fetch_page_and_count, page_count_mode
 from app.iorganizations.service import IOrganizationService
 
 service = IOrganizationService()
@@ -23,7 +25,20 @@ async def count():
 async def get_by_id(uid: str):
     return await service.fetch_many(where={"uid": uid})
 
-@router.get("/iorganizations-group/")
+@router.get("/iorganizations-aggregate/")
+async def aggregate(request: Request):
+    """
+    Aggregates the organizations in one query, with a columnar response. Query: _dimensions, _measures, _sort,
+    _limit and the filters of /iorganizations/, see /iemissiondata-aggregate/. E.g. the organizations and their
+    employees per sector and size: _dimensions=sectorMain,sizeCategory&_measures=count,sum:numEmployees&_sort=count:desc.
+    """
+    query_params = request.query_params._dict
+    try:
+        return await service.aggregate(**adapter.to_aggregation_args(query_params))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/iorganizations-group/", deprecated=True)
 async def group(count=None, by=None, sum=None, order=None, having=None):
     return await service.group_by(
         count=count, by=by, sum=sum, order=order, having=having
@@ -33,32 +48,51 @@ async def group(count=None, by=None, sum=None, order=None, having=None):
 async def get_orgs(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    return await service.fetch_paged(
-        where=query_args, take=query_args.take, skip=query_args.take * query_args.page
+    try:
+        offset_args = adapter.to_offset_args(query_params)
+        fields = adapter.to_fields_args(query_params, prisma.models.IOrganization.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    results = await service.fetch_paged(
+        where=query_args,
+        include=adapter.include_projected(None, fields),
+        **offset_args,
     )
+    return adapter.project(results, fields)
 
 @router.get("/iorganizations.paged/")
 async def get_paged(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    page_size = int(query_params["_pageSize"])
-    page_num = int(query_params["_pageNum"])
-    include = query_params.get("_include", None)
-    _sort = query_params.get("_sort", None)
-    sort = adapter.to_sort_object(_sort)
+    try:
+        page_args = adapter.to_page_args(query_params, prisma.models.IOrganization.model_fields)
+        page_count_mode(query_params)
+        fields = adapter.to_fields_args(query_params, prisma.models.IOrganization.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    include = (
+        adapter.to_include_exclude_args(query_params["_include"])
+        if "_include" in query_params
+        else None
+    )
+    include = adapter.include_projected(include, fields)
 
-    content = await service.fetch_paged(
-        where=query_args,
-        take=page_size,
-        skip=page_size * page_num,
-        include=include,
-        order=sort
-    )  ##TODO: Group these to a single query
-    if content is None:
-        content = []
-    count = await service.fetch_count(where=query_args)
+    content, count, approximate = await fetch_page_and_count(
+        query_params,
+        page_args,
+        query_args,
+        fetch_content=partial(service.fetch_paged, **page_args, include=include),
+        fetch_count=partial(service.fetch_count, where=query_args),
+        client=service.prisma,
+        table="IOrganization",
+    )
     response = adapter.to_pageable_response(
-        query=query_params, response=content, count=count
+        query=query_params,
+        response=content,
+        count=count,
+        order=page_args["order"],
+        approximate=approximate,
+        fields=fields,
     )
     return response
 
@@ -8,6 +8,12 @@ from app.foundation.exception import catch_errors_decorator
 from tqdm import tqdm
 from app.utils.file import FileUtils
 from app.config.column_mapping import iorganization_map
+from app.foundation.aggregation import AggregationQuery
+from app.foundation.field_type_match import model_fields_into_type_map
+
+
+# Typed aggregations of the organizations, see aggregate
+IORGANIZATION_AGGREGATION = AggregationQuery("IOrganization", model_fields_into_type_map(prisma.models.IOrganization.model_fields))
 
 
 class IOrganizationService:
@@ -172,27 +178,39 @@ class IOrganizationService:
             count=count, by=by, sum=sum, order=order, having=having
         )
 
+    async def aggregate(self, dimensions=(), measures=(), filters=None, order=(), limit=None) -> dict:
+        """
+        Aggregates the organizations in one query (see AggregationQuery.compile),
+        e.g. dimensions=["sectorMain", "sizeCategory"], measures=["count", "sum:numEmployees"].
+
+        Returns:
+            dict: One list per dimension and measure.
+        """
+        return await IORGANIZATION_AGGREGATION.fetch(
+            self.prisma, dimensions=dimensions, measures=measures, filters=filters, order=order, limit=limit
+        )
+
     @catch_errors_decorator
     async def _fetch_page(
-        self, cursor: str, page_size=10
-    ) -> tuple[list[prisma.models.IOrganization], str]:
+        self, cursor: int | None, page_size=10
+    ) -> tuple[list[prisma.models.IOrganization], int]:
         """
         Fetches a page of organizations from the database.
 
         Args:
-            cursor (str): The cursor used for pagination.
+            cursor (int): The sid of the last row of the previous page, None for the first page.
             page_size (int, optional): The number of results per page. Defaults to 10.
 
         Returns:
-            Tuple[List[prisma.models.IOrganization], str]: A tuple containing a list of organizations
+            Tuple[List[prisma.models.IOrganization], int]: A tuple containing a list of organizations
                 and the next cursor for pagination.
         """
         results = await self.prisma.iorganization.find_many(
             take=page_size,
-            cursor={"id": cursor} if cursor else None,
-            order={"id": "asc"},
+            where={"sid": {"gt": cursor}} if cursor is not None else None,
+            order={"sid": "asc"},
         )
-        next_cursor = results[-1].id if results else None
+        next_cursor = results[-1].sid if results else None
         return results, next_cursor
 
     @catch_errors_decorator
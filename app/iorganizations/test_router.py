@@ -0,0 +1,15 @@
+import pytest
+from starlette.requests import Request
+from app.iorganizations import router
+
+
+def request_with(query_string: bytes) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/api/iorganizations/", "query_string": query_string, "headers": []})
+
+
+@pytest.mark.asyncio
+async def test_get_orgs_pages_with_page_size_and_number(mocker):
+    fetch_paged = mocker.patch.object(router.service, "fetch_paged", return_value=[])
+    response = await router.get_orgs(request_with(b"_pageSize=5&_pageNum=2&name=A"))
+    assert response == []
+    fetch_paged.assert_awaited_once_with(where={"name": "A"}, include=None, take=5, skip=10)
@@ -1,10 +1,13 @@
 import logging
+from functools import partial
 from fastapi import APIRouter, HTTPException, Request, UploadFile
 import pandas as pd
 import prisma
 from app.iorgsites.service import IOrgSiteService
 from app.foundation.adapter_prisma import PrismaAdapter
+from app.foundation.jobs import job_runner
 from app.foundation.field_type_match import cast_dict_to_types, model_fields_into_type_map
+from app.foundation.paging import fetch_page_and_count, page_count_mode
 
 service = IOrgSiteService()
 adapter = PrismaAdapter()
@@ -21,7 +24,21 @@ async def count():
 
 
 
-@router.get("/iorgsites-group")
+@router.get("/iorgsites-aggregate/")
+async def aggregate(request: Request):
+    """
+    Aggregates the org sites in one query, with a columnar response. Query: _dimensions, _measures, _sort, _limit
+    and the filters of /iorgsite/, see /iemissiondata-aggregate/. E.g. the sites and their facility area per region
+    and operation start year: _dimensions=addressRegionName,operationStartDt:year
+    &_measures=count,sum:manufacturingFacilityArea&_sort=sum:manufacturingFacilityArea:desc.
+    """
+    query_params = request.query_params._dict
+    try:
+        return await service.aggregate(**adapter.to_aggregation_args(query_params))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+
+@router.get("/iorgsites-group", deprecated=True)
 async def group(count=None, by=None, sum=None, order=None, having=None):
     return await service.group_by(
         count=count, by=by, sum=sum, order=order, having=having
@@ -34,7 +51,14 @@ async def upload(file: UploadFile):
 
 @router.put("/iorgsites-address-all/")
 async def update_addresses():
-    return await service.populate_addresses()
+    job = job_runner.submit("populate_addresses", service.populate_addresses, lock_keys=["iorgsites:sites"], unit="sites")
+    return job.to_dict()
+
+
+@router.put("/iorgsites-relations-all/")
+async def update_relations():
+    job = job_runner.submit("update_relations_alt", service.update_relations_alt, lock_keys=["iorgsites:sites"], unit="sites")
+    return job.to_dict()
 
 
 @router.put("/iorgsites-address/{uid}/")
@@ -45,10 +69,19 @@ async def update_single_address(uid: str):
 async def get(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    include = query_params.get("_include", None)
-    return await service.fetch_paged(
-        where=query_args, take=query_args.take, skip=query_args.take * query_args.page, include=include
+    try:
+        offset_args = adapter.to_offset_args(query_params)
+        fields = adapter.to_fields_args(query_params, prisma.models.IOrgSite.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    include = (
+        adapter.to_include_exclude_args(query_params["_include"])
+        if "_include" in query_params
+        else None
     )
+    include = adapter.include_projected(include, fields)
+    results = await service.fetch_paged(where=query_args, include=include, **offset_args)
+    return adapter.project(results, fields)
 
 @router.get("/iorgsites/{uid}/")
 async def get_by_id(uid: str):
@@ -58,25 +91,34 @@ async def get_by_id(uid: str):
 async def get_paged(request: Request):
     query_params = request.query_params._dict
     query_args = adapter.to_query_args(query=query_params)
-    page_size = int(query_params["_pageSize"])
-    page_num = int(query_params["_pageNum"])
+    try:
+        page_args = adapter.to_page_args(query_params, prisma.models.IOrgSite.model_fields)
+        page_count_mode(query_params)
+        fields = adapter.to_fields_args(query_params, prisma.models.IOrgSite.model_fields)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     include = (
         adapter.to_include_exclude_args(query_params["_include"])
         if "_include" in query_params
         else None
     )    
-    _sort = query_params.get("_sort", None)
-    sort = adapter.to_sort_object(_sort)
-    content = await service.fetch_paged(
-        where=query_args,
-        take=page_size,
-        skip=page_size * page_num,
-        include=include,
-        order=sort
-    )  ##TODO: Group these to a single query
-    count = await service.fetch_count(where=query_args)
+    include = adapter.include_projected(include, fields)
+    content, count, approximate = await fetch_page_and_count(
+        query_params,
+        page_args,
+        query_args,
+        fetch_content=partial(service.fetch_paged, **page_args, include=include),
+        fetch_count=partial(service.fetch_count, where=query_args),
+        client=service.prisma,
+        table="IOrgSite",
+    )
     response = adapter.to_pageable_response(
-        query=query_params, response=content, count=count
+        query=query_params,
+        response=content,
+        count=count,
+        order=page_args["order"],
+        approximate=approximate,
+        fields=fields,
     )
     return response
 
@@ -28,6 +28,18 @@ from app.iorgsites.adapters.adapter_address import fix_address_string
 from app.utils.string import get_coords_from_detail, get_regions_as_tuple
 from app.utils.data_types import parse_to_date
 from app.emission_data.service import IEmissionDataService
+from app.foundation.jobs import Job
+from app.foundation.aggregation import AggregationQuery
+
+# Site fields used by the emission allocation. Changing them makes the calculated emissions of the site's categories dirty.
+ALLOCATION_FIELDS = [
+    "manufacturingFacilityArea", "operationStartDt", "sectorIds", "sectorIdMain",
+    "addressRegionUid", "addressSubRegion", "longitude", "latitude",
+]
+
+# Typed aggregations of the org sites, see aggregate
+IORGSITE_AGGREGATION = AggregationQuery("IOrgSite", model_fields_into_type_map(prisma.models.IOrgSite.model_fields))
+
 
 class IOrgSiteService:
     def __init__(self):
@@ -56,9 +68,12 @@ class IOrgSiteService:
         existing_record = await self.prisma.iorgsite.find_first(where=where)
 
         if existing_record:
-            return await self.prisma.iorgsite.update(
-                where={"uid": existing_record.uid}, data=data
+            site = await self.prisma.iorgsite.update(
+                where={"uid": existing_record.uid}, data={**data, "dateModified": datetime.now()}
             )
+            if site and any(field in data for field in ALLOCATION_FIELDS):
+                await self.mark_site_dirty(site.uid, reason="site:update")
+            return site
         else:
             return await self.prisma.iorgsite.create(data=data)
 
@@ -80,9 +95,13 @@ class IOrgSiteService:
         Returns:
             None
         """
-        return await self.prisma.iorgsite.upsert(
-            data={"create": data, "update": data}, where=where
+        site = await self.prisma.iorgsite.upsert(
+            data={"create": data, "update": {**data, "dateModified": datetime.now()}}, where=where
         )
+        # A created site has no relations yet, so only an updated one has calculated emissions to mark
+        if site and any(field in data for field in ALLOCATION_FIELDS):
+            await self.mark_site_dirty(site.uid, reason="site:update")
+        return site
 
     @return_list
     async def create(self, data: prisma.types.IOrgSiteCreateInput) -> prisma.models.IOrgSite | None:
@@ -111,7 +130,26 @@ class IOrgSiteService:
         Returns:
             None
         """
-        return await self.prisma.iorgsite.update(where=where, data=data, include=include)
+        updated_site = await self.prisma.iorgsite.update(
+            where=where, data={**data, "dateModified": datetime.now()}, include=include
+        )
+        if updated_site and any(field in data for field in ALLOCATION_FIELDS):
+            await self.mark_site_dirty(updated_site.uid, reason="site:update")
+        return updated_site
+
+    async def mark_site_dirty(self, uid: str, reason: str, categories: list[str] | None = None) -> None:
+        """
+        Marks the calculated emissions of every category the site is related to as dirty,
+        see IEmissionDataService.mark_dirty.
+
+        Args:
+            uid (str): The UID of the site.
+            reason (str): What changed on the site.
+            categories (list[str], optional): Additional categories, e.g. the ones of relations about to be replaced.
+        """
+        rels = await self.rel_service.fetch_many(where={"siteUid": uid})
+        site_categories = {rel.categoryName for rel in rels or []} | set(categories or [])
+        await self.emission_service.mark_dirty(list(site_categories), reason=reason)
 
     @catch_errors_decorator
     async def delete(self, where: prisma.types.IOrgSiteWhereInput) -> None:
@@ -219,27 +257,39 @@ class IOrgSiteService:
             count=count, by=by, sum=sum, order=order, having=having
         )
 
+    async def aggregate(self, dimensions=(), measures=(), filters=None, order=(), limit=None) -> dict:
+        """
+        Aggregates the org sites in one query (see AggregationQuery.compile),
+        e.g. dimensions=["addressRegionName", "operationStartDt:year"], measures=["sum:manufacturingFacilityArea"].
+
+        Returns:
+            dict: One list per dimension and measure.
+        """
+        return await IORGSITE_AGGREGATION.fetch(
+            self.prisma, dimensions=dimensions, measures=measures, filters=filters, order=order, limit=limit
+        )
+
     @catch_errors_decorator
-    async def _fetch_page( ##TODO: Make sure this works
-        self, cursor: str, page_size=10
-    ) -> tuple[list[prisma.models.IOrgSite], str]:
+    async def _fetch_page(
+        self, cursor: int | None, page_size=10
+    ) -> tuple[list[prisma.models.IOrgSite], int]:
         """
         Fetches a page of org sites from the database.
 
         Args:
-            cursor (str): The cursor used for pagination.
+            cursor (int): The sid of the last row of the previous page, None for the first page.
             page_size (int, optional): The number of results per page. Defaults to 10.
 
         Returns:
-            Tuple[List[prisma.models.IOrgSite], str]: A tuple containing a list of org sites
+            Tuple[List[prisma.models.IOrgSite], int]: A tuple containing a list of org sites
                 and the next cursor for pagination.
         """
         results = await self.prisma.iorgsite.find_many(
             take=page_size,
-            cursor={"uid": cursor} if cursor else None,
+            where={"sid": {"gt": cursor}} if cursor is not None else None,
             order={"sid": "asc"},
         )
-        next_cursor = results[-1].uid if results else None
+        next_cursor = results[-1].sid if results else None
         return results, next_cursor
 
     @catch_errors_decorator
@@ -418,10 +468,13 @@ class IOrgSiteService:
         return structured_address, address_detail
 
     @catch_errors_decorator
-    async def populate_addresses(self) -> None:
+    async def populate_addresses(self, job: Job | None = None) -> None:
         """
         Asynchronously populates addresses.
 
+        Args:
+            job (Job, optional): The background job running the population (see app.foundation.jobs).
+
         Returns:
             None
 
@@ -429,8 +482,12 @@ class IOrgSiteService:
             Exception: If an error occurs during the population of addresses.
         """
         sites = await self.find_many(where={"structuredAddress": None})
+        if job:
+            job.set_total(len(sites))
         for site in tqdm(sites, total=len(sites)):
             await self.populate_single_address(site)
+            if job:
+                job.advance()
 
     #TODO: Seems like there is empty strings in the xlsx file. Clear them when importing
     @catch_errors_decorator
@@ -466,7 +523,7 @@ class IOrgSiteService:
             site = await self.connect_address(site)
         if latitude is None or longitude is None:
             latitude, longitude = site.addressRegion.latitude if site.addressRegion else None, site.addressRegion.longitude if site.addressRegion else None
-        return await self.prisma.iorgsite.update(
+        updated_site = await self.prisma.iorgsite.update(
             where={"uid": site.uid},
             data={
                 "structuredAddress": address_dict.get(structured_address) or structured_address,
@@ -474,9 +531,12 @@ class IOrgSiteService:
                 "latitude": float(latitude) if latitude is not None else None,
                 "longitude": float(longitude) if longitude is not None else None,
                 "addressRegionName": region,
-                "addressSubRegion": subregion
+                "addressSubRegion": subregion,
+                "dateModified": datetime.now(),
             },
         )
+        await self.mark_site_dirty(site.uid, reason="site:address")
+        return updated_site
 
     async def connect_address(self, site: prisma.models.IOrgSite) -> None:
         """
@@ -542,6 +602,7 @@ class IOrgSiteService:
             sector_count = len(sectors)
             contribution_magnitude = proxy_field / sector_count
 
+            previous_rels = await self.rel_service.fetch_many(where={"siteUid": uid})
             await self.rel_service.delete_many(where={"siteUid": uid}) #TODO: This is slower but we need to have this in order to account for chancing sectorids
             for sector in sectors:
                 sector = sector.strip()
@@ -564,6 +625,9 @@ class IOrgSiteService:
                         data=relation_obj,
                         where={"siteUid": uid, "sectorId": relation_obj["sectorId"], 'categoryLevel': lvl},
                     )
+            await self.mark_site_dirty(
+                uid, reason="site:relations", categories=[rel.categoryName for rel in previous_rels or []]
+            )
 
     async def update_relations(self) -> None:
         """
@@ -611,11 +675,12 @@ class IOrgSiteService:
             if rel:
                 await self.emission_service.calculate_emissions(rel)
 
-    async def update_relations_alt(self)-> None:
+    async def update_relations_alt(self, job: Job | None = None)-> None:
         """
         Update the relations of the object asynchronously. This is the alternative version of this function
         since it only fetches the sites that are include mapped sectors.
 
+        :param job: The background job running the update (see app.foundation.jobs), optional.
         :return: None
         """
         sites = await self.prisma.query_raw(
@@ -625,9 +690,13 @@ class IOrgSiteService:
             WHERE "sectorIds" ~ ('(^|\s*,\s*)(' || array_to_string(ARRAY{list(ipcc_to_gir.keys())}::text[], '|') || ')(\s*,|$)');
             """, model=prisma.models.IOrgSite
         )
+        if job:
+            job.set_total(len(sites))
         for site in tqdm(sites, total=len(sites), desc="Updating relations"):
             await self.populate_single_address(site=site)
             await self.update_relation_single(site=site)
+            if job:
+                job.advance()
 
     async def add_site(self, site: prisma.models.IOrgSite) -> None:
         try:
@@ -640,6 +709,7 @@ class IOrgSiteService:
             return e
 
     async def delete_site(self, uid: str) -> Tuple[int, prisma.models.IOrgSite]:
+        await self.mark_site_dirty(uid, reason="site:delete")
         deleted_site = await self.prisma.iorgsite.delete(where={"uid": uid},include={"organization": True})
         if deleted_site:
             if deleted_site.organizationUid:
@@ -648,7 +718,11 @@ class IOrgSiteService:
             return deleted_site
 
     async def update_site(self, orgUid: str | None, data: prisma.models.IOrgSite) -> prisma.models.IOrgSite:
-        updated_site = await self.prisma.iorgsite.update(where={"uid": data.get("uid")}, data=data)
+        updated_site = await self.prisma.iorgsite.update(
+            where={"uid": data.get("uid")}, data={**data, "dateModified": datetime.now()}
+        )
+        if any(field in data for field in ALLOCATION_FIELDS):
+            await self.mark_site_dirty(updated_site.uid, reason="site:update")
         if orgUid is None:
             orgUid = updated_site.organizationUid
         site_count = await self.prisma.iorgsite.count(where={"organizationUid": orgUid})
@@ -60,3 +60,20 @@
 #     assert (
 #         response.status_code == 200
 #     )  ##TODO: figure out how to prepare mock data for fastapi tests
+
+
+import pytest
+from starlette.requests import Request
+from app.iorgsites import router
+
+
+def request_with(query_string: bytes) -> Request:
+    return Request({"type": "http", "method": "GET", "path": "/api/iorgsite/", "query_string": query_string, "headers": []})
+
+
+@pytest.mark.asyncio
+async def test_get_pages_with_page_size_and_number(mocker):
+    fetch_paged = mocker.patch.object(router.service, "fetch_paged", return_value=[])
+    response = await router.get(request_with(b"_pageSize=5&_pageNum=2&companyName=A"))
+    assert response == []
+    fetch_paged.assert_awaited_once_with(where={"companyName": "A"}, include=None, take=5, skip=10)
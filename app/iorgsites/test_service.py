@@ -87,6 +87,16 @@ def test_upload_iorgsites_buffer_and_path(setup_db):
 async def test_upload_iorgsites_no_arguments(setup_db):
     service.upload_iorgsites()
 
+@pytest.mark.asyncio
+@pytest.mark.skipif(ENV_IS_GITHUB, reason="database not available on github actions env")
+async def test_update_sets_date_modified(setup_db):
+    site = await service.create(data={
+        "companyName": "a", "factoryManagementNumber": "a", "landAddress": "a", "dataSource": "test", "keyHash": "a",
+    })
+    assert site.dateModified is None
+    updated = await service.update(data={"companyName": "b"}, where={"uid": site.uid})
+    assert updated.companyName == "b" and updated.dateModified is not None
+
 @pytest.mark.skip("WIP")
 @pytest.mark.asyncio
 async def test_request_address_with_streetAddress():
@@ -184,25 +184,25 @@ class ISiteCategoryRelService:
         )
 
     async def _fetch_page(
-        self, cursor: str, page_size=10
-    ) -> tuple[list[prisma.models.ISiteCategoryRel], str]:
+        self, cursor: int | None, page_size=10
+    ) -> tuple[list[prisma.models.ISiteCategoryRel], int]:
         """
         Fetches a page of org sites from the database.
 
         Args:
-            cursor (str): The cursor used for pagination.
+            cursor (int): The sid of the last row of the previous page, None for the first page.
             page_size (int, optional): The number of results per page. Defaults to 10.
 
         Returns:
-            Tuple[List[prisma.models.ISiteCategoryRel], str]: A tuple containing a list of org sites
+            Tuple[List[prisma.models.ISiteCategoryRel], int]: A tuple containing a list of org sites
                 and the next cursor for pagination.
         """
         results = await self.prisma.isitecategoryrel.find_many(
             take=page_size,
-            cursor={"id": cursor} if cursor else None,
-            order={"id": "asc"},
+            where={"sid": {"gt": cursor}} if cursor is not None else None,
+            order={"sid": "asc"},
         )
-        next_cursor = results[-1].id if results else None
+        next_cursor = results[-1].sid if results else None
         return results, next_cursor
 
     async def fetch_paged(
@@ -227,14 +227,14 @@ class ISiteCategoryRelService:
     async def fetch_all_paginated(self):
         pass
 
-    async def fetch_count(self) -> int:
+    async def fetch_count(self, where: prisma.types.ISiteCategoryRelWhereInput = None) -> int:
         """
         Fetches the count of the ISiteCategoryRel table.
 
         Returns:
             int: The count of the ISiteCategoryRel table.
         """
-        return await self.prisma.isitecategoryrel.count()
+        return await self.prisma.isitecategoryrel.count(where=where)
 
     # async def api_to_gir_address(self):
     #     """
@@ -0,0 +1,32 @@
+import logging
+from fastapi import APIRouter, HTTPException
+from app.foundation.jobs import JOB_STATUSES, job_runner
+
+logger = logging.getLogger(__name__)
+router = APIRouter(
+    prefix="/api",
+    tags=["jobs"],
+)
+
+
+@router.get("/jobs/")
+async def get_jobs(status: str | None = None):
+    if status is not None and status not in JOB_STATUSES:
+        raise HTTPException(status_code=400, detail=f"status must be one of {JOB_STATUSES}")
+    return [job.to_dict() for job in job_runner.list(status=status)]
+
+
+@router.get("/jobs/{uid}/")
+async def get_job(uid: str):
+    job = job_runner.get(uid)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {uid} not found")
+    return job.to_dict()
+
+
+@router.delete("/jobs/{uid}/")
+async def cancel_job(uid: str):
+    job = job_runner.cancel(uid)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job {uid} not found")
+    return job.to_dict()
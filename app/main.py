@@ -1,5 +1,6 @@
 
 from contextlib import asynccontextmanager
+from functools import partial
 import logging
 from fastapi import FastAPI
 from fastapi.responses import ORJSONResponse
@@ -9,7 +10,11 @@ from app.iorgsites import router as iorgsites
 from app.region import router as region
 from app.emission_data import router as emission_data
 from app.database import  get_connection
+from app.foundation.advisory_lock import advisory_lock
+from app.foundation.jobs import job_runner
 from app.code import router as code
+from app.jobs import router as jobs
+from app.tiles import router as tiles
 
 logger = logging.getLogger(__name__)
 logger.setLevel(logging.INFO)
@@ -25,6 +30,8 @@ async def lifespan(app: FastAPI):
     
     get_connection()
     await client.connect()
+    # The API may run several workers, the jobs writing the same data must not overlap across them
+    job_runner.cross_process_lock = partial(advisory_lock, client)
     yield
     await client.disconnect()
 
@@ -34,6 +41,8 @@ app.include_router(iorganizations.router)
 app.include_router(emission_data.router)
 app.include_router(region.router)
 app.include_router(code.router)
+app.include_router(jobs.router)
+app.include_router(tiles.router)
 
 api_logger = logging.getLogger(__name__)
 logging.basicConfig(level=logging.INFO)
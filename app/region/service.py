@@ -160,25 +160,25 @@ class RegionService:
         )
 
     async def _fetch_page(
-        self, cursor: str, page_size=10
-    ) -> tuple[list[prisma.models.Region], str]:
+        self, cursor: int | None, page_size=10
+    ) -> tuple[list[prisma.models.Region], int]:
         """
         Fetches a page of organizations from the database.
 
         Args:
-            cursor (str): The cursor used for pagination.
+            cursor (int): The sid of the last row of the previous page, None for the first page.
             page_size (int, optional): The number of results per page. Defaults to 10.
 
         Returns:
-            Tuple[List[prisma.models.Region], str]: A tuple containing a list of organizations
+            Tuple[List[prisma.models.Region], int]: A tuple containing a list of organizations
                 and the next cursor for pagination.
         """
         results = await self.prisma.region.find_many(
             take=page_size,
-            cursor={"id": cursor} if cursor else None,
-            order={"id": "asc"},
+            where={"sid": {"gt": cursor}} if cursor is not None else None,
+            order={"sid": "asc"},
         )
-        next_cursor = results[-1].id if results else None
+        next_cursor = results[-1].sid if results else None
         return results, next_cursor
 
     async def fetch_paged(
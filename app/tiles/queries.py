@@ -0,0 +1,90 @@
+"""
+Raw SQL used by the tile service to read only the points of a tile, clustered at low zoom levels.
+
+Queries are parameterized ($1, $2, ...) and are executed with ``query_raw``. The bounds of the tile are
+$1 south, $2 west, $3 north, $4 east.
+"""
+from app.utils.units import source_unit_sql
+
+_SITES_WITHIN = """
+    FROM "IOrgSite" s
+    WHERE NOT s."deleteFlag"
+        AND s."latitude" BETWEEN $1::float8 AND $3::float8
+        AND s."longitude" BETWEEN $2::float8 AND $4::float8
+"""
+
+# Emission rows with a site of the year $5 and of the sources of the JSON array $6, from active calculation runs
+_EMISSIONS_WITHIN = """
+    FROM "IEmissionData" e
+    WHERE e."siteUid" IS NOT NULL
+        AND e."latitude" BETWEEN $1::float8 AND $3::float8
+        AND e."longitude" BETWEEN $2::float8 AND $4::float8
+        AND e."periodStartDt" >= make_timestamp($5::int, 1, 1, 0, 0, 0)
+        AND e."periodStartDt" < make_timestamp($5::int + 1, 1, 1, 0, 0, 0)
+        AND e."source" IN (SELECT jsonb_array_elements_text($6::jsonb))
+        AND (e."calcRunUid" IS NULL OR e."calcRunUid" IN (SELECT "uid" FROM "IEmissionCalcRun" WHERE "isActive"))
+"""
+
+_EMISSION_KT = f"""e."emissionTotal" * ({source_unit_sql('e."source"', "kt")})"""
+
+
+def site_tile_query(clustered: bool = False) -> str:
+    """
+    The sites within the bounds, or their clusters per cell of $5 degrees (count and mean position) when clustered.
+    """
+    if clustered:
+        return f"""
+            SELECT AVG(s."latitude") AS "latitude", AVG(s."longitude") AS "longitude", COUNT(*)::int AS "count"
+            {_SITES_WITHIN}
+            GROUP BY floor(s."latitude" / $5::float8), floor(s."longitude" / $5::float8)
+        """
+    return f"""
+        SELECT s."uid", s."companyName", s."sectorIdMain", s."latitude", s."longitude"
+        {_SITES_WITHIN}
+    """
+
+
+def emission_tile_query(clustered: bool = False) -> str:
+    """
+    The emissions (kt) per site within the bounds, or per cell of $7 degrees (site count, mean position and total)
+    when clustered.
+    """
+    if clustered:
+        return f"""
+            SELECT
+                AVG(e."latitude") AS "latitude",
+                AVG(e."longitude") AS "longitude",
+                COUNT(DISTINCT e."siteUid")::int AS "count",
+                SUM({_EMISSION_KT}) AS "emissionTotal"
+            {_EMISSIONS_WITHIN}
+            GROUP BY floor(e."latitude" / $7::float8), floor(e."longitude" / $7::float8)
+        """
+    return f"""
+        SELECT
+            e."siteUid",
+            AVG(e."latitude") AS "latitude",
+            AVG(e."longitude") AS "longitude",
+            SUM({_EMISSION_KT}) AS "emissionTotal"
+        {_EMISSIONS_WITHIN}
+        GROUP BY e."siteUid"
+    """
+
+
+# Changes whenever sites are created, modified or deleted. The update paths of IOrgSiteService set dateModified.
+SITES_VERSION = """
+    SELECT COUNT(*)::int AS "count", MAX(COALESCE("dateModified", "dateCreated"))::text AS "modified"
+    FROM "IOrgSite"
+"""
+
+# Changes whenever emission rows of the year $1 and of the sources of the JSON array $2 are written (the update
+# paths of IEmissionDataService set dateModified), or another calculation run of the year is published
+EMISSIONS_VERSION = """
+    SELECT
+        COUNT(*)::int AS "count",
+        MAX(COALESCE(e."dateModified", e."dateCreated"))::text AS "modified",
+        (SELECT string_agg("uid", ',' ORDER BY "uid") FROM "IEmissionCalcRun" WHERE "isActive" AND "year" = $1::int) AS "runs"
+    FROM "IEmissionData" e
+    WHERE e."periodStartDt" >= make_timestamp($1::int, 1, 1, 0, 0, 0)
+        AND e."periodStartDt" < make_timestamp($1::int + 1, 1, 1, 0, 0, 0)
+        AND e."source" IN (SELECT jsonb_array_elements_text($2::jsonb))
+"""
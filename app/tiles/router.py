@@ -0,0 +1,30 @@
+import logging
+from functools import partial
+from fastapi import APIRouter, HTTPException, Request, Response
+from app.foundation.single_flight import request_key, single_flight
+from app.tiles.service import TileService
+
+service = TileService()
+logger = logging.getLogger(__name__)
+router = APIRouter(
+    prefix="/api",
+    tags=["tiles"],
+)
+
+MVT_MEDIA_TYPE = "application/vnd.mapbox-vector-tile"
+
+
+@router.get("/tiles/{layer}/{z}/{x}/{y}.mvt")
+async def get_tile(request: Request, layer: str, z: int, x: int, y: int, year: int | None = None, source: str | None = None):
+    """
+    A vector tile of the sites or of the emissions (kt) per site of a year. Query: year (emissions), source
+    (comma separated, emissions).
+    """
+    try:
+        tile = await single_flight.do(
+            request_key(request),
+            partial(service.fetch_tile, layer, z, x, y, year=year, sources=source.split(",") if source else None),
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    return Response(content=tile, media_type=MVT_MEDIA_TYPE)
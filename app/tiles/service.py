@@ -0,0 +1,88 @@
+import json
+import logging
+from app.config.env_config import TILE_CACHE_SIZE
+from app.database import get_connection
+from app.foundation.cache import ResponseCache
+from app.tiles.queries import EMISSIONS_VERSION, SITES_VERSION, emission_tile_query, site_tile_query
+from app.utils.mvt import encode_tile, tile_bounds
+
+LAYERS = ["sites", "emissions"]
+MAX_ZOOM = 22
+# Points are clustered below this zoom level, per cell of 1/CLUSTER_CELLS of the tile side
+CLUSTER_MAX_ZOOM = 12
+CLUSTER_CELLS = 64
+# Share of the tile side read around the tile, so that symbols are not cut at the tile edges
+TILE_BUFFER = 1 / 64
+DEFAULT_EMISSION_SOURCES = ["calc:gir-db4"]
+# Seconds the data version of a layer is trusted, so that a burst of tile requests reads it once
+DATA_VERSION_TTL = 10
+
+# Tiles are keyed by the data version of their layer, so that writes of any process are picked up
+tile_cache = ResponseCache(max_size=TILE_CACHE_SIZE, ttl=24 * 3600)
+version_cache = ResponseCache(ttl=DATA_VERSION_TTL)
+
+
+class TileService:
+    def __init__(self) -> None:
+        self.prisma = get_connection()
+        self.logger = logging.getLogger(__name__)
+
+    async def fetch_tile(
+        self, layer: str, z: int, x: int, y: int, year: int | None = None, sources: list[str] | None = None
+    ) -> bytes:
+        """
+        Fetches a Mapbox Vector Tile of the points of a layer: the sites (uid, companyName, sectorIdMain) or
+        the emissions (kt) per site of a year. Only the rows within the tile are read, and below CLUSTER_MAX_ZOOM
+        they are clustered in SQL (count, and emissionTotal for emissions).
+
+        Args:
+            layer (str): One of LAYERS.
+            z (int): The zoom level.
+            x (int): The tile column.
+            y (int): The tile row.
+            year (int, optional): The year of the emissions, required by the emissions layer.
+            sources (list[str], optional): The sources of the emissions. Defaults to DEFAULT_EMISSION_SOURCES.
+
+        Returns:
+            bytes: The tile, with one layer named after the layer.
+        """
+        if layer not in LAYERS:
+            raise ValueError(f"Unknown layer {layer}, expected one of {LAYERS}")
+        if not 0 <= z <= MAX_ZOOM or not 0 <= x < 2**z or not 0 <= y < 2**z:
+            raise ValueError(f"No tile {z}/{x}/{y}")
+        if layer == "emissions" and year is None:
+            raise ValueError("The emissions layer requires a year")
+        sources = sources or DEFAULT_EMISSION_SOURCES
+        version = await self.fetch_data_version(layer, year, sources)
+        key = ResponseCache.make_key("tile", layer=layer, tile=[z, x, y], year=year, sources=sources, version=version)
+        return await tile_cache.get_or_set(key, lambda: self._encode_tile(layer, z, x, y, year, sources))
+
+    async def fetch_data_version(self, layer: str, year: int | None, sources: list[str]) -> str:
+        """
+        Returns a string that changes whenever the data of the layer changes, cached DATA_VERSION_TTL seconds.
+        """
+        async def compute() -> str:
+            if layer == "sites":
+                rows = await self.prisma.query_raw(SITES_VERSION)
+            else:
+                rows = await self.prisma.query_raw(EMISSIONS_VERSION, year, json.dumps(sources))
+            return json.dumps(rows[0], sort_keys=True)
+
+        key = ResponseCache.make_key("version", layer=layer, year=year, sources=sources)
+        return await version_cache.get_or_set(key, compute)
+
+    async def _encode_tile(self, layer: str, z: int, x: int, y: int, year: int | None, sources: list[str]) -> bytes:
+        west, south, east, north = tile_bounds(z, x, y)
+        buffer = (east - west) * TILE_BUFFER
+        bounds = [south - buffer, west - buffer, north + buffer, east + buffer]
+        clustered = z < CLUSTER_MAX_ZOOM
+        cell = [(east - west) / CLUSTER_CELLS] if clustered else []
+        if layer == "sites":
+            rows = await self.prisma.query_raw(site_tile_query(clustered), *bounds, *cell)
+        else:
+            rows = await self.prisma.query_raw(emission_tile_query(clustered), *bounds, year, json.dumps(sources), *cell)
+        features = [
+            (row["longitude"], row["latitude"], {key: value for key, value in row.items() if key not in ["latitude", "longitude"]})
+            for row in rows
+        ]
+        return encode_tile({layer: features}, z, x, y)
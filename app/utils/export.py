@@ -0,0 +1,126 @@
+import csv
+import io
+import tempfile
+from typing import Iterable, Iterator, Sequence
+import xlsxwriter
+
+try:
+    import pyarrow
+    import pyarrow.parquet
+except ImportError:  # Optional, only needed by the parquet export
+    pyarrow = None
+
+# Media type and file extension of every export format
+EXPORT_FORMATS = {
+    "csv": ("text/csv", "csv"),
+    "xlsx": ("application/vnd.openxmlformats-officedocument.spreadsheetml.sheet", "xlsx"),
+    "parquet": ("application/vnd.apache.parquet", "parquet"),
+}
+CHUNK_ROWS = 1000
+CHUNK_BYTES = 64 * 1024
+
+
+def check_export_format(export_format: str) -> None:
+    """Raises ValueError when the format is unknown or its optional dependency is not installed."""
+    if export_format not in EXPORT_FORMATS:
+        raise ValueError(f"Unknown format {export_format}, expected one of {list(EXPORT_FORMATS)}")
+    if export_format == "parquet" and pyarrow is None:
+        raise ValueError("The parquet format requires pyarrow, which is not installed")
+
+
+def stream_export(rows: Iterable[Sequence], columns: list[str], export_format: str = "csv") -> Iterator[bytes]:
+    """
+    Writes rows in the export format chunk by chunk, e.g. for a StreamingResponse.
+
+    CSV and Parquet chunks are yielded as soon as CHUNK_ROWS rows are written. XLSX is a zip file that is only
+    complete once closed, so it is written in xlsxwriter constant memory mode to a temporary file and then streamed.
+
+    Args:
+        rows (Iterable[Sequence]): The rows, in the order of the columns.
+        columns (list[str]): The column names.
+        export_format (str, optional): One of EXPORT_FORMATS. Defaults to "csv".
+
+    Returns:
+        Iterator[bytes]: The chunks of the file.
+    """
+    check_export_format(export_format)
+    if export_format == "csv":
+        return _stream_csv(rows, columns)
+    if export_format == "xlsx":
+        return _stream_xlsx(rows, columns)
+    return _stream_parquet(rows, columns)
+
+
+def _chunks(rows: Iterable[Sequence]) -> Iterator[list[Sequence]]:
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) >= CHUNK_ROWS:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def _stream_csv(rows: Iterable[Sequence], columns: list[str]) -> Iterator[bytes]:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    # BOM so that Excel opens the Korean region names as UTF-8
+    yield ("\ufeff" + buffer.getvalue()).encode("utf-8")
+    for chunk in _chunks(rows):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerows(chunk)
+        yield buffer.getvalue().encode("utf-8")
+
+
+def _stream_xlsx(rows: Iterable[Sequence], columns: list[str]) -> Iterator[bytes]:
+    with tempfile.TemporaryFile() as file:
+        workbook = xlsxwriter.Workbook(file, {"constant_memory": True, "nan_inf_to_errors": True})
+        worksheet = workbook.add_worksheet()
+        worksheet.write_row(0, 0, columns)
+        for index, row in enumerate(rows, start=1):
+            worksheet.write_row(index, 0, row)
+        workbook.close()
+        file.seek(0)
+        while chunk := file.read(CHUNK_BYTES):
+            yield chunk
+
+
+class _ChunkSink(io.RawIOBase):
+    """A write-only file collecting what pyarrow writes until it is taken."""
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.buffer.extend(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def take(self) -> bytes:
+        data, self.buffer = bytes(self.buffer), bytearray()
+        return data
+
+
+def _stream_parquet(rows: Iterable[Sequence], columns: list[str]) -> Iterator[bytes]:
+    sink = _ChunkSink()
+    writer = None
+    for chunk in _chunks(rows):
+        table = pyarrow.Table.from_pylist([dict(zip(columns, row)) for row in chunk])
+        if writer is None:
+            writer = pyarrow.parquet.ParquetWriter(sink, table.schema)
+        writer.write_table(table.cast(writer.schema))
+        yield sink.take()
+    if writer is None:
+        writer = pyarrow.parquet.ParquetWriter(sink, pyarrow.schema([(column, pyarrow.null()) for column in columns]))
+    writer.close()
+    yield sink.take()
@@ -0,0 +1,117 @@
+import math
+import struct
+from typing import Any, Iterable, Mapping
+
+# Coordinates of the features within a tile, the default of the Mapbox Vector Tile spec
+EXTENT = 4096
+MVT_VERSION = 2
+POINT = 1
+MOVE_TO = 1
+MAX_LATITUDE = 85.0511287798
+
+_VARINT, _FIXED64, _BYTES = 0, 1, 2
+
+
+def tile_bounds(z: int, x: int, y: int) -> tuple[float, float, float, float]:
+    """Returns the (west, south, east, north) bounds in degrees of the web mercator tile z/x/y."""
+    n = 2**z
+    return x / n * 360 - 180, _tile_latitude(y + 1, n), (x + 1) / n * 360 - 180, _tile_latitude(y, n)
+
+
+def project(longitude: float, latitude: float, z: int, x: int, y: int, extent: int = EXTENT) -> tuple[int, int]:
+    """Returns the coordinates of a point within the tile z/x/y, (0, 0) being its top left corner."""
+    n = 2**z
+    latitude = max(min(latitude, MAX_LATITUDE), -MAX_LATITUDE)
+    tile_x = (longitude + 180) / 360 * n
+    tile_y = (1 - math.asinh(math.tan(math.radians(latitude))) / math.pi) / 2 * n
+    return round((tile_x - x) * extent), round((tile_y - y) * extent)
+
+
+def encode_tile(
+    layers: Mapping[str, Iterable[tuple[float, float, dict]]], z: int, x: int, y: int, extent: int = EXTENT
+) -> bytes:
+    """
+    Encodes point layers as a Mapbox Vector Tile (spec 2.1), without depending on a protobuf library.
+
+    Args:
+        layers (Mapping[str, Iterable[tuple[float, float, dict]]]): Layer name -> features, each a longitude,
+            a latitude and properties (str, int, float or bool values, None values are left out).
+        z (int): The zoom level of the tile.
+        x (int): The column of the tile.
+        y (int): The row of the tile.
+        extent (int, optional): The size of the tile coordinates. Defaults to EXTENT.
+
+    Returns:
+        bytes: The tile.
+    """
+    return b"".join(_bytes_field(3, _layer(name, features, z, x, y, extent)) for name, features in layers.items())
+
+
+def _layer(name: str, features: Iterable[tuple[float, float, dict]], z: int, x: int, y: int, extent: int) -> bytes:
+    keys: dict[str, int] = {}
+    values: dict[bytes, int] = {}
+    encoded = []
+    for longitude, latitude, properties in features:
+        tags = []
+        for key, value in properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            tags.append(values.setdefault(_value(value), len(values)))
+        point_x, point_y = project(longitude, latitude, z, x, y, extent)
+        geometry = [(1 << 3) | MOVE_TO, _zigzag(point_x), _zigzag(point_y)]
+        encoded.append(_bytes_field(2, _packed_field(2, tags) + _varint_field(3, POINT) + _packed_field(4, geometry)))
+    return b"".join([
+        _varint_field(15, MVT_VERSION),
+        _bytes_field(1, name.encode("utf-8")),
+        *encoded,
+        *[_bytes_field(3, key.encode("utf-8")) for key in keys],
+        *[_bytes_field(4, value) for value in values],
+        _varint_field(5, extent),
+    ])
+
+
+def _value(value: Any) -> bytes:
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    if isinstance(value, int):
+        return _varint_field(6, _zigzag(value))
+    if isinstance(value, float):
+        return _key(3, _FIXED64) + struct.pack("<d", value)
+    return _bytes_field(1, str(value).encode("utf-8"))
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _varint(value: int) -> bytes:
+    encoded = bytearray()
+    while True:
+        byte = value & 0x7F
+        value >>= 7
+        if value:
+            encoded.append(byte | 0x80)
+        else:
+            encoded.append(byte)
+            return bytes(encoded)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _varint_field(field: int, value: int) -> bytes:
+    return _key(field, _VARINT) + _varint(value)
+
+
+def _bytes_field(field: int, value: bytes) -> bytes:
+    return _key(field, _BYTES) + _varint(len(value)) + value
+
+
+def _packed_field(field: int, values: list[int]) -> bytes:
+    return _bytes_field(field, b"".join(_varint(value) for value in values)) if values else b""
+
+
+def _tile_latitude(y: int, n: int) -> float:
+    return math.degrees(math.atan(math.sinh(math.pi * (1 - 2 * y / n))))
@@ -22,3 +22,16 @@ def to_dict(obj):
     """
     d = obj.__dict__
     return {k: v for k, v in d.items() if v is not None and v != ""}
+
+def records_to_columns(records, columns):
+    """
+    Converts a list of records to columnar arrays, a more compact JSON payload for long results.
+
+    Args:
+        records (list): A list of dictionaries.
+        columns (list): The keys to keep, missing keys become None.
+
+    Returns:
+        dict: One list per column, e.g. {"year": [2020, 2021], "emissionTotal": [1.0, 2.0]}.
+    """
+    return {column: [record.get(column) for record in records] for column in columns}
@@ -0,0 +1,36 @@
+import io
+import openpyxl
+import pytest
+from app.utils import export
+from app.utils.export import check_export_format, stream_export
+
+COLUMNS = ["regionName", "gir1Calc", "gir4Calc", "gir1"]
+ROWS = [("서울", 1.5, 2.0, None), ("부산", 3.0, None, 4.25)]
+
+
+def test_stream_csv_in_chunks(monkeypatch):
+    monkeypatch.setattr(export, "CHUNK_ROWS", 1)
+    chunks = list(stream_export(iter(ROWS), COLUMNS, "csv"))
+    assert len(chunks) == 3
+    assert b"".join(chunks).decode("utf-8-sig").splitlines() == [
+        "regionName,gir1Calc,gir4Calc,gir1", "서울,1.5,2.0,", "부산,3.0,,4.25",
+    ]
+
+
+def test_stream_xlsx():
+    workbook = openpyxl.load_workbook(io.BytesIO(b"".join(stream_export(iter(ROWS), COLUMNS, "xlsx"))))
+    rows = list(workbook.active.iter_rows(values_only=True))
+    assert rows == [tuple(COLUMNS), *ROWS]
+
+
+def test_stream_parquet():
+    pyarrow_parquet = pytest.importorskip("pyarrow.parquet")
+    table = pyarrow_parquet.read_table(io.BytesIO(b"".join(stream_export(iter(ROWS), COLUMNS, "parquet"))))
+    assert table.column_names == COLUMNS
+    assert table.num_rows == 2
+
+
+def test_check_export_format():
+    check_export_format("csv")
+    with pytest.raises(ValueError):
+        check_export_format("pdf")
@@ -0,0 +1,81 @@
+import struct
+import pytest
+from app.utils.mvt import EXTENT, encode_tile, project, tile_bounds
+
+
+def read_message(data: bytes) -> list[tuple[int, object]]:
+    """Reads the (field, value) pairs of a protobuf message, enough to check the tiles."""
+    fields, position = [], 0
+
+    def varint():
+        nonlocal position
+        value, shift = 0, 0
+        while True:
+            byte = data[position]
+            position += 1
+            value |= (byte & 0x7F) << shift
+            shift += 7
+            if not byte & 0x80:
+                return value
+
+    while position < len(data):
+        key = varint()
+        field, wire_type = key >> 3, key & 7
+        if wire_type == 0:
+            fields.append((field, varint()))
+        elif wire_type == 1:
+            fields.append((field, struct.unpack("<d", data[position:position + 8])[0]))
+            position += 8
+        else:
+            length = varint()
+            fields.append((field, data[position:position + length]))
+            position += length
+    return fields
+
+
+def read_varints(data: bytes) -> list[int]:
+    values, value, shift = [], 0, 0
+    for byte in data:
+        value |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value, shift = 0, 0
+    return values
+
+
+def test_tile_bounds():
+    assert tile_bounds(0, 0, 0) == pytest.approx((-180, -85.0511287798, 180, 85.0511287798))
+    west, south, east, north = tile_bounds(7, 109, 49)
+    assert west < 127.0 < east
+    assert south < 37.5 < north
+
+
+def test_project():
+    assert project(0, 0, 0, 0, 0) == (EXTENT // 2, EXTENT // 2)
+    assert project(-180, 85.0511287798, 0, 0, 0) == (0, 0)
+    assert project(180, 0, 1, 1, 0) == (EXTENT, EXTENT)
+
+
+def test_encode_tile():
+    tile = encode_tile(
+        {"sites": [(0.0, 0.0, {"companyName": "a", "count": 3, "emissionTotal": 1.5, "operating": True, "sector": None})]},
+        0, 0, 0,
+    )
+    [(field, layer)] = read_message(tile)
+    assert field == 3
+    layer = read_message(layer)
+    assert (15, 2) in layer and (1, b"sites") in layer and (5, EXTENT) in layer
+    keys = [value.decode() for field, value in layer if field == 3]
+    assert keys == ["companyName", "count", "emissionTotal", "operating"]
+    values = [read_message(value)[0] for field, value in layer if field == 4]
+    assert values == [(1, b"a"), (6, 6), (3, 1.5), (7, 1)]
+    [feature] = [read_message(value) for field, value in layer if field == 2]
+    assert read_varints(dict(feature)[2]) == [0, 0, 1, 1, 2, 2, 3, 3]
+    assert dict(feature)[3] == 1
+    assert read_varints(dict(feature)[4]) == [9, EXTENT, EXTENT]
+
+
+def test_encode_empty_layer():
+    [(_, layer)] = read_message(encode_tile({"sites": []}, 3, 1, 1))
+    assert [field for field, _ in read_message(layer)] == [15, 1, 5]
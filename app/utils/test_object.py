@@ -1,5 +1,6 @@
 
 from app.utils.data_types import to_dict
+from app.utils.object import records_to_columns
 
 def test_object_with_attributes():
     # Test converting an object with attributes to a dictionary
@@ -33,3 +34,8 @@ def test_object_with_empty_string_attributes():
     obj = MyClass()
     expected_dict = { "attr1": "", "attr2": "" }
     assert to_dict(obj) == expected_dict
+
+def test_records_to_columns():
+    records = [{"year": 2020, "emissionTotal": 1.0}, {"year": 2021}]
+    assert records_to_columns(records, ["year", "emissionTotal"]) == {"year": [2020, 2021], "emissionTotal": [1.0, None]}
+    assert records_to_columns([], ["year"]) == {"year": []}
@@ -0,0 +1,57 @@
+import numpy as np
+import pandas as pd
+import pytest
+from app.utils.units import co2eq_sql, convert_units, gwp_factors, gwp_sql, source_unit_factors, to_co2eq, unit_factor
+
+
+def test_unit_factor():
+    assert unit_factor("t", "kt") == 0.001
+    assert unit_factor("kt", "t") == 1000
+    assert unit_factor("kt", "kt") == 1
+    with pytest.raises(ValueError):
+        unit_factor("g", "kt")
+
+
+def test_convert_units_vectorized():
+    values = pd.Series([1000.0, 2500.0])
+    assert list(convert_units(values, "t", "kt")) == [1.0, 2.5]
+    assert convert_units(np.array([1.0]), "Mt", "kt")[0] == 1000
+
+
+def test_gwp_factors():
+    pollutants = pd.Series(["CO2", "CH4", "co2eq", "tCO2eq", "XYZ", None])
+    factors = gwp_factors(pollutants, "SAR")
+    assert list(factors[:4]) == [1, 21, 1, 1]
+    assert factors[4:].isna().all()
+    assert gwp_factors(pd.Series(["CH4"]))[0] == 28
+    with pytest.raises(ValueError):
+        gwp_factors(pollutants, "AR99")
+
+
+def test_source_unit_factors():
+    factors = source_unit_factors(pd.Series(["orig:gir-db4", "orig:gir-db1", "unknown"]))
+    assert list(factors[:2]) == [1, 0.001]
+    assert np.isnan(factors[2])
+
+
+def test_to_co2eq():
+    df = pd.DataFrame({
+        "emissionTotal": [10.0, 2.0, 4000.0, 1.0],
+        "pollutantId": ["CO2", "CH4", "CO2eq", "XYZ"],
+        "source": ["orig:gir-db4", "orig:gir-db4", "orig:gir-db1", "orig:gir-db4"],
+    })
+    result = to_co2eq(df, gwp_set="AR5")
+    assert list(result[:3]) == pytest.approx([10.0, 56.0, 4.0])
+    assert np.isnan(result[3])
+    # CO2eq of the CO2 and CH4 sheets of a category in one pass
+    assert result[:2].sum() == pytest.approx(66.0)
+
+
+def test_co2eq_sql():
+    sql = gwp_sql('e."pollutantId"', "SAR")
+    assert sql.startswith('CASE upper(e."pollutantId") WHEN \'CO2\' THEN 1')
+    assert "WHEN 'CH4' THEN 21" in sql
+    assert sql.endswith("ELSE NULL END")
+    expression = co2eq_sql("x", "kt", "SAR")
+    assert expression.startswith('x."emissionTotal" * (CASE upper(x."pollutantId")')
+    assert "WHEN 'orig:gir-db1' THEN 0.001" in expression
@@ -0,0 +1,140 @@
+import numpy as np
+import pandas as pd
+from app.config.column_mapping import default_gwp_set, gwp_values, source_units, unit_factors
+
+
+def unit_factor(from_unit: str, to_unit: str) -> float:
+    """
+    Returns the factor converting a quantity in from_unit to to_unit.
+
+    Parameters:
+        from_unit (str): The unit of the quantity, one of unit_factors (e.g. "t").
+        to_unit (str): The wanted unit (e.g. "kt").
+
+    Returns:
+        float: The factor.
+
+    Example:
+    >>> unit_factor("t", "kt")
+    0.001
+    """
+    if from_unit not in unit_factors or to_unit not in unit_factors:
+        raise ValueError(f"Unknown unit {from_unit} or {to_unit}, expected one of {list(unit_factors)}")
+    return unit_factors[from_unit] / unit_factors[to_unit]
+
+
+def convert_units(values, from_unit: str, to_unit: str):
+    """
+    Converts a scalar, numpy array or pandas Series from one unit to another.
+
+    Parameters:
+        values: The quantities.
+        from_unit (str): The unit of the quantities.
+        to_unit (str): The wanted unit.
+
+    Returns:
+        The converted quantities, of the same type as values.
+    """
+    return values * unit_factor(from_unit, to_unit)
+
+
+def gwp_factors(pollutants: pd.Series, gwp_set: str | None = None) -> pd.Series:
+    """
+    Maps pollutantIds to their global warming potential. Unknown pollutants map to NaN, so they are
+    left out of the sums instead of being counted as CO2.
+
+    Parameters:
+        pollutants (pd.Series): The pollutantIds (case-insensitive).
+        gwp_set (str, optional): The assessment report, one of gwp_values. Defaults to default_gwp_set.
+
+    Returns:
+        pd.Series: The GWP of each pollutant.
+    """
+    gwp = _gwp_set(gwp_set)
+    return pollutants.astype("string").str.upper().map(gwp).astype(float)
+
+
+def source_unit_factors(sources: pd.Series, to_unit: str = "kt") -> pd.Series:
+    """
+    Maps sources to the factor converting their emissionTotal (see source_units) to to_unit.
+    Sources with an unknown unit map to NaN.
+
+    Parameters:
+        sources (pd.Series): The sources.
+        to_unit (str, optional): The wanted unit. Defaults to "kt".
+
+    Returns:
+        pd.Series: The factor of each source.
+    """
+    factors = {source: unit_factor(unit, to_unit) for source, unit in source_units.items()}
+    return sources.map(factors).astype(float)
+
+
+def to_co2eq(
+    df: pd.DataFrame,
+    value_column: str = "emissionTotal",
+    pollutant_column: str = "pollutantId",
+    source_column: str = "source",
+    to_unit: str = "kt",
+    gwp_set: str | None = None,
+) -> pd.Series:
+    """
+    Converts the emissions of a DataFrame to CO2 equivalents in to_unit, with one vectorized operation.
+
+    Parameters:
+        df (pd.DataFrame): The emissions, with a value, a pollutant and a source column.
+        value_column (str, optional): Defaults to "emissionTotal".
+        pollutant_column (str, optional): Defaults to "pollutantId".
+        source_column (str, optional): Used to know the unit of each row (see source_units). Defaults to "source".
+        to_unit (str, optional): Defaults to "kt".
+        gwp_set (str, optional): Defaults to default_gwp_set.
+
+    Returns:
+        pd.Series: The CO2 equivalents, NaN for unknown pollutants or sources.
+    """
+    values = pd.to_numeric(df[value_column], errors="coerce").astype(float)
+    factors = gwp_factors(df[pollutant_column], gwp_set) * source_unit_factors(df[source_column], to_unit)
+    return pd.Series(np.asarray(values) * np.asarray(factors), index=df.index)
+
+
+def gwp_sql(pollutant_column: str, gwp_set: str | None = None) -> str:
+    """
+    Returns a SQL CASE expression of the GWP of pollutant_column, NULL for unknown pollutants,
+    e.g. CASE upper(e."pollutantId") WHEN 'CO2' THEN 1 WHEN 'CH4' THEN 28 ... ELSE NULL END.
+    """
+    cases = " ".join(f"WHEN {_sql_literal(pollutant)} THEN {value!r}" for pollutant, value in _gwp_set(gwp_set).items())
+    return f"CASE upper({pollutant_column}) {cases} ELSE NULL END"
+
+
+def source_unit_sql(source_column: str, to_unit: str = "kt") -> str:
+    """
+    Returns a SQL CASE expression of the factor converting the emissionTotal of source_column to to_unit.
+    """
+    cases = " ".join(
+        f"WHEN {_sql_literal(source)} THEN {unit_factor(unit, to_unit)!r}" for source, unit in source_units.items()
+    )
+    return f"CASE {source_column} {cases} ELSE NULL END"
+
+
+def co2eq_sql(alias: str = "e", to_unit: str = "kt", gwp_set: str | None = None) -> str:
+    """
+    Returns a SQL expression of the emissionTotal of the IEmissionData alias in CO2 equivalents of to_unit,
+    the SQL counterpart of to_co2eq.
+    """
+    pollutant_column = f'{alias}."pollutantId"'
+    source_column = f'{alias}."source"'
+    return (
+        f'{alias}."emissionTotal" * ({gwp_sql(pollutant_column, gwp_set)})'
+        f" * ({source_unit_sql(source_column, to_unit)})"
+    )
+
+
+def _gwp_set(gwp_set: str | None) -> dict:
+    gwp_set = gwp_set or default_gwp_set
+    if gwp_set not in gwp_values:
+        raise ValueError(f"Unknown GWP set {gwp_set}, expected one of {list(gwp_values)}")
+    return gwp_values[gwp_set]
+
+
+def _sql_literal(value: str) -> str:
+    return "'" + str(value).replace("'", "''") + "'"
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+import pandas as pd
+from app.database import get_connection
+from app.emission_data.service import IEmissionDataService
+from app.foundation.arg_parse import parse_args
+from app.utils.object import list_of_objects_to_dict
+
+##Benchmarks /iemissiondata-mapdata/ on synthetic rows of BENCHMARK_YEAR: the former row-by-row implementation
+##(every row with its Region loaded into pandas), the SQL pushdown (live) and the rollups. Use a test database.
+BENCHMARK_YEAR = 1900
+DISTRICT_COUNT = 250
+
+SEED_CALC_ROWS = """
+    INSERT INTO "IEmissionData" (
+        "uid", "categoryName", "periodStartDt", "periodEndDt", "periodLength", "emissionTotal", "source",
+        "regionUid", "regionName", "pollutantId", "calcRunUid"
+    )
+    SELECT
+        gen_random_uuid()::text, '2.A', make_timestamp($1, 1, 1, 0, 0, 0), make_timestamp($1, 12, 31, 0, 0, 0), '1Y',
+        random() * 100, CASE WHEN i % 2 = 0 THEN 'calc:gir-db4' ELSE 'calc:gir-db1' END,
+        $3::jsonb->>(i % jsonb_array_length($3::jsonb)), 'bench', 'CO2', $2
+    FROM generate_series(1, $4) AS i
+"""
+
+SEED_GIR1_ROWS = """
+    INSERT INTO "IEmissionData" (
+        "uid", "categoryName", "periodStartDt", "periodEndDt", "periodLength", "emissionTotal", "source",
+        "regionName", "pollutantId", "latitude", "longitude"
+    )
+    SELECT
+        gen_random_uuid()::text, '2.A', make_timestamp($1, 1, 1, 0, 0, 0), make_timestamp($1, 12, 31, 0, 0, 0), '1Y',
+        random() * 1000, 'orig:gir-db1', 'bench-' || (i % 17), 'CO2', 37.0, 127.0
+    FROM generate_series(1, $2) AS i
+"""
+
+
+async def row_by_row(db, year_start: str, year_end: str) -> dict:
+    """The implementation before the rollups, kept here as the baseline."""
+    sources = {}
+    for source in ["calc:gir-db4", "calc:gir-db1"]:
+        rows = await db.iemissiondata.find_many(
+            where={
+                "source": source,
+                "calcRun": {"is": {"isActive": True}},
+                "regionUid": {"not": None},
+                "periodStartDt": {"gte": year_start},
+                "periodEndDt": {"lte": year_end},
+            },
+            include={"region": True},
+        )
+        df = pd.DataFrame(list_of_objects_to_dict(rows))
+        df["latitude"] = df.apply(lambda x: x["region"].latitude, axis=1)
+        df["longitude"] = df.apply(lambda x: x["region"].longitude, axis=1)
+        sources[source] = df.groupby(["regionUid"], as_index=False).agg(
+            {"emissionTotal": "sum", "latitude": "mean", "longitude": "mean", "regionName": "first"}
+        )
+    return sources
+
+
+async def timed(label: str, rows: int, func) -> None:
+    started = time.perf_counter()
+    await func()
+    print(f"{rows:>8} rows  {label:<12} {(time.perf_counter() - started) * 1000:10.1f} ms")
+
+
+@parse_args
+async def main(rows: str = "10000,100000"):
+    db = get_connection()
+    await db.connect()
+    service = IEmissionDataService()
+    year_start, year_end = f"{BENCHMARK_YEAR}-01-01", f"{BENCHMARK_YEAR + 1}-01-01"
+    province = await db.region.create(data={"createdByUid": "benchmark", "type": "province", "id": "bench", "name": "bench", "latitude": 37.0, "longitude": 127.0})
+    districts = [
+        await db.region.create(data={
+            "createdByUid": "benchmark", "type": "district", "id": f"bench-{index}", "name": f"bench-{index}",
+            "parentUid": province.uid, "latitude": 37.0 + index / 1000, "longitude": 127.0,
+        })
+        for index in range(DISTRICT_COUNT)
+    ]
+    run = await db.iemissioncalcrun.create(data={"year": BENCHMARK_YEAR, "mode": "benchmark", "status": "published", "isActive": True})
+    try:
+        for row_count in [int(count) for count in rows.split(",")]:
+            await db.iemissiondata.delete_many(where={"calcRunUid": run.uid})
+            await db.execute_raw(SEED_CALC_ROWS, BENCHMARK_YEAR, run.uid, json.dumps([district.uid for district in districts]), row_count)
+            await db.execute_raw(SEED_GIR1_ROWS, BENCHMARK_YEAR, max(row_count // 10, 1))
+            await service.refresh_region_rollups(BENCHMARK_YEAR)
+            await timed("row by row", row_count, lambda: row_by_row(db, year_start, year_end))
+            await timed("live", row_count, lambda: service.fetch_grouped_by_region(year_start, year_end, {"categoryName": "2.A"}, live=True))
+            await timed("rollups", row_count, lambda: service.fetch_grouped_by_region(year_start, year_end, {"categoryName": "2.A"}))
+            await db.iemissiondata.delete_many(where={"source": "orig:gir-db1", "regionName": {"startswith": "bench-"}})
+    finally:
+        await db.iemissiondata.delete_many(where={"source": "orig:gir-db1", "regionName": {"startswith": "bench-"}})
+        await db.iemissionregionrollup.delete_many(where={"year": BENCHMARK_YEAR})
+        await db.iemissioncalcrun.delete(where={"uid": run.uid})
+        await db.region.delete_many(where={"uid": {"in": [district.uid for district in districts]}})
+        await db.region.delete(where={"uid": province.uid})
+        await db.disconnect()
+
+if __name__ == "__main__":
+    asyncio.run(main())
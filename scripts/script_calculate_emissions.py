@@ -6,11 +6,14 @@ from app.foundation.arg_parse import parse_args
 service = IEmissionDataService()
 
 @parse_args
-async def main(year_from: int=2020, year_to: int = 2021):
+async def main(year_from: int=2020, year_to: int = 2021, mode: str = "set"):
     db = get_connection()
     await db.connect()
+    if mode == "incremental": ##Only the dirty (category, year) groups, year range is ignored
+        await service.calculate_emissions(mode=mode)
+        return
     for year in range(year_from, year_to): ##Range is end exclusive, thus 2021 means until 2020
-        await service.calculate_emissions(year=year)
+        await service.calculate_emissions(year=year, mode=mode)
 
 if __name__ == "__main__":
     asyncio.run(main())
@@ -0,0 +1,16 @@
+import asyncio
+from app.database import get_connection
+from app.emission_data.service import IEmissionDataService
+from app.foundation.arg_parse import parse_args
+
+service = IEmissionDataService()
+
+@parse_args
+async def main(year_from: int = 2020, year_to: int = 2021):
+    db = get_connection()
+    await db.connect()
+    ##Range is end exclusive, thus 2021 means until 2020
+    print(await service.estimate_emissions_by_intensity(year_from=year_from, year_to=year_to))
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,23 @@
+import asyncio
+from app.database import get_connection
+from app.emission_data.service import IEmissionDataService
+from app.foundation.arg_parse import parse_args
+from app.utils.data_types import parse_to_date
+
+service = IEmissionDataService()
+
+@parse_args
+async def main(source: str = "calc:", date_from: str = "", date_to: str = "", category_name: str = "", batch_size: int = 5000):
+    db = get_connection()
+    await db.connect()
+    stats = await service.purge_emissions(
+        source_prefix=source,
+        date_from=parse_to_date(date_from),
+        date_to=parse_to_date(date_to),
+        category_name=category_name or None,
+        batch_size=batch_size,
+    )
+    print(f"Deleted {stats['deleted']} rows of {stats['sources']} in {stats['batches']} batches ({stats['rowsPerSecond']} rows/sec)")
+
+if __name__ == "__main__":
+    asyncio.run(main())